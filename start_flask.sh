@@ -1 +1 @@
-flask run --host 0.0.0.0 --port 8080
+flask migrate && flask run --host 0.0.0.0 --port 8080
@@ -0,0 +1,62 @@
+from vitality.autocomplete import Autocomplete, PrefixIndex
+
+
+def test_prefix_index_search():
+    index = PrefixIndex()
+    index.load([
+        ('1', 'testtrainer', 'First Last'),
+        ('2', 'trainerbob', 'Bob Builder'),
+        ('3', 'alice', None)
+    ])
+    assert len(index) == 3
+
+    assert [user['_id'] for user in index.search('test')] == ['1']
+    assert [user['_id'] for user in index.search('TRAIN')] == ['2']
+    assert [user['_id'] for user in index.search('b')] == ['2']
+    assert [user['_id'] for user in index.search('la')] == ['1']
+    assert index.search('none') == []
+    assert index.search('') == []
+    assert index.search('zzz') == []
+
+    # A user matching on several keys is only returned once
+    assert len(index.search('bob')) == 1
+    assert len(index.search('t', limit=1)) == 1
+
+
+def test_prefix_index_updates():
+    index = PrefixIndex()
+    index.add('1', 'testtrainer', 'first last')
+    assert index.search('test')[0] == {
+        '_id': '1',
+        'username': 'testtrainer',
+        'name': 'first last'
+    }
+
+    index.update('1', username='renamed')
+    assert index.search('test') == []
+    assert index.search('renamed')[0]['_id'] == '1'
+    assert index.search('first')[0]['username'] == 'renamed'
+
+    index.update('1', name='other')
+    assert index.search('first') == []
+    assert index.search('other')[0]['_id'] == '1'
+
+    # Updating a user that is not indexed does nothing
+    index.update('2', username='ghost')
+    assert index.search('ghost') == []
+
+    index.remove('1')
+    assert index.search('renamed') == []
+    assert len(index) == 0
+
+
+def test_autocomplete_roles():
+    autocomplete = Autocomplete()
+    autocomplete.add('trainer', '1', 'testtrainer', None)
+    autocomplete.add('trainee', '2', 'testtrainee', None)
+
+    assert [user['_id'] for user in autocomplete.search('trainer', 'test')] == ['1']
+    assert [user['_id'] for user in autocomplete.search('trainee', 'test')] == ['2']
+
+    autocomplete.remove('trainer', '1')
+    assert autocomplete.search('trainer', 'test') == []
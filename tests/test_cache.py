@@ -0,0 +1,60 @@
+from vitality.cache import LRUCache
+from time import sleep
+
+
+def test_get_set():
+    cache = LRUCache(maxsize=2, ttl=60)
+    assert cache.get('missing') is None
+    assert cache.get('missing', 'default') == 'default'
+
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+    cache.delete('a')
+    assert cache.get('a') is None
+
+
+def test_eviction():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    # 'a' is now the most recently used, so 'b' gets evicted
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+    assert len(cache) == 2
+
+
+def test_expiration():
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set('a', 1)
+    sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+    assert len(cache) == 0
+
+
+def test_disabled():
+    cache = LRUCache(maxsize=0, ttl=60)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_stats():
+    cache = LRUCache(maxsize=2, ttl=60)
+    assert cache.stats()['hit_ratio'] == 0.0
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    assert cache.stats()['hit_ratio'] == 0.5
+
+    cache.reset()
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['size'] == 0
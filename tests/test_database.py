@@ -2,10 +2,19 @@ from bson.objectid import ObjectId
 from copy import deepcopy
 from datetime import datetime
 from vitality.database import *
+from vitality.migrations import (
+    MIGRATIONS,
+    MIGRATION_DOCUMENT_ID,
+    LATEST_VERSION,
+    find_duplicate_usernames,
+    get_schema_version,
+    list_pending_migrations,
+    migrate)
 from vitality.trainee import Trainee
 from vitality.trainer import Trainer
 from vitality.workout import Workout
 from vitality.settings import MONGO_URI
+import base64
 import unittest
 
 
@@ -45,6 +54,10 @@ class TestDatabase(unittest.TestCase):
         miles="2",
         category="cardio")
 
+    @classmethod
+    def setUpClass(cls):
+        migrate(cls.database)
+
     def setUp(self):
         self.tearDown()
         self.assertTrue(self.test_trainee.password == 'password')
@@ -81,6 +94,49 @@ class TestDatabase(unittest.TestCase):
         hashed_password = '009e3e71eed006baa4441cdc417e58f72a635e52f814400e6301881620628d8b'
         self.assertTrue(password_sha256(password) == hashed_password)
 
+    def test_database_shares_client(self):
+        other_database = Database(MONGO_URI)
+        self.assertTrue(other_database.mongo.client is self.database.mongo.client)
+        self.assertTrue(get_mongo_client(MONGO_URI) is self.database.mongo.client)
+
+    def test_migrate(self):
+        # Migrations are idempotent and leave the schema at the latest version
+        self.assertEqual(migrate(self.database), [])
+        self.assertEqual(get_schema_version(self.database), LATEST_VERSION)
+        self.assertEqual(list_pending_migrations(self.database), [])
+
+        # Events stored before migration 6 have string dates
+        event_id = self.database.mongo.event.insert_one({
+            'title': 'migratedEvent',
+            'date': str(datetime(2020, 12, 2))
+        }).inserted_id
+
+        self.database.mongo.migration.delete_one({'_id': MIGRATION_DOCUMENT_ID})
+        self.assertEqual(get_schema_version(self.database), 0)
+        try:
+            self.assertEqual(migrate(self.database),
+                             [version for version, _, _ in MIGRATIONS])
+            self.assertEqual(self.database.mongo.event.find_one({'_id': event_id})['date'],
+                             datetime(2020, 12, 2))
+        finally:
+            self.database.mongo.event.delete_one({'_id': event_id})
+        self.assertEqual(get_schema_version(self.database), LATEST_VERSION)
+
+        indexes = self.database.mongo.trainee.index_information()
+        self.assertIn('trainee_search_index', indexes)
+        self.assertTrue(indexes['trainee_username_unique_index']['unique'])
+        self.assertNotIn('trainee_username_index', indexes)
+
+    def test_migrate_duplicate_usernames(self):
+        self.assertEqual(find_duplicate_usernames(self.database.mongo.trainee), {})
+
+        collection = self.database.mongo.duplicate_username_test
+        try:
+            collection.insert_many([{'username': 'twin'}, {'username': 'twin'}, {'username': 'single'}])
+            self.assertEqual(find_duplicate_usernames(collection), {'twin': 2})
+        finally:
+            collection.drop()
+
     """Trainee tests"""
 
     def test_trainee_add_trainer(self):
@@ -302,6 +358,144 @@ class TestDatabase(unittest.TestCase):
         trainee = self.database.get_trainee_by_username("testtrainee")
         self.assertEqual(found_trainees[0].as_dict(), trainee.as_dict())
 
+    def test_search_grams(self):
+        self.assertEqual(search_grams("Abc"), ['a', 'ab', 'abc', 'b', 'bc', 'c'])
+        self.assertEqual(search_query_grams("ab"), ['ab'])
+        self.assertEqual(search_query_grams("Train"), ['tra', 'rai', 'ain'])
+
+        trainee = self.database.mongo.trainee.find_one({'username': 'testtrainee'})
+        self.assertEqual(trainee['username_grams'], search_grams('testtrainee'))
+        self.assertEqual(trainee['name_grams'], search_grams('first last'))
+
+        self.database.set_trainee_name(str(trainee['_id']), 'othername')
+        trainee = self.database.mongo.trainee.find_one({'username': 'testtrainee'})
+        self.assertEqual(trainee['name_grams'], search_grams('othername'))
+
+    def test_list_users_by_search_ranking(self):
+        # Middle of the word substrings are still found
+        found_trainees = self.database.list_trainees_by_search("trainee")
+        self.assertIn("testtrainee", [trainee.username for trainee in found_trainees])
+
+        # Non contiguous grams do not match
+        self.assertEqual(self.database.list_trainees_by_search("testee"), [])
+
+        # Empty and too short terms are not searched
+        self.assertEqual(self.database.list_trainees_by_search(""), [])
+        self.assertEqual(self.database.list_trainees_by_search("t" * (MIN_SEARCH_TERM_LENGTH - 1)), [])
+        self.assertEqual(list(self.database.iter_trainees_by_search("")), [])
+
+        # Exact usernames rank first and the limit is applied
+        new_trainee = deepcopy(self.test_trainee)
+        new_trainee.username = "testtraineezz"
+        self.database.add_trainee(new_trainee)
+        try:
+            found_trainees = self.database.list_trainees_by_search("testtrainee")
+            self.assertEqual([trainee.username for trainee in found_trainees],
+                             ["testtrainee", "testtraineezz"])
+
+            found_trainees = self.database.list_trainees_by_search("testtrainee", limit=1)
+            self.assertEqual(len(found_trainees), 1)
+
+            # Pages continue in relevance order
+            found_trainees, next_cursor = self.database.list_trainees_page_by_search(
+                "testtrainee", limit=1)
+            self.assertEqual(found_trainees[0].username, "testtrainee")
+            found_trainees, next_cursor = self.database.list_trainees_page_by_search(
+                "testtrainee", limit=1, cursor=next_cursor)
+            self.assertEqual(found_trainees[0].username, "testtraineezz")
+            self.assertTrue(next_cursor is None)
+
+            self.assertEqual([trainee.username for trainee in
+                              self.database.iter_trainees_by_search("testtrainee")],
+                             ["testtrainee", "testtraineezz"])
+        finally:
+            self.database.mongo.trainee.delete_many({'username': 'testtraineezz'})
+
+    def test_get_user_by_id(self):
+        trainee = self.database.get_trainee_by_username("testtrainee")
+        trainer = self.database.get_trainer_by_username("testtrainer")
+
+        found_user = self.database.get_user_by_id(trainee._id)
+        self.assertTrue(type(found_user) is Trainee)
+        self.assertEqual(found_user.as_dict(), trainee.as_dict())
+
+        found_user = self.database.get_user_by_id(trainer._id)
+        self.assertTrue(type(found_user) is Trainer)
+        self.assertEqual(found_user.as_dict(), trainer.as_dict())
+
+        self.assertTrue(self.database.get_user_by_id("123456789012345678901234") is None)
+
+    def test_get_user_by_username(self):
+        trainee = self.database.get_trainee_by_username("testtrainee")
+        trainer = self.database.get_trainer_by_username("testtrainer")
+
+        found_user = self.database.get_user_by_username("testtrainee")
+        self.assertTrue(type(found_user) is Trainee)
+        self.assertEqual(found_user.as_dict(), trainee.as_dict())
+
+        found_user = self.database.get_user_by_username("testtrainer")
+        self.assertTrue(type(found_user) is Trainer)
+        self.assertEqual(found_user.as_dict(), trainer.as_dict())
+
+        self.assertTrue(self.database.get_user_by_username("notauser") is None)
+
+    def test_identity_map(self):
+        database = Database(MONGO_URI, identity_map=True)
+        trainee = database.get_trainee_by_username("testtrainee")
+        trainer = database.get_trainer_by_username("testtrainer")
+
+        # First lookup misses, the second is served from the identity map
+        first = database.get_trainee_by_id(trainee._id)
+        self.assertEqual(database.identity_map.stats()['misses'], 1)
+        second = database.get_trainee_by_id(trainee._id)
+        self.assertEqual(database.identity_map.stats()['hits'], 1)
+        self.assertTrue(first is second)
+
+        # get_user_by_id remembers both roles
+        self.assertTrue(database.get_user_by_id(trainer._id) is not None)
+        hits = database.identity_map.hits
+        self.assertTrue(database.get_trainee_by_id(trainer._id) is None)
+        self.assertTrue(type(database.get_trainer_by_id(trainer._id)) is Trainer)
+        self.assertEqual(database.identity_map.hits, hits + 2)
+
+        # Setters invalidate the remembered model
+        database.set_trainee_name(trainee._id, "newname")
+        self.assertEqual(database.get_trainee_by_id(trainee._id).name, "newname")
+
+        # Without the identity map nothing is remembered
+        self.assertTrue(self.database.identity_map is None)
+        self.assertTrue(self.database.get_trainee_by_id(trainee._id)
+                        is not self.database.get_trainee_by_id(trainee._id))
+
+    def test_shared_user_cache(self):
+        database = Database(MONGO_URI, shared_cache=True)
+        other_database = Database(MONGO_URI, shared_cache=True)
+        trainee = database.get_trainee_by_username("testtrainee")
+        trainer = database.get_trainer_by_username("testtrainer")
+        user_cache.clear()
+
+        # A lookup made by one Database is served from the cache to another
+        database.get_trainee_by_id(trainee._id)
+        hits = user_cache.hits
+        cached_trainee = other_database.get_trainee_by_id(trainee._id)
+        self.assertEqual(user_cache.hits, hits + 1)
+        self.assertEqual(cached_trainee.as_dict(), trainee.as_dict())
+        self.assertTrue(other_database.get_trainer_by_id(trainee._id) is None)
+        self.assertTrue(type(other_database.get_user_by_id(trainee._id)) is Trainee)
+
+        # Cached classes are copies, mutating one does not leak into the cache
+        cached_trainee.name = "changed"
+        self.assertEqual(database.get_trainee_by_id(trainee._id).name, trainee.name)
+
+        # Writes through any Database invalidate the cache
+        database.get_trainer_by_id(trainer._id)
+        self.database.add_trainer_experience(trainer._id, 10)
+        self.assertEqual(other_database.get_trainer_by_id(trainer._id).exp, 10)
+
+        stats = user_cache.stats()
+        self.assertTrue(0 < stats['hit_ratio'] <= 1)
+        self.assertIn('evictions', stats)
+
     """ Test trainer """
 
     def test_add_trainer_experience(self):
@@ -475,6 +669,47 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(
             self.database.get_trainee_by_id(db_user._id) is None)
 
+    def test_update_user_profile(self):
+        trainee = self.database.get_trainee_by_username(self.test_trainee.username)
+        trainer = self.database.get_trainer_by_username(self.test_trainer.username)
+
+        updated_trainee = self.database.update_user_profile(trainee._id, 'trainee',
+                                                            password='newpassword',
+                                                            name='newname',
+                                                            phone='0987654321',
+                                                            lng=5,
+                                                            lat=6)
+        self.assertEqual(updated_trainee.password, password_sha256('newpassword'))
+        self.assertEqual(updated_trainee.name, 'newname')
+        self.assertEqual(updated_trainee.phone, '0987654321')
+        self.assertEqual((updated_trainee.lng, updated_trainee.lat), (5, 6))
+        self.assertEqual(self.database.get_trainee_by_id(trainee._id).as_dict(),
+                         updated_trainee.as_dict())
+        self.assertEqual([found.username for found in
+                          self.database.list_trainees_by_search('newname')], [trainee.username])
+
+        # Usernames taken by either role are refused
+        with self.assertRaises(UsernameTakenError):
+            self.database.update_user_profile(trainee._id, 'trainee', username=trainer.username)
+        new_trainee = deepcopy(self.test_trainee)
+        new_trainee.username = "testtraineezz"
+        self.database.add_trainee(new_trainee)
+        try:
+            with self.assertRaises(UsernameTakenError):
+                self.database.update_user_profile(trainee._id, 'trainee', username='testtraineezz')
+        finally:
+            self.database.mongo.trainee.delete_many({'username': 'testtraineezz'})
+
+        with self.assertRaises(InvalidProfileFieldError):
+            self.database.update_user_profile(trainee._id, 'trainee', exp=100)
+        with self.assertRaises(InvalidProfileFieldError):
+            self.database.update_user_profile(trainee._id, 'trainee', lng=5)
+        with self.assertRaises(InvalidProfileFieldError):
+            self.database.update_user_profile(trainee._id, 'admin', name='name')
+
+        self.assertTrue(self.database.update_user_profile(
+            "123456789012345678901234", 'trainee', name='name') is None)
+
     def test_set_trainer_phone(self):
 
         new_trainer = deepcopy(self.test_trainer)
@@ -947,6 +1182,72 @@ class TestDatabase(unittest.TestCase):
             self.database.mongo.trainee.delete_many(
                 {"username": "testtrainee1"})
 
+    def test_search_workouts(self):
+        creator_id = self.test_workout.creator_id
+        try:
+            for number, difficulty in enumerate(['easy', 'hard', 'hard']):
+                self.database.add_workout(Workout(
+                    _id=None,
+                    creator_id=creator_id,
+                    name="searchable squat {}".format(number),
+                    difficulty=difficulty,
+                    about="squats for legs",
+                    category="strength"))
+
+            search = self.database.search_workouts("searchable squat", limit=2)
+            self.assertEqual(len(search['workouts']), 2)
+            self.assertEqual(search['facets']['difficulty'], {'easy': 1, 'hard': 2})
+            self.assertEqual(search['facets']['category'], {'strength': 3})
+            self.assertTrue(search['next_cursor'] is not None)
+
+            # The second page continues where the first stopped
+            next_search = self.database.search_workouts("searchable squat",
+                                                        limit=2,
+                                                        cursor=search['next_cursor'])
+            self.assertEqual(len(next_search['workouts']), 1)
+            self.assertTrue(next_search['next_cursor'] is None)
+            self.assertTrue(next_search['facets'] is None)
+            names = [workout.name for workout in search['workouts'] + next_search['workouts']]
+            self.assertEqual(len(set(names)), 3)
+
+            # Filters only narrow the results, not the facet counts
+            search = self.database.search_workouts("searchable squat", difficulty="hard")
+            self.assertEqual(len(search['workouts']), 2)
+            self.assertEqual(search['facets']['difficulty'], {'easy': 1, 'hard': 2})
+            search = self.database.search_workouts("searchable squat", category="cardio")
+            self.assertEqual(search['workouts'], [])
+
+            # Name matches rank above matches on other fields
+            search = self.database.search_workouts("testing workout")
+            self.assertEqual(search['workouts'][0].name, self.test_workout.name)
+
+            # Without text every workout matches, paged by _id
+            search = self.database.search_workouts("", difficulty="hard", limit=1)
+            self.assertEqual(search['workouts'][0].difficulty, 'hard')
+            self.assertTrue(search['facets'] is None)
+            next_search = self.database.search_workouts("", difficulty="hard", limit=1,
+                                                        cursor=search['next_cursor'])
+            self.assertNotEqual(next_search['workouts'][0]._id, search['workouts'][0]._id)
+            self.assertTrue(next_search['facets'] is None)
+
+            with self.assertRaises(InvalidCursor):
+                self.database.search_workouts("searchable", cursor="notacursor")
+        finally:
+            self.database.mongo.workout.delete_many({'about': 'squats for legs'})
+
+    def test_cursor(self):
+        cursor = encode_cursor([1.5, '123456789012345678901234'])
+        self.assertEqual(decode_cursor(cursor), [1.5, '123456789012345678901234'])
+        with self.assertRaises(InvalidCursor):
+            decode_cursor('%%%')
+
+        # Valid JSON that encode_cursor never writes is refused too
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(base64.urlsafe_b64encode(b'{"a": 1}').decode())
+        with self.assertRaises(InvalidCursor):
+            self.database.get_workout_page_by_creatorid(
+                '123456789012345678901234', cursor=base64.urlsafe_b64encode(b'{}').decode())
+
     def test_get_all_workouts_by_creatorid(self):
 
         # Checking if workout total is equal to 1
@@ -967,6 +1268,40 @@ class TestDatabase(unittest.TestCase):
         workouts = self.database.get_all_workouts_by_creatorid(trainee._id)
         assert len(workouts) == 2
 
+    def test_get_workout_page_by_creatorid(self):
+        trainee = self.database.get_trainee_by_username(
+            self.test_trainee.username)
+        for number in range(2):
+            self.database.add_workout(Workout(
+                _id=None,
+                creator_id=trainee._id,
+                name="pagedworkout{}".format(number),
+                difficulty="novice",
+                about="something something else"
+            ))
+
+        try:
+            self._check_workout_pages(trainee)
+        finally:
+            self.database.mongo.workout.delete_many({'name': {'$regex': '^pagedworkout'}})
+
+    def _check_workout_pages(self, trainee):
+        workouts, next_cursor = self.database.get_workout_page_by_creatorid(trainee._id, limit=2)
+        self.assertEqual(len(workouts), 2)
+        self.assertTrue(next_cursor is not None)
+
+        next_workouts, next_cursor = self.database.get_workout_page_by_creatorid(
+            trainee._id, limit=2, cursor=next_cursor)
+        self.assertEqual(len(next_workouts), 1)
+        self.assertTrue(next_cursor is None)
+        self.assertEqual(len({workout._id for workout in workouts + next_workouts}), 3)
+
+        # The iterator streams the same workouts
+        self.assertEqual(len(list(self.database.iter_workouts_by_creatorid(trainee._id))), 3)
+
+        with self.assertRaises(InvalidCursor):
+            self.database.get_workout_page_by_creatorid(trainee._id, cursor="notacursor")
+
     def test_set_workout_status(self):
         trainee = self.database.get_trainee_by_username(
             self.test_trainee.username)
@@ -987,6 +1322,22 @@ class TestDatabase(unittest.TestCase):
         assert workout is not None
         assert workout['is_complete'] is True
 
+    def test_complete_workout(self):
+        trainee = self.database.get_trainee_by_username(
+            self.test_trainee.username)
+
+        workout = self.database.complete_workout(trainee._id, "testing", 'trainee', 15,
+                                                 "30 minutes", "12", "3", "strength")
+        self.assertEqual(workout.is_complete, True)
+        self.assertEqual((workout.total_time, workout.reps, workout.miles, workout.category),
+                         ("30 minutes", "12", "3", "strength"))
+        self.assertEqual(self.database.get_trainee_by_id(trainee._id).exp, trainee.exp + 15)
+
+        # Experience is still added when the user has no workout of that name
+        self.assertTrue(self.database.complete_workout(trainee._id, "notaworkout", 'trainee', 15,
+                                                       "30 minutes", "12", "3", "strength") is None)
+        self.assertEqual(self.database.get_trainee_by_id(trainee._id).exp, trainee.exp + 30)
+
     def test_set_workout_total_time(self):
         trainee = self.database.get_trainee_by_username(
             self.test_trainee.username)
@@ -1337,6 +1688,75 @@ class TestDatabase(unittest.TestCase):
         finally:
             clean_up(trainee, trainer)
 
+    def test_list_user_invitations(self):
+        trainee = self.database.get_trainee_by_username('testtrainee')
+        trainer = self.database.get_trainer_by_username('testtrainer')
+        try:
+            sent_id = self.database.create_invitation(trainee._id, trainer._id)
+            recieved_id = self.database.create_invitation(trainer._id, trainee._id)
+            missing_sender_id = str(self.database.mongo.invitation.insert_one({
+                'sender': ObjectId("123456789012345678901234"),
+                'recipient': ObjectId(trainee._id)
+            }).inserted_id)
+
+            all_sent, all_recieved = self.database.list_user_invitations(trainee._id)
+            self.assertEqual([invitation['_id'] for invitation in all_sent], [sent_id])
+            self.assertEqual(all_sent[0]['user'].as_dict(), {
+                '_id': trainer._id, 'username': trainer.username, 'name': trainer.name, 'role': 'trainer'
+            })
+            self.assertEqual([invitation['_id'] for invitation in all_recieved],
+                             [recieved_id, missing_sender_id])
+            self.assertEqual(all_recieved[0]['user'].username, trainer.username)
+            self.assertTrue(all_recieved[1]['user'] is None)
+
+            # Each direction is paged on its own
+            all_sent, all_recieved, next_sent_cursor, next_recieved_cursor = \
+                self.database.list_user_invitations_page(trainee._id, limit=1)
+            self.assertEqual(len(all_recieved), 1)
+            self.assertTrue(next_sent_cursor is None)
+            all_sent, all_recieved, next_sent_cursor, next_recieved_cursor = \
+                self.database.list_user_invitations_page(trainee._id, limit=1,
+                                                         recieved_cursor=next_recieved_cursor)
+            self.assertEqual([invitation['_id'] for invitation in all_recieved], [missing_sender_id])
+            self.assertTrue(next_recieved_cursor is None)
+        finally:
+            self.database.mongo.invitation.delete_many({'recipient': ObjectId(trainee._id)})
+            self.database.mongo.invitation.delete_many({'sender': ObjectId(trainee._id)})
+
+    def test_accept_invitations(self):
+        trainee = self.database.get_trainee_by_username('testtrainee')
+        trainer = self.database.get_trainer_by_username('testtrainer')
+        new_trainee = deepcopy(self.test_trainee)
+        new_trainee.username = "testtraineezz"
+        self.database.add_trainee(new_trainee)
+        new_trainee = self.database.get_trainee_by_username("testtraineezz")
+
+        try:
+            first_id = self.database.create_invitation(trainee._id, trainer._id)
+            self.database.create_invitation(new_trainee._id, trainer._id)
+            missing_sender_id = self.database.mongo.invitation.insert_one({
+                'sender': ObjectId("123456789012345678901234"),
+                'recipient': ObjectId(trainer._id)
+            }).inserted_id
+
+            # Invitations sent to someone else are skipped
+            self.assertEqual(self.database.accept_invitations([first_id], new_trainee._id), 0)
+            self.assertEqual(self.database.accept_invitations([], trainer._id), 0)
+
+            self.assertEqual(self.database.accept_invitations([first_id], trainer._id), 1)
+            self.assertEqual(self.database.get_trainer_by_id(trainer._id).trainees, [trainee._id])
+
+            # Invitations from removed users are only deleted
+            self.assertEqual(self.database.accept_all_invitations(trainer._id), 2)
+            self.assertEqual(self.database.get_trainer_by_id(trainer._id).trainees,
+                             [trainee._id, new_trainee._id])
+            self.assertEqual(self.database.get_trainee_by_id(new_trainee._id).trainers, [trainer._id])
+            self.assertTrue(self.database.mongo.invitation.find_one({'_id': missing_sender_id}) is None)
+            self.assertEqual(self.database.accept_all_invitations(trainer._id), 0)
+        finally:
+            self.database.mongo.invitation.delete_many({'recipient': ObjectId(trainer._id)})
+            self.database.mongo.trainee.delete_many({'username': 'testtraineezz'})
+
     def test_trainee_remove_trainer(self):
         """Tests to see if a trainee gets removed from a trainers list"""
 
@@ -1426,6 +1846,59 @@ class TestDatabase(unittest.TestCase):
         # checking if list is empty
         assert returned_list
 
+    def test_find_nearest_trainers(self):
+        trainer = self.database.get_trainer_by_username(self.test_trainer.username)
+        trainer.lng, trainer.lat = 12.345, 54.321
+        self.database.set_coords(trainer._id, trainer.lng, trainer.lat)
+
+        found_trainers = self.database.find_nearest_trainers(trainer.lng, trainer.lat,
+                                                             limit=1,
+                                                             max_distance=1000,
+                                                             fields=('username',))
+        self.assertEqual(len(found_trainers), 1)
+        self.assertEqual(found_trainers[0]['username'], trainer.username)
+        self.assertEqual(found_trainers[0]['_id'], trainer._id)
+        self.assertAlmostEqual(found_trainers[0]['distance'], 0)
+        self.assertNotIn('password', found_trainers[0])
+        self.assertNotIn('trainees', found_trainers[0])
+
+        # Nothing is found outside of the radius and the limit is capped
+        self.assertEqual(self.database.find_nearest_trainers(
+            trainer.lng + 90, trainer.lat, max_distance=1000), [])
+        self.assertEqual(self.database.find_nearest_trainers(
+            trainer.lng, trainer.lat, limit=0), [])
+        self.assertLessEqual(len(self.database.find_nearest_trainers(
+            trainer.lng, trainer.lat, limit=MAX_NEARBY_LIMIT + 1)), MAX_NEARBY_LIMIT)
+
+    def test_find_nearby_trainer_pins(self):
+        trainer = self.database.get_trainer_by_username(self.test_trainer.username)
+        self.database.set_coords(trainer._id, 12.345, 54.321)
+
+        pins = self.database.find_nearby_trainer_pins(12.345, 54.321, limit=1, max_distance=1000)
+        self.assertEqual(len(pins), 1)
+        self.assertTrue(isinstance(pins[0], MapPin))
+        self.assertEqual(pins[0].username, trainer.username)
+        self.assertEqual((pins[0].lng, pins[0].lat), (12.345, 54.321))
+
+    def test_get_user_summaries_by_ids(self):
+        trainee = self.database.get_trainee_by_username("testtrainee")
+        trainer = self.database.get_trainer_by_username("testtrainer")
+        missing_id = "123456789012345678901234"
+
+        self.assertEqual(self.database.get_user_summaries_by_ids([]), [])
+
+        summaries = self.database.get_user_summaries_by_ids([trainer._id, missing_id, trainee._id])
+        self.assertEqual([summary.as_dict() for summary in summaries], [
+            {'_id': trainer._id, 'username': trainer.username, 'name': trainer.name, 'role': 'trainer'},
+            {'_id': trainee._id, 'username': trainee.username, 'name': trainee.name, 'role': 'trainee'}
+        ])
+
+        # Only the collection of the role is searched
+        self.assertEqual(self.database.get_user_summaries_by_ids([trainer._id], 'trainee'), [])
+        self.assertEqual(self.database.get_user_summary_by_id(trainee._id, 'trainee').username,
+                         trainee.username)
+        self.assertTrue(self.database.get_user_summary_by_id(missing_id) is None)
+
     def test_create_event(self):
         """Tests the creation of an event within the database"""
         def clean_up(trainee, trainer):
@@ -1463,7 +1936,7 @@ class TestDatabase(unittest.TestCase):
 
             assert database_event['title'] == event.title
             assert str(database_event['creator_id']) == str(event.creator_id)
-            assert database_event['date'] == str(event.date)
+            assert database_event['date'] == event.date
             assert database_event['title'] == event.title
             assert database_event['description'] == event.description
             assert str(database_event['participant_id']
@@ -1488,7 +1961,7 @@ class TestDatabase(unittest.TestCase):
 
             assert database_event['title'] == event.title
             assert str(database_event['creator_id']) == str(event.creator_id)
-            assert database_event['date'] == str(event.date)
+            assert database_event['date'] == event.date
             assert database_event['title'] == event.title
             assert database_event['description'] == event.description
             assert str(database_event['participant_id']
@@ -1529,7 +2002,7 @@ class TestDatabase(unittest.TestCase):
             })
             assert database_event['title'] == event.title
             assert str(database_event['creator_id']) == str(event.creator_id)
-            assert database_event['date'] == str(event.date)
+            assert database_event['date'] == event.date
             assert database_event['title'] == event.title
             assert database_event['description'] == event.description
             assert str(database_event['participant_id']
@@ -1555,7 +2028,7 @@ class TestDatabase(unittest.TestCase):
             })
             assert database_event['title'] == event.title
             assert str(database_event['creator_id']) == str(event.creator_id)
-            assert database_event['date'] == str(event.date)
+            assert database_event['date'] == event.date
             assert database_event['title'] == event.title
             assert database_event['description'] == event.description
             assert str(database_event['participant_id']
@@ -1686,3 +2159,129 @@ class TestDatabase(unittest.TestCase):
 
         finally:
             clean_up(trainee, trainer)
+
+    def test_list_events_in_range(self):
+        trainee = self.database.get_trainee_by_username('testtrainee')
+        trainer = self.database.get_trainer_by_username('testtrainer')
+
+        try:
+            for day, creator, participant in ((2, trainee, trainer),
+                                              (1, trainee, trainer),
+                                              (3, trainer, trainee),
+                                              (30, trainee, trainer)):
+                self.database.create_event(Event(
+                    _id=None,
+                    creator_id=creator._id,
+                    title='rangeEvent{}'.format(day),
+                    date=datetime(2020, 12, day),
+                    description='a simple desc',
+                    participant_id=participant._id
+                ))
+
+            created_events, recieved_events = self.database.list_events_in_range(
+                trainee._id, datetime(2020, 12, 1), datetime(2020, 12, 8))
+            self.assertEqual([event.title for event in created_events],
+                             ['rangeEvent1', 'rangeEvent2'])
+            self.assertEqual([event.title for event in recieved_events], ['rangeEvent3'])
+            self.assertEqual(recieved_events[0].date, datetime(2020, 12, 3))
+
+            created_events, recieved_events = self.database.list_events_in_range(
+                trainer._id, datetime(2020, 12, 8), datetime(2021, 1, 1))
+            self.assertEqual(created_events, [])
+            self.assertEqual([event.title for event in recieved_events], ['rangeEvent30'])
+        finally:
+            self.database.mongo.event.delete_many({'title': {'$regex': '^rangeEvent'}})
+
+    def test_get_dashboard_stats(self):
+        trainee = self.database.get_trainee_by_username('testtrainee')
+        trainer = self.database.get_trainer_by_username('testtrainer')
+
+        self.assertEqual(self.database.get_dashboard_stats(trainer._id), {
+            'created_events': 0,
+            'recieved_events': 0,
+            'workouts': 0,
+            'completed_workouts': 0,
+            'sent_invitations': 0,
+            'recieved_invitations': 0
+        })
+
+        try:
+            for creator, participant in ((trainee, trainer), (trainee, trainer), (trainer, trainee)):
+                self.database.create_event(Event(
+                    _id=None,
+                    creator_id=creator._id,
+                    title='statsEvent',
+                    date=datetime(2020, 12, 2),
+                    description='a simple desc',
+                    participant_id=participant._id
+                ))
+            self.database.create_invitation(trainer._id, trainee._id)
+            self.database.set_workout_status(trainee._id, self.test_workout.name, True)
+
+            self.assertEqual(self.database.get_dashboard_stats(trainee._id), {
+                'created_events': 2,
+                'recieved_events': 1,
+                'workouts': 1,
+                'completed_workouts': 1,
+                'sent_invitations': 0,
+                'recieved_invitations': 1
+            })
+        finally:
+            self.database.mongo.event.delete_many({'title': 'statsEvent'})
+            self.database.mongo.invitation.delete_many({'sender': ObjectId(trainer._id)})
+
+    def test_remove_trainee_cascades(self):
+        trainee = self.database.get_trainee_by_username('testtrainee')
+        trainer = self.database.get_trainer_by_username('testtrainer')
+        other_trainer = deepcopy(self.test_trainer)
+        other_trainer.username = "testtrainerzz"
+        self.database.add_trainer(other_trainer)
+        other_trainer = self.database.get_trainer_by_username("testtrainerzz")
+
+        try:
+            self.database.trainee_add_trainer(trainee._id, trainer._id)
+            self.database.trainer_add_trainee(trainer._id, trainee._id)
+            self.database.create_invitation(trainee._id, other_trainer._id)
+            self.database.create_invitation(other_trainer._id, trainee._id)
+            self.database.create_event(Event(
+                _id=None,
+                creator_id=trainer._id,
+                title='cascadeEvent',
+                date=datetime(2020, 12, 2),
+                description='a simple desc',
+                participant_id=trainee._id
+            ))
+
+            self.database.remove_trainee(trainee._id)
+
+            self.assertTrue(self.database.get_trainee_by_id(trainee._id) is None)
+            self.assertEqual(self.database.get_trainer_by_id(trainer._id).trainees, [])
+            self.assertEqual(self.database.get_all_workouts_by_creatorid(trainee._id), [])
+            self.assertEqual(self.database.get_dashboard_stats(trainee._id)['recieved_events'], 0)
+            self.assertEqual(self.database.get_dashboard_stats(other_trainer._id), {
+                'created_events': 0,
+                'recieved_events': 0,
+                'workouts': 0,
+                'completed_workouts': 0,
+                'sent_invitations': 0,
+                'recieved_invitations': 0
+            })
+        finally:
+            self.database.mongo.trainer.delete_many({'username': 'testtrainerzz'})
+            self.database.mongo.event.delete_many({'title': 'cascadeEvent'})
+
+    def test_youtube_videos(self):
+        topic = 'testyoutubetopic'
+        videos = [{'videoId': 'abc', 'title': 'Abs', 'thumbnail': 'abc.jpg', 'channel': 'Channel'}]
+        fetched_at = datetime(2020, 3, 1, 12, 0)
+        try:
+            self.assertTrue(self.database.get_youtube_videos(topic) is None)
+
+            self.database.set_youtube_videos(topic, videos, fetched_at, datetime(2999, 1, 1))
+            self.database.set_youtube_videos(topic, videos, fetched_at, datetime(2999, 1, 1))
+            self.assertEqual(self.database.get_youtube_videos(topic), (videos, fetched_at))
+            self.assertEqual(self.database.mongo.youtube_cache.count_documents({'_id': topic}), 1)
+            self.assertIn('youtube_cache_expire_index',
+                          self.database.mongo.youtube_cache.index_information())
+        finally:
+            self.database.mongo.youtube_cache.delete_many({'_id': topic})
@@ -5,12 +5,12 @@ import pytest
 from flask import g, session, url_for
 from os import environ
 from vitality import create_app
-from vitality import database
 from vitality.database import Database, WorkoutCreatorIdNotFoundError, password_sha256, InvalidCharactersException
 from vitality.trainee import Trainee
 from vitality.trainer import Trainer
 from vitality.workout import Workout
 from vitality.event import Event
+from vitality.migrations import MIGRATION_DOCUMENT_ID, LATEST_VERSION, get_schema_version, migrate
 from vitality.settings import MONGO_URI, SECRET_KEY
 from datetime import datetime
 from dotenv import load_dotenv 
@@ -67,6 +67,7 @@ def client():
     app.config['TESTING'] = True
     app.secret_key = environ.get('SECRET_KEY')
     database = Database(MONGO_URI)
+    migrate(database)
 
     def setup():
         """ Code run after client has been used """
@@ -761,6 +762,7 @@ def test_trainer_overview(client):
                 "trainees": ObjectId(trainee._id)
             }
         })
+    g.database.forget_user(trainer._id)
 
     invitation = g.database.mongo.invitation.insert_one({
         'sender': ObjectId(trainee._id),
@@ -819,6 +821,7 @@ def test_list_trainees(client):
                 "trainees": ObjectId(trainee._id)
             }
         })
+    g.database.forget_user(trainer._id)
     # Trainer Overview as Trainer
     returned_value = client.get('/list_trainees',
                                 follow_redirects=True)
@@ -849,6 +852,7 @@ def test_trainee_overview(client):
                 "trainers": ObjectId(trainer._id)
             }
         })
+    g.database.forget_user(trainee._id)
 
     invitation = g.database.mongo.invitation.insert_one({
         'sender': ObjectId(trainer._id),
@@ -1068,6 +1072,7 @@ def test_list_trainers(client):
                 "trainers": ObjectId(trainer._id)
             }
         })
+    g.database.forget_user(trainee._id)
 
     returned_value = client.get('/list_trainers',
                                 follow_redirects=True)
@@ -1129,7 +1134,7 @@ def test_trainee_schedule(client):
 
         assert database_event is not None
 
-        returned_value = client.get('/schedule',
+        returned_value = client.get('/schedule?month=2020-03',
                                     follow_redirects=True)
         assert returned_value.status_code == 200
         assert type(g.user) == Trainee
@@ -1139,13 +1144,31 @@ def test_trainee_schedule(client):
         login_as_testTrainer(client)
 
         # Trainer Overview as Trainer
-        returned_value = client.get('/schedule',
+        returned_value = client.get('/schedule?month=2020-03',
                                     follow_redirects=True)
         assert returned_value.status_code == 200
         assert type(g.user) == Trainer
         assert bytes('{}'.format(event.title), 'utf-8') in returned_value.data
         assert bytes('{}'.format(event.date), 'utf-8') in returned_value.data
 
+        # Events outside of the month are not loaded
+        returned_value = client.get('/schedule?month=2020-04',
+                                    follow_redirects=True)
+        assert returned_value.status_code == 200
+        assert bytes('{}'.format(event.title), 'utf-8') not in returned_value.data
+
+        returned_value = client.get('/schedule?month=notamonth',
+                                    follow_redirects=True)
+        assert returned_value.status_code == 400
+
+        # The first and last representable months are rejected instead of overflowing
+        returned_value = client.get('/schedule?month=0001-01',
+                                    follow_redirects=True)
+        assert returned_value.status_code == 400
+        returned_value = client.get('/schedule?month=9999-12',
+                                    follow_redirects=True)
+        assert returned_value.status_code == 400
+
     finally:
         g.database.mongo.event.delete_many({
             'title': event.title,
@@ -1606,6 +1629,7 @@ def test_workout(client):
                 "exp": 0
             }
         })
+    g.database.forget_user(trainer._id)
     g.database.mongo.workout.update_one(
         {"_id": ObjectId(database_workout._id)},
         {
@@ -1645,6 +1669,7 @@ def test_workout(client):
                 "exp": 0
             }
         })
+    g.database.forget_user(trainer._id)
     g.database.mongo.workout.update_one(
         {"_id": ObjectId(database_workout._id)},
         {
@@ -1684,6 +1709,7 @@ def test_workout(client):
                 "exp": 0
             }
         })
+    g.database.forget_user(trainer._id)
     g.database.mongo.workout.update_one(
         {"_id": ObjectId(database_workout._id)},
         {
@@ -1723,6 +1749,7 @@ def test_workout(client):
                 "exp": 0
             }
         })
+    g.database.forget_user(trainer._id)
     g.database.mongo.workout.update_one(
         {"_id": ObjectId(database_workout._id)},
         {
@@ -1759,6 +1786,7 @@ def test_workout(client):
                 "exp": 0
             }
         })
+    g.database.forget_user(trainee._id)
     g.database.mongo.workout.update_one(
         {"_id": ObjectId(database_workout._id)},
         {
@@ -1935,6 +1963,7 @@ def test_remove_added_user(client):
                 "trainers": ObjectId(trainer._id)
             }
         })
+    g.database.forget_user(trainee._id)
 
     assert ObjectId(trainer._id) in g.database.mongo.trainee.find_one({
         '_id': ObjectId(trainee._id)
@@ -1958,6 +1987,7 @@ def test_remove_added_user(client):
                 "trainees": ObjectId(trainee._id)
             }
         })
+    g.database.forget_user(trainer._id)
 
     assert ObjectId(trainee._id) in g.database.mongo.trainer.find_one({
         '_id': ObjectId(trainer._id)
@@ -2063,3 +2093,98 @@ def test_accept_invitation(client):
             'sender': ObjectId(trainer._id),
             'recipient': ObjectId(trainee._id)
         })
+
+
+def test_accept_invitations(client):
+    returned_value = client.post('/accept_invitations',
+                                 data={'confirmation': 'true', 'all': 'true'},
+                                 follow_redirects=True)
+    assert returned_value.status_code == 200
+    assert b'login' in returned_value.data
+    assert g.user is None
+
+    login_as_testTrainee(client)
+
+    try:
+        trainee = g.database.get_trainee_by_username('testtrainee')
+        trainer = g.database.get_trainer_by_username('testtrainer')
+        invitation = g.database.mongo.invitation.insert_one({
+            'sender': ObjectId(trainer._id),
+            'recipient': ObjectId(trainee._id)
+        })
+
+        returned_value = client.post('/accept_invitations',
+                                     data={'all': 'true'},
+                                     follow_redirects=True)
+        assert returned_value.status_code == 400
+
+        returned_value = client.post('/accept_invitations',
+                                     data={
+                                         'confirmation': 'true',
+                                         'invitation_ids': ['notanid']
+                                     },
+                                     follow_redirects=True)
+        assert returned_value.status_code == 400
+
+        returned_value = client.post('/accept_invitations',
+                                     data={
+                                         'confirmation': 'true',
+                                         'invitation_ids': [str(invitation.inserted_id)]
+                                     },
+                                     follow_redirects=True)
+        assert returned_value.status_code == 200
+        assert g.database.mongo.invitation.find_one({
+            '_id': invitation.inserted_id
+        }) is None
+        assert ObjectId(trainer._id) in g.database.mongo.trainee.find_one({
+            '_id': ObjectId(trainee._id)
+        })['trainers']
+
+    finally:
+        g.database.mongo.invitation.delete_many({
+            'sender': ObjectId(trainer._id),
+            'recipient': ObjectId(trainee._id)
+        })
+
+
+def test_migrate_command(client):
+    runner = client.application.test_cli_runner()
+    database = Database(MONGO_URI)
+
+    # --check only reports the migrations the app factory left pending
+    database.mongo.migration.update_one({'_id': MIGRATION_DOCUMENT_ID},
+                                        {'$set': {'version': LATEST_VERSION - 1}})
+    returned_value = runner.invoke(args=['migrate', '--check'])
+    assert returned_value.exit_code == 0
+    assert 'Schema version {} of {}'.format(LATEST_VERSION - 1, LATEST_VERSION) in returned_value.output
+    assert 'Pending {}'.format(LATEST_VERSION) in returned_value.output
+    assert get_schema_version(database) == LATEST_VERSION - 1
+
+    returned_value = runner.invoke(args=['migrate'])
+    assert returned_value.exit_code == 0
+    assert 'Applied {}'.format(LATEST_VERSION) in returned_value.output
+
+    returned_value = runner.invoke(args=['migrate', '--check'])
+    assert returned_value.exit_code == 0
+    assert 'Pending' not in returned_value.output
+
+
+def test_autocomplete_users(client):
+    returned_value = client.get('/autocomplete/trainer?q=test',
+                                follow_redirects=True)
+    assert returned_value.status_code == 200
+    assert g.user is None
+    assert b'login' in returned_value.data
+
+    login_as_testTrainee(client)
+
+    returned_value = client.get('/autocomplete/trainer?q=testtrain')
+    assert returned_value.status_code == 200
+    assert 'testtrainer' in [user['username'] for user in returned_value.get_json()]
+
+    returned_value = client.get('/autocomplete/trainee?q=testtrain')
+    assert returned_value.status_code == 200
+    assert 'testtrainee' in [user['username'] for user in returned_value.get_json()]
+
+    returned_value = client.get('/autocomplete/admin?q=test')
+    assert returned_value.status_code == 404
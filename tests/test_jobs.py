@@ -0,0 +1,146 @@
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from time import sleep
+from vitality.database import Database
+from vitality.jobs import (
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_PENDING,
+    JOB_RUNNING,
+    MAX_JOB_BACKOFF_SECONDS,
+    JobRunner,
+    UnknownJobError,
+    job_backoff,
+    schedule_youtube_prefetch)
+from vitality.migrations import migrate
+from vitality.settings import MONGO_URI
+import unittest
+
+
+class TestJobs(unittest.TestCase):
+
+    database = Database(MONGO_URI)
+
+    @classmethod
+    def setUpClass(cls):
+        migrate(cls.database)
+
+    def setUp(self):
+        self.tearDown()
+        self.calls = []
+        self.runner = JobRunner(workers=2, poll_interval=0.05, max_attempts=2)
+
+        @self.runner.task('record')
+        def record(database, value):
+            self.calls.append(value)
+
+        @self.runner.task('explode')
+        def explode(database):
+            raise RuntimeError('boom')
+
+    def tearDown(self):
+        self.database.mongo.job.delete_many({'name': {'$in': ['record', 'explode']}})
+        self.database.mongo.job.delete_many({'name': 'prefetch_youtube_topics', 'status': JOB_PENDING})
+
+    def test_job_backoff(self):
+        self.assertEqual(job_backoff(1), 2)
+        self.assertEqual(job_backoff(3), 8)
+        self.assertEqual(job_backoff(100), MAX_JOB_BACKOFF_SECONDS)
+
+    def test_enqueue(self):
+        with self.assertRaises(UnknownJobError):
+            self.runner.enqueue(self.database, 'missing')
+
+        # Jobs with the same key are stored once
+        job_id = self.runner.enqueue(self.database, 'record', key='record:1', value=1)
+        self.assertEqual(self.runner.enqueue(self.database, 'record', key='record:1', value=2), job_id)
+        self.assertEqual(self.database.mongo.job.count_documents({'name': 'record'}), 1)
+
+        # Delayed jobs are not due yet
+        self.runner.enqueue(self.database, 'record', delay=60, value=3)
+        self.assertEqual(self.runner.run_pending(self.database), 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(self.database.mongo.job.find_one({'key': 'record:1'})['status'], JOB_DONE)
+
+    def test_retry(self):
+        job_id = self.runner.enqueue(self.database, 'explode')
+
+        self.assertEqual(self.runner.run_pending(self.database), 1)
+        job = self.database.mongo.job.find_one({'name': 'explode'})
+        self.assertEqual((job['status'], job['attempts']), (JOB_PENDING, 1))
+        self.assertGreater(job['run_at'], datetime.utcnow())
+        self.assertIn('boom', job['last_error'])
+
+        # The last attempt marks the job as failed
+        self.database.mongo.job.update_one({'name': 'explode'},
+                                           {'$set': {'run_at': datetime.utcnow()}})
+        self.assertEqual(self.runner.run_pending(self.database), 1)
+        job = self.database.mongo.job.find_one({'name': 'explode'})
+        self.assertEqual((job['status'], job['attempts']), (JOB_FAILED, 2))
+        self.assertEqual(str(job['_id']), job_id)
+
+    def test_expired_lease(self):
+        self.runner.enqueue(self.database, 'record', value=1)
+        job = self.runner.claim(self.database)
+        self.assertEqual(job['status'], JOB_RUNNING)
+        self.assertTrue(self.runner.claim(self.database) is None)
+
+        # A job left running by a dead worker is claimed again once its lease expires
+        self.database.mongo.job.update_one({'_id': job['_id']},
+                                           {'$set': {'locked_until': datetime.utcnow() - timedelta(seconds=1)}})
+        self.assertEqual(self.runner.run_pending(self.database), 1)
+        self.assertEqual(self.calls, [1])
+
+    def test_release(self):
+        self.runner.enqueue(self.database, 'record', value=1)
+        job = self.runner.claim(self.database)
+
+        # A claimed job that never ran is due again without losing an attempt
+        self.runner.release(self.database, job)
+        job = self.database.mongo.job.find_one({'_id': job['_id']})
+        self.assertEqual((job['status'], job['attempts']), (JOB_PENDING, 0))
+        self.assertNotIn('locked_until', job)
+        self.assertEqual(self.runner.run_pending(self.database), 1)
+        self.assertEqual(self.calls, [1])
+
+    def test_dispatch_after_shutdown(self):
+        self.runner.start(lambda: self.database)
+        self.runner._executor.shutdown(wait=True)
+        try:
+            self.runner.enqueue(self.database, 'record', value=1)
+            self.runner._dispatcher.join(5)
+
+            # The dispatcher stops and hands the job back instead of leaving it leased
+            self.assertFalse(self.runner._dispatcher.is_alive())
+            job = self.database.mongo.job.find_one({'name': 'record'})
+            self.assertEqual(job['status'], JOB_PENDING)
+            self.assertNotIn('locked_until', job)
+        finally:
+            self.runner.stop()
+
+    def test_start_stop(self):
+        self.runner.start(lambda: self.database)
+        try:
+            for value in range(5):
+                self.runner.enqueue(self.database, 'record', value=value)
+
+            for _ in range(100):
+                if len(self.calls) == 5:
+                    break
+                sleep(0.05)
+        finally:
+            self.runner.stop()
+
+        self.assertEqual(sorted(self.calls), [0, 1, 2, 3, 4])
+        self.assertEqual(self.database.mongo.job.count_documents({'name': 'record', 'status': JOB_DONE}), 5)
+
+    def test_schedule_youtube_prefetch(self):
+        # Every process schedules the same prefetch job for an interval
+        job_id = schedule_youtube_prefetch(self.database)
+        self.assertEqual(schedule_youtube_prefetch(self.database), job_id)
+
+        next_id = schedule_youtube_prefetch(self.database, next_interval=True)
+        self.assertNotEqual(next_id, job_id)
+        job = self.database.mongo.job.find_one({'_id': ObjectId(next_id)})
+        self.assertGreater(job['run_at'], datetime.utcnow())
+        self.assertEqual(job['name'], 'prefetch_youtube_topics')
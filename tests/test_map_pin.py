@@ -0,0 +1,26 @@
+from vitality.map_pin import MapPin
+
+
+def test_map_pin_creation():
+
+    pin = MapPin("123456789012345678901234", "testtrainer", 5.0, 6.0, 120.5)
+
+    assert pin._id == "123456789012345678901234"
+    assert pin.username == "testtrainer"
+    assert pin.lng == 5.0
+    assert pin.lat == 6.0
+    assert pin.distance == 120.5
+    assert pin.as_dict() == {
+        '_id': "123456789012345678901234",
+        'username': "testtrainer",
+        'lng': 5.0,
+        'lat': 6.0,
+        'distance': 120.5
+    }
+
+
+def test_map_pin_repr():
+
+    pin = MapPin("123456789012345678901234", "testtrainer", 5.0, 6.0)
+
+    assert repr(pin) == 'MapPin(123456789012345678901234, testtrainer, 5.0, 6.0, None)'
@@ -0,0 +1,26 @@
+from vitality.user_summary import UserSummary
+
+
+def test_user_summary_creation():
+
+    summary = UserSummary("123456789012345678901234", "testtrainee", "Test", "trainee")
+
+    assert summary._id == "123456789012345678901234"
+    assert summary.username == "testtrainee"
+    assert summary.name == "Test"
+    assert summary.role == "trainee"
+    assert summary.as_dict() == {
+        '_id': "123456789012345678901234",
+        'username': "testtrainee",
+        'name': "Test",
+        'role': "trainee"
+    }
+
+
+def test_user_summary_repr():
+
+    summary = UserSummary("123456789012345678901234", "testtrainee")
+
+    # A missing name stays None instead of becoming the string 'None'
+    assert summary.name is None
+    assert repr(summary) == 'UserSummary(123456789012345678901234, testtrainee, None, None)'
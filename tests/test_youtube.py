@@ -3,7 +3,12 @@ from os import environ, getenv
 from os.path import exists
 from vitality.settings import GOOGLE_MAPS_KEY
 from dotenv import load_dotenv 
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
 from time import sleep
+import json
 import pytest 
 
 @pytest.mark.skip
@@ -31,4 +36,381 @@ def test_fallback_dicts():
     assert 'etag' in DEFAULT_YOUTUBE_DIET_SEARCH
     assert 'nextPageToken' in DEFAULT_YOUTUBE_DIET_SEARCH
     assert 'regionCode' in DEFAULT_YOUTUBE_DIET_SEARCH
-    assert 'pageInfo' in DEFAULT_YOUTUBE_DIET_SEARCH
\ No newline at end of file
+    assert 'pageInfo' in DEFAULT_YOUTUBE_DIET_SEARCH
+
+
+def search_result(*video_ids):
+    return {'items': [{'id': {'kind': 'youtube#video', 'videoId': video_id},
+                       'snippet': {'title': video_id.title(),
+                                   'channelTitle': 'Channel',
+                                   'thumbnails': {'high': {'url': video_id + '.jpg'}}}}
+                      for video_id in video_ids]}
+
+
+def video(video_id):
+    return {'videoId': video_id, 'title': video_id.title(),
+            'thumbnail': video_id + '.jpg', 'channel': 'Channel'}
+
+
+class FakeYoutube:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def search_topic(self, topic: str):
+        self.calls.append(topic)
+        if self.fail:
+            raise YoutubeRequestFailed('Status == 403')
+        return search_result('{}{}'.format(topic.lower(), len(self.calls)))
+
+
+class FakeDatabase:
+
+    def __init__(self):
+        self.videos = {}
+
+    def get_youtube_videos(self, topic: str):
+        return self.videos.get(topic)
+
+    def set_youtube_videos(self, topic, videos, fetched_at, expire_at):
+        self.videos[topic] = (videos, fetched_at)
+
+
+def test_trim_search_result():
+    assert trim_search_result(search_result('abs')) == [video('abs')]
+    assert trim_search_result({}) == []
+
+    # Channels have no videoId and are skipped
+    channel = {'items': [{'id': {'kind': 'youtube#channel', 'channelId': 'UC'}, 'snippet': {}}]}
+    assert trim_search_result(channel) == []
+
+    assert len(DEFAULT_WORKOUT_VIDEOS) == 6
+    assert set(DEFAULT_DIET_VIDEOS[0]) == {'videoId', 'title', 'thumbnail', 'channel'}
+
+
+def test_cached_search_topic():
+    client = FakeYoutube()
+    cache = CachedYoutube(client, maxsize=2, ttl=60)
+    assert cache.search_topic('Abs') == [video('abs1')]
+    assert cache.search_topic('Abs') == [video('abs1')]
+    assert client.calls == ['Abs']
+    assert cache.stats()['fresh_hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+    # The least recently used topic is evicted past maxsize
+    cache.search_topic('Legs')
+    cache.search_topic('Full Body')
+    cache.search_topic('Abs')
+    assert client.calls == ['Abs', 'Legs', 'Full Body', 'Abs']
+    assert cache.stats()['evictions'] == 2
+
+
+def test_cached_search_topic_stale():
+    client = FakeYoutube()
+    cache = CachedYoutube(client, ttl=0.01, stale_seconds=60)
+    cache.search_topic('Abs')
+    sleep(0.02)
+
+    # The stale result is served while a background refresh replaces it
+    assert cache.search_topic('Abs') == [video('abs1')]
+    for _ in range(100):
+        if cache.stats()['refreshes'] == 1:
+            break
+        sleep(0.01)
+    assert cache.stats()['refreshes'] == 1
+    assert cache.stats()['stale_hits'] == 1
+    assert cache.entries.get('Abs')[1] == [video('abs2')]
+
+    # A failed refresh keeps the stale result
+    client.fail = True
+    sleep(0.02)
+    assert cache.search_topic('Abs') == [video('abs2')]
+    for _ in range(100):
+        if cache.stats()['refresh_failures'] == 1:
+            break
+        sleep(0.01)
+    assert cache.stats()['refresh_failures'] == 1
+    assert cache.entries.get('Abs')[1] == [video('abs2')]
+
+
+def test_cached_search_topic_failure():
+    client = FakeYoutube(fail=True)
+    cache = CachedYoutube(client, ttl=60, error_ttl=0.05)
+    for _ in range(3):
+        with pytest.raises(YoutubeRequestFailed):
+            cache.search_topic('Abs')
+    assert client.calls == ['Abs']
+    assert cache.stats()['negative_hits'] == 2
+
+    # The failure is retried once error_ttl has passed
+    client.fail = False
+    sleep(0.06)
+    assert cache.search_topic('Abs') == [video('abs2')]
+
+
+def test_cached_search_topic_shared():
+    database = FakeDatabase()
+    client = FakeYoutube()
+    cache = CachedYoutube(client, ttl=60, database_factory=lambda: database)
+    assert cache.search_topic('Abs') == [video('abs1')]
+    assert database.videos['Abs'][0] == [video('abs1')]
+
+    # A new process reads the shared result instead of calling the API
+    restarted = CachedYoutube(client, ttl=60, database_factory=lambda: database)
+    assert restarted.search_topic('Abs') == [video('abs1')]
+    assert restarted.search_topic('Abs') == [video('abs1')]
+    assert client.calls == ['Abs']
+    assert restarted.stats()['shared_hits'] == 1
+    assert restarted.stats()['fresh_hits'] == 1
+
+    # Results older than the stale window are fetched again
+    database.videos['Abs'] = ([video('old')], datetime.utcnow() - timedelta(seconds=120))
+    expired = CachedYoutube(client, ttl=30, stale_seconds=30, database_factory=lambda: database)
+    assert expired.search_topic('Abs') == [video('abs2')]
+
+
+class StubYoutubeHandler(BaseHTTPRequestHandler):
+    """Answers with the next (status, delay[, body]) of the server's responses, 200 once they run out."""
+
+    def do_GET(self):
+        self.server.requests.append(parse_qs(urlparse(self.path).query))
+        status, delay, *result = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        sleep(delay)
+        body = json.dumps(result[0] if result else search_result('stub')).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client timed out and closed the connection
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubYoutubeHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.responses = []
+    server.url = 'http://127.0.0.1:{}/youtube/v3/search'.format(server.server_port)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stub_youtube(server, retries=1, failure_threshold=2, reset_seconds=60, timeout=(1, 1)):
+    session = new_youtube_session(pool_size=2, retries=retries)
+    # Keep proxy settings of the environment away from the stub server
+    session.trust_env = False
+    return Youtube('testkey',
+                   session=session,
+                   timeout=timeout,
+                   breaker=CircuitBreaker(failure_threshold, reset_seconds),
+                   search_url=server.url)
+
+
+def test_search_topic_stub(stub_server):
+    youtube = stub_youtube(stub_server)
+    assert trim_search_result(youtube.search_topic('Abs')) == [video('stub')]
+    assert stub_server.requests[0]['q'] == ['Abs']
+    assert stub_server.requests[0]['key'] == ['testkey']
+
+
+def test_search_topic_retries(stub_server):
+    youtube = stub_youtube(stub_server, retries=1)
+
+    # One server error is retried
+    stub_server.responses = [(503, 0)]
+    assert trim_search_result(youtube.search_topic('Abs')) == [video('stub')]
+    assert len(stub_server.requests) == 2
+
+    # Retries are bounded, and quota errors are not retried
+    stub_server.responses = [(503, 0), (503, 0), (503, 0)]
+    with pytest.raises(YoutubeRequestFailed):
+        youtube.search_topic('Abs')
+    assert len(stub_server.requests) == 4
+
+    stub_server.responses = [(403, 0)]
+    with pytest.raises(YoutubeRequestFailed):
+        youtube.search_topic('Abs')
+    assert len(stub_server.requests) == 5
+
+
+def test_search_topic_timeout(stub_server):
+    youtube = stub_youtube(stub_server, timeout=(1, 0.1))
+    stub_server.responses = [(200, 0.5)]
+    with pytest.raises(YoutubeRequestFailed):
+        youtube.search_topic('Abs')
+    assert len(stub_server.requests) == 1
+
+
+def test_circuit_breaker(stub_server):
+    youtube = stub_youtube(stub_server, retries=0, failure_threshold=2, reset_seconds=0.1)
+    stub_server.responses = [(500, 0), (500, 0), (500, 0)]
+    for _ in range(2):
+        with pytest.raises(YoutubeRequestFailed):
+            youtube.search_topic('Abs')
+    assert youtube.breaker.state == 'open'
+
+    # An open circuit refuses calls without reaching the server
+    with pytest.raises(YoutubeCircuitOpen):
+        youtube.search_topic('Abs')
+    assert len(stub_server.requests) == 2
+
+    # A failed trial call reopens the circuit, a successful one closes it
+    sleep(0.15)
+    assert youtube.breaker.state == 'half-open'
+    with pytest.raises(YoutubeRequestFailed):
+        youtube.search_topic('Abs')
+    assert youtube.breaker.state == 'open'
+
+    sleep(0.15)
+    assert trim_search_result(youtube.search_topic('Abs')) == [video('stub')]
+    assert youtube.breaker.state == 'closed'
+    assert len(stub_server.requests) == 4
+
+
+def test_circuit_breaker_fallback(stub_server):
+    youtube = stub_youtube(stub_server, retries=0, failure_threshold=1)
+    stub_server.responses = [(500, 0)]
+    cache = CachedYoutube(youtube, ttl=60, error_ttl=0)
+    with pytest.raises(YoutubeRequestFailed):
+        cache.search_topic('Abs')
+
+    # Routes fall back to the default videos on YoutubeRequestFailed
+    with pytest.raises(YoutubeRequestFailed):
+        cache.search_topic('Legs')
+    assert youtube.breaker.state == 'open'
+    assert len(stub_server.requests) == 1
+
+
+def test_quota_error(stub_server):
+    youtube = stub_youtube(stub_server)
+    quota = {'error': {'code': 403, 'errors': [{'reason': 'quotaExceeded'}]}}
+    forbidden = {'error': {'code': 403, 'errors': [{'reason': 'forbidden'}]}}
+    stub_server.responses = [(403, 0, quota), (403, 0, forbidden)]
+    with pytest.raises(YoutubeQuotaExceeded):
+        youtube.search_topic('Abs')
+    with pytest.raises(YoutubeRequestFailed) as error:
+        youtube.search_topic('Abs')
+    assert not isinstance(error.value, YoutubeQuotaExceeded)
+
+
+def test_prefetch_interval():
+    assert prefetch_interval(9, seconds=3600, daily_quota=1000000) == 3600
+    # 9 searches of 100 units every 3600 seconds would spend 21600 units a day
+    assert prefetch_interval(9, seconds=3600, daily_quota=10000) == 7776
+    assert YOUTUBE_TOPICS == WORKOUT_TOPICS + DIET_TOPICS
+    assert len(YOUTUBE_TOPICS) == 9
+
+
+def test_prefetch():
+    database = FakeDatabase()
+    client = FakeYoutube()
+    cache = CachedYoutube(client, ttl=60, database_factory=lambda: database, read_only=True)
+
+    # Read only caches never call the API on a miss
+    with pytest.raises(YoutubeRequestFailed):
+        cache.search_topic('Abs')
+    assert client.calls == []
+
+    assert cache.prefetch(['Abs', 'Legs'], workers=2) == 2
+    assert sorted(client.calls) == ['Abs', 'Legs']
+    assert cache.search_topic('Abs') in ([video('abs1')], [video('abs2')])
+    assert cache.stats()['prefetches'] == 2
+
+    # Topics fresh in the shared cache are skipped
+    other = CachedYoutube(client, ttl=60, database_factory=lambda: database, read_only=True)
+    assert other.prefetch(['Abs', 'Legs', 'Full Body']) == 1
+    assert len(client.calls) == 3
+    assert other.search_topic('Full Body') == [video('full body3')]
+
+
+class QuotaYoutube(FakeYoutube):
+
+    def search_topic(self, topic: str):
+        self.calls.append(topic)
+        raise YoutubeQuotaExceeded('Status == 403')
+
+
+def test_prefetch_quota():
+    client = QuotaYoutube()
+    cache = CachedYoutube(client, ttl=60)
+
+    # The first quota error stops the remaining searches
+    assert cache.prefetch(['Abs', 'Legs', 'Full Body'], workers=1) == 0
+    assert client.calls == ['Abs']
+
+
+def test_read_only_stale():
+    database = FakeDatabase()
+    client = FakeYoutube()
+    cache = CachedYoutube(client, ttl=0.01, stale_seconds=60, error_ttl=60,
+                          database_factory=lambda: database, read_only=True)
+    database.videos['Abs'] = ([video('abs')], datetime.utcnow())
+    assert cache.search_topic('Abs') == [video('abs')]
+    sleep(0.02)
+
+    # A stale topic is reloaded from the shared cache, never from the API
+    database.videos['Abs'] = ([video('prefetched')], datetime.utcnow())
+    assert cache.search_topic('Abs') == [video('abs')]
+    for _ in range(100):
+        if cache.entries.get('Abs')[1] == [video('prefetched')]:
+            break
+        sleep(0.01)
+    assert cache.entries.get('Abs')[1] == [video('prefetched')]
+    assert client.calls == []
+
+
+def test_search_topics(stub_server):
+    youtube = stub_youtube(stub_server)
+    stub_server.responses = [(200, 0.3), (200, 0.3), (200, 0.3)]
+
+    # The topics are searched concurrently, duplicates once
+    started = datetime.utcnow()
+    results = youtube.search_topics(['Abs', 'Legs', 'Full Body', 'Abs'], concurrency=3)
+    assert (datetime.utcnow() - started).total_seconds() < 0.8
+    assert list(results) == ['Abs', 'Legs', 'Full Body']
+    assert all(trim_search_result(result) == [video('stub')] for result in results.values())
+    assert sorted(request['q'][0] for request in stub_server.requests) == ['Abs', 'Full Body', 'Legs']
+
+
+def test_search_topics_deadline(stub_server):
+    youtube = stub_youtube(stub_server, timeout=(1, 1))
+    stub_server.responses = [(200, 0.5)]
+    results = youtube.search_topics(['Abs'], concurrency=1, deadline=0.1)
+    assert isinstance(results['Abs'], YoutubeRequestFailed)
+    assert 'Deadline' in str(results['Abs'])
+
+
+def test_search_topics_quota():
+    client = QuotaYoutube()
+    results = search_topics(client, ['Abs', 'Legs'], concurrency=1)
+    assert client.calls == ['Abs']
+    assert all(isinstance(result, YoutubeQuotaExceeded) for result in results.values())
+
+
+def test_cached_search_topics():
+    client = FakeYoutube()
+    cache = CachedYoutube(client, ttl=60)
+    cache.search_topic('Abs')
+
+    results = cache.search_topics(['Abs', 'Legs'])
+    assert results == {'Abs': [video('abs1')], 'Legs': [video('legs2')]}
+    assert client.calls == ['Abs', 'Legs']
+    assert cache.stats()['fresh_hits'] == 1
+
+    client.fail = True
+    results = cache.search_topics(['Legs', 'Full Body'])
+    assert results['Legs'] == [video('legs2')]
+    assert isinstance(results['Full Body'], YoutubeRequestFailed)
+
+    read_only = CachedYoutube(client, ttl=60, read_only=True)
+    assert isinstance(read_only.search_topics(['Abs'])['Abs'], YoutubeRequestFailed)
@@ -6,13 +6,22 @@ from .trainer import Trainer
 from .event import Event
 from .database import (
     Database, EventNotFound,
+    autocomplete,
+    user_cache,
     UsernameTakenError,
     WorkoutCreatorIdNotFoundError, WorkoutNotFound,
     password_sha256,
     InvalidCharactersException,
     UserNotFoundError,
     IncorrectRecipientID,
+    InvalidCursor,
     InvitationNotFound)
+from .jobs import jobs, schedule_youtube_prefetch, REMOVE_USER_REFERENCES_DELAY_SECONDS
+from .migrations import (
+    LATEST_VERSION,
+    get_schema_version,
+    list_pending_migrations,
+    migrate)
 from .workout import (
     Workout,
     DEFAULT_EASY_EXP,
@@ -22,6 +31,7 @@ from .workout import (
 from flask import (
     abort,
     Flask,
+    jsonify,
     render_template,
     url_for,
     redirect,
@@ -29,19 +39,27 @@ from flask import (
     session,
     g)
 from markupsafe import escape
+import click
 import re
 from .settings import (
     SECRET_KEY,
     MONGO_URI,
+    MONGO_MIGRATE_ON_STARTUP,
+    AUTOCOMPLETE_REFRESH_SECONDS,
+    NEARBY_TRAINERS_LIMIT,
+    NEARBY_TRAINERS_RADIUS,
+    YOUTUBE_PREFETCH_SECONDS,
     GOOGLE_MAPS_KEY,
     GOOGLE_YOUTUBE_KEY)
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from bson.errors import InvalidId
-from .youtube import (Youtube,
+from .youtube import (youtube_cache,
                       YoutubeRequestFailed,
-                      DEFAULT_YOUTUBE_DIET_SEARCH,
-                      DEFAULT_YOUTUBE_WORKOUT_SEARCH)
+                      DIET_TOPICS,
+                      WORKOUT_TOPICS,
+                      DEFAULT_DIET_VIDEOS,
+                      DEFAULT_WORKOUT_VIDEOS)
 import random
 
 DEFAULT_VITALITY_PASSWORD = "DefaultVitalityTrainerPassword"
@@ -104,12 +122,60 @@ def populate_database_defaults():
             default_database.add_workout(workout)
 
 
+def check_database_migrations(app):
+    """Applies or reports pending index migrations when the app starts."""
+    database = Database(MONGO_URI)
+    pending = list_pending_migrations(database)
+    if not pending:
+        return
+
+    if MONGO_MIGRATE_ON_STARTUP:
+        applied = migrate(database)
+        app.logger.info('Applied database migrations {}'.format(applied))
+    else:
+        app.logger.warning('Database has {} pending migrations, run "flask migrate".'.format(
+            len(pending)))
+
+
 def create_app():
     """Application factory for our flask web server"""
     app = Flask(__name__)
     app.secret_key = SECRET_KEY
 
+    check_database_migrations(app)
     populate_database_defaults()
+    autocomplete.build(Database(MONGO_URI))
+    youtube_cache.database_factory = lambda: Database(MONGO_URI)
+    if YOUTUBE_PREFETCH_SECONDS > 0:
+        # Only the prefetch job calls the Youtube API, requests read the cache
+        youtube_cache.read_only = True
+        schedule_youtube_prefetch(Database(MONGO_URI))
+
+    @app.cli.command('migrate')
+    @click.option('--check', is_flag=True, help='Only list pending migrations.')
+    def migrate_command(check):
+        """Applies pending database index migrations."""
+        database = Database(MONGO_URI)
+        click.echo('Schema version {} of {}'.format(
+            get_schema_version(database), LATEST_VERSION))
+
+        for version, description, _ in list_pending_migrations(database):
+            click.echo('Pending {}: {}'.format(version, description))
+
+        if not check:
+            for version in migrate(database):
+                click.echo('Applied {}'.format(version))
+
+    @app.cli.command('jobs')
+    @click.option('--stats', is_flag=True, help='Only count the jobs per status.')
+    def jobs_command(stats):
+        """Runs every due background job, then prints the queue counts."""
+        database = Database(MONGO_URI)
+        if not stats:
+            click.echo('Ran {} jobs'.format(jobs.run_pending(database)))
+
+        for status, count in jobs.stats(database).items():
+            click.echo('{}: {}'.format(status, count))
 
     # Input Validation
     alphaPattern = re.compile(r"^[a-zA-Z0-9\s]*$")
@@ -117,37 +183,38 @@ def create_app():
     stringPattern = re.compile(r"^[a-zA-Z]*$")
     lowerPattern = re.compile(r"^[a-z0-9\s]*$")
 
-    categories = [
-        'Low Carb Recipe',
-        'Paleo Carb Recipe',
-        'High Protein Recipe',
-        'Weight Watchers Recipe',
-        'Sugar Free Recipe',
-        'Vegan Recipe']
-
-    predefined_workout_topics = [
-        'Abs Workout Routine',
-        'Legs Workout Routine',
-        'Full Body Workout'
-    ]
+    categories = DIET_TOPICS
+
+    predefined_workout_topics = WORKOUT_TOPICS
 
     @app.before_request
     def before_request():
         """Actions to take before each request"""
+        # Database handles are cheap, they all share the worker's pooled MongoClient
         if 'database' not in g:
-            g.database = Database(MONGO_URI)
+            g.database = Database(MONGO_URI, identity_map=True, shared_cache=True)
+
+        autocomplete.start_refresher(lambda: Database(MONGO_URI),
+                                     AUTOCOMPLETE_REFRESH_SECONDS)
+        jobs.start(lambda: Database(MONGO_URI))
 
         g.google_maps_key = GOOGLE_MAPS_KEY
         g.GOOGLE_YOUTUBE_KEY = GOOGLE_YOUTUBE_KEY
 
         g.user = None
         if 'user_id' in session:
-            g.user = g.database.get_trainee_by_id(session['user_id'])
-            g.user_type = 'trainee' if g.user is not None else None
-
-            if g.user is None:
-                g.user = g.database.get_trainer_by_id(session['user_id'])
-                g.user_type = 'trainer' if g.user is not None else None
+            g.user = g.database.get_user_by_id(session['user_id'])
+            g.user_type = type(g.user).__name__.lower() if g.user is not None else None
+
+    @app.teardown_request
+    def teardown_request(error):
+        """Actions to take after each request"""
+        database = g.get('database')
+        if database is not None and database.identity_map is not None:
+            app.logger.debug('Identity map {}'.format(
+                database.identity_map.stats()))
+        app.logger.debug('User cache {}'.format(user_cache.stats()))
+        app.logger.debug('Youtube cache {}'.format(youtube_cache.stats()))
 
     @app.route('/', methods=["GET"])
     def home():
@@ -290,8 +357,7 @@ def create_app():
             return redirect(url_for('login'))
 
         username = escape(username)
-        user = g.database.get_trainer_by_username(username) \
-            or g.database.get_trainee_by_username(username)
+        user = g.database.get_user_by_username(username)
 
         return render_template("account/profile.html", user=user)
 
@@ -324,35 +390,24 @@ def create_app():
                 lat = float(escape(request.form['lat']))
                 lng = float(escape(request.form['lng']))
 
-                if g.database.get_trainee_by_id(g.user._id) is not None:
-                    if username:
-                        g.database.set_trainee_username(g.user._id, username)
-                    if password and re_password and password == re_password:
-                        g.database.set_trainee_password(g.user._id, password)
-                    if phone:
-                        g.database.set_trainee_phone(g.user._id, phone)
-                    if name:
-                        g.database.set_trainee_name(g.user._id, name)
-
-                    if lng and lat:
-                        g.database.set_coords(g.user._id, lng, lat)
-
-                    return redirect(url_for('usersettings'))
-
-                elif g.database.get_trainer_by_id(g.user._id) is not None:
-                    if username:
-                        g.database.set_trainer_username(g.user._id, username)
-                    if password and re_password and password == re_password:
-                        g.database.set_trainer_password(g.user._id, password)
-                    if phone:
-                        g.database.set_trainer_phone(g.user._id, phone)
-                    if name:
-                        g.database.set_trainer_name(g.user._id, name)
-
-                    if lng and lat:
-                        g.database.set_coords(g.user._id, lng, lat)
-
-                    return redirect(url_for('usersettings'))
+                fields = {}
+                if username:
+                    fields['username'] = username
+                if password and re_password and password == re_password:
+                    fields['password'] = password
+                if phone:
+                    fields['phone'] = phone
+                if name:
+                    fields['name'] = name
+                if lng and lat:
+                    fields['lng'] = lng
+                    fields['lat'] = lat
+
+                g.database.update_user_profile(g.user._id, g.user_type, **fields)
+                return redirect(url_for('usersettings'))
+
+            except UsernameTakenError:
+                return render_template("account/usersettings.html", username_taken=True), 400
 
             except InvalidCharactersException as e:
                 return render_template("account/usersettings.html", invalid_characters=True), 400
@@ -407,21 +462,25 @@ def create_app():
             if str(confirmation) != 'true':
                 return render_template("account/delete.html"), 500
 
-            if g.database.get_trainee_by_id(g.user._id) is not None:
-                app.logger.info('Deleting user ' + g.user.username)
-                g.database.remove_trainee(session['user_id'])
-                if 'user_id' in session:
-                    session.pop('user_id', None)
-                g.user = None
-                return redirect(url_for('home'))
+            # The account is removed now, its links, workouts, invitations and events by a job.
+            # The job is stored first so a crash after the removal can not orphan them
+            user_id = session['user_id']
+            jobs.enqueue(g.database, 'remove_user_references',
+                         key='remove_user_references:{}'.format(user_id),
+                         delay=REMOVE_USER_REFERENCES_DELAY_SECONDS,
+                         role=g.user_type,
+                         user_id=user_id)
 
-            elif g.database.get_trainer_by_id(g.user._id) is not None:
+            if type(g.user) is Trainee:
+                app.logger.info('Deleting user ' + g.user.username)
+                g.database.remove_trainee(user_id, cascade=False)
+            elif type(g.user) is Trainer:
                 app.logger.info('Deleting user ' + g.user.username)
-                g.database.remove_trainer(session['user_id'])
-                if 'user_id' in session:
-                    session.pop('user_id', None)
-                g.user = None
-                return redirect(url_for('home'))
+                g.database.remove_trainer(user_id, cascade=False)
+            if 'user_id' in session:
+                session.pop('user_id', None)
+            g.user = None
+            return redirect(url_for('home'))
 
         return render_template("account/delete.html")
 
@@ -451,32 +510,28 @@ def create_app():
             str(session['user_id'])))
 
         # Get all trainees
-        trainees = []
-        for trainee_id in g.user.trainees:
-            trainee = g.database.get_trainee_by_id(trainee_id)
-            if trainee is not None:
-                trainees.append(trainee)
+        trainees = g.database.get_user_summaries_by_ids(g.user.trainees, 'trainee')
 
         # Get all Invitations
-        sent_invitations, recieved_invitations = g.database.search_all_user_invitations(
+        # Only the first page of invitations and workouts is shown, the rest are counted
+        stats = g.database.get_dashboard_stats(g.user._id)
+        _, recieved_invitations, _, _ = g.database.list_user_invitations_page(
             g.user._id)
 
         invitations = []
         for invitation in recieved_invitations:
             invitations.append({
-                'sender': g.database.get_trainee_by_id(invitation['sender']),
-                'recipient': g.database.get_trainer_by_id(invitation['recipient'])
+                'sender': invitation['user'],
+                'recipient': g.user
             })
 
-        # Get all workouts
-        workouts = g.database.get_all_workouts_by_creatorid(g.user._id)
-        created_events, recieved_events = g.database.list_events_from_user_id(
-            g.user._id)
-        event_length_array = [len(created_events), len(recieved_events)]
+        workouts, _ = g.database.get_workout_page_by_creatorid(g.user._id)
+        event_length_array = [stats['created_events'], stats['recieved_events']]
         return render_template("user/overview.html",
                                trainees=trainees,
                                workouts=workouts,
                                invitations=invitations,
+                               stats=stats,
                                event_length_array=event_length_array)
 
     @app.route('/list_trainees', methods=["GET"])
@@ -492,11 +547,7 @@ def create_app():
 
         app.logger.debug('Trainer {} loaded Trainer List Trainees.'.format(
             str(session['user_id'])))
-        trainees = []
-        for trainee_id in g.user.trainees:
-            trainee = g.database.get_trainee_by_id(trainee_id)
-            if trainee is not None:
-                trainees.append(trainee)
+        trainees = g.database.get_user_summaries_by_ids(g.user.trainees, 'trainee')
         return render_template("user/list_added.html",
                                users=trainees)
 
@@ -513,32 +564,28 @@ def create_app():
 
         app.logger.debug('Trainee {} has loaded Trainee Overview.'.format(
             str(session['user_id'])))
-        trainers = []
-        for trainer_id in g.user.trainers:
-            trainer = g.database.get_trainer_by_id(trainer_id)
-            if trainer is not None:
-                trainers.append(trainer)
+        trainers = g.database.get_user_summaries_by_ids(g.user.trainers, 'trainer')
 
         # Get all Invitations
-        sent_invitations, recieved_invitations = g.database.search_all_user_invitations(
+        # Only the first page of invitations and workouts is shown, the rest are counted
+        stats = g.database.get_dashboard_stats(g.user._id)
+        _, recieved_invitations, _, _ = g.database.list_user_invitations_page(
             g.user._id)
 
         invitations = []
         for invitation in recieved_invitations:
             invitations.append({
-                'sender': g.database.get_trainer_by_id(invitation['sender']),
-                'recipient': g.database.get_trainee_by_id(invitation['recipient'])
+                'sender': invitation['user'],
+                'recipient': g.user
             })
 
-        # Get all workouts
-        workouts = g.database.get_all_workouts_by_creatorid(g.user._id)
-        created_events, recieved_events = g.database.list_events_from_user_id(
-            g.user._id)
-        event_length_array = [len(created_events), len(recieved_events)]
+        workouts, _ = g.database.get_workout_page_by_creatorid(g.user._id)
+        event_length_array = [stats['created_events'], stats['recieved_events']]
         return render_template("user/overview.html",
                                trainers=trainers,
                                workouts=workouts,
                                invitations=invitations,
+                               stats=stats,
                                event_length_array=event_length_array)
 
     @app.route('/list_trainers', methods=["GET"])
@@ -553,11 +600,7 @@ def create_app():
 
         app.logger.debug('Trainer {} loaded Trainer List Trainees.'.format(
             str(session['user_id'])))
-        trainers = []
-        for trainer_id in g.user.trainers:
-            trainer = g.database.get_trainer_by_id(trainer_id)
-            if trainer is not None:
-                trainers.append(trainer)
+        trainers = g.database.get_user_summaries_by_ids(g.user.trainers, 'trainer')
         return render_template("user/list_added.html",
                                users=trainers)
 
@@ -576,10 +619,16 @@ def create_app():
 
         if (request.method == "POST"):
             trainer_name = escape(request.form['trainer_name'])
-            found_trainers = g.database.list_trainers_by_search(trainer_name)
+            try:
+                found_trainers, next_cursor = g.database.list_trainers_page_by_search(
+                    trainer_name, cursor=request.form.get('cursor'))
+            except InvalidCursor:
+                abort(400)
             return render_template("trainee/trainer_search.html",
                                    trainers=found_trainers,
-                                   trainer_id_list=g.user.trainers)
+                                   trainer_id_list=g.user.trainers,
+                                   trainer_name=trainer_name,
+                                   next_cursor=next_cursor)
 
         return render_template("trainee/trainer_search.html")
 
@@ -595,14 +644,17 @@ def create_app():
 
         lat = float(g.user.lat)
         lng = float(g.user.lng)
-        trainers = g.database.find_trainers_near_user(lng, lat)
+        pins = g.database.find_nearby_trainer_pins(lng, lat,
+                                                   limit=NEARBY_TRAINERS_LIMIT,
+                                                   max_distance=NEARBY_TRAINERS_RADIUS)
         json_trainers = []
 
-        for trainer in trainers:
+        for pin in pins:
             json_trainer = {
-                'username': trainer.username,
-                'lng': trainer.lng,
-                'lat': trainer.lat
+                'username': pin.username,
+                'lng': pin.lng,
+                'lat': pin.lat,
+                'distance': round(pin.distance)
             }
             json_trainers.append(json_trainer)
 
@@ -623,13 +675,33 @@ def create_app():
 
         if (request.method == "POST"):
             trainee_name = escape(request.form['trainee_name'])
-            found_trainees = g.database.list_trainees_by_search(trainee_name)
+            try:
+                found_trainees, next_cursor = g.database.list_trainees_page_by_search(
+                    trainee_name, cursor=request.form.get('cursor'))
+            except InvalidCursor:
+                abort(400)
             return render_template("trainer/trainee_search.html",
                                    trainees=found_trainees,
-                                   trainee_id_list=g.user.trainees)
+                                   trainee_id_list=g.user.trainees,
+                                   trainee_name=trainee_name,
+                                   next_cursor=next_cursor)
 
         return render_template("trainer/trainee_search.html")
 
+    @app.route('/autocomplete/<role>', methods=["GET"])
+    def autocomplete_users(role: str):
+        """JSON username and name suggestions for the search pages, served from memory."""
+        if not g.user:
+            app.logger.debug('Redirecting user because there is no g.user.')
+            return redirect(url_for('login'))
+
+        if role not in ('trainer', 'trainee'):
+            abort(404)
+
+        prefix = str(escape(request.args.get('q', '')))
+        limit = min(request.args.get('limit', 10, type=int), 50)
+        return jsonify(autocomplete.search(role, prefix, limit))
+
     @app.route('/add_trainer', methods=["POST"])
     def add_trainer():
         """This route allows trainees to add trainers to their added list"""
@@ -718,20 +790,25 @@ def create_app():
             default_vitality_user._id)
 
         try:
-            youtube = Youtube(g.GOOGLE_YOUTUBE_KEY)
             workout_topic = random.choice(predefined_workout_topics)
-            list_of_workout_videos = youtube.search_topic(workout_topic)[
-                'items']
+            list_of_workout_videos = youtube_cache.search_topic(workout_topic)
         except YoutubeRequestFailed:
-            list_of_workout_videos = DEFAULT_YOUTUBE_DIET_SEARCH
+            list_of_workout_videos = DEFAULT_WORKOUT_VIDEOS
 
         if request.method == "POST":
-            name = escape(request.form["name"])
-            workouts = g.database.get_all_workout_by_attributes(
-                name={
-                    '$regex': r'(.+)?{}(.+)?'.format(name)
-                }
-            )
+            name = escape(request.form.get("name", ""))
+            difficulty = escape(request.form.get("difficulty", ""))
+            category = escape(request.form.get("category", ""))
+            cursor = request.form.get("cursor") or None
+
+            try:
+                search = g.database.search_workouts(name,
+                                                    difficulty=difficulty or None,
+                                                    category=category or None,
+                                                    cursor=cursor)
+            except InvalidCursor:
+                app.logger.debug('Workout search cursor was invalid.')
+                abort(400)
 
             return render_template("workout/search.html",
                                    default_workouts=default_workouts,
@@ -739,7 +816,12 @@ def create_app():
                                    default_hard_exp=DEFAULT_HARD_EXP,
                                    default_medium_exp=DEFAULT_MEDIUM_EXP,
                                    default_insane_exp=DEFAULT_INSANE_EXP,
-                                   workouts=workouts,
+                                   workouts=search['workouts'],
+                                   facets=search['facets'],
+                                   next_cursor=search['next_cursor'],
+                                   search_name=name,
+                                   search_difficulty=difficulty,
+                                   search_category=category,
                                    list_of_workout_videos=list_of_workout_videos)
 
         return render_template("workout/search.html",
@@ -791,19 +873,12 @@ def create_app():
             category = str(escape(request.form['category']))
             if completed != 'true':
                 abort(400)
-            app.logger.debug('heyyy')
-            if type(g.user) is Trainer:
-                g.database.add_trainer_experience(g.user._id, exp_value)
-            if type(g.user) is Trainee:
-                g.database.add_trainee_experience(g.user._id, exp_value)
-            g.database.set_workout_total_time(
-                g.user._id, workout_name, total_time)
-            g.database.set_workout_reps(g.user._id, workout_name, reps)
-            g.database.set_workout_miles(g.user._id, workout_name, miles)
-            g.database.set_workout_category(g.user._id, workout_name, category)
-            g.database.set_workout_status(g.user._id, workout_name, True)
-            workout_info = g.database.get_workout_by_attributes(name=workout_name,
-                                                                creator_id=creator_id)
+            completed_workout = g.database.complete_workout(g.user._id, workout_name,
+                                                            g.user_type, exp_value,
+                                                            total_time, reps, miles, category)
+            # Only the user's own workout of that name is updated
+            if completed_workout is not None and completed_workout.creator_id == creator_id:
+                workout_info = completed_workout
 
         return render_template("workout/workout.html", workout_info=workout_info, exp=exp_value)
 
@@ -821,10 +896,15 @@ def create_app():
         if not g.user:
             return redirect(url_for('login'))
 
-        workouts = g.database.get_all_workouts_by_creatorid(g.user._id)
+        try:
+            workouts, next_cursor = g.database.get_workout_page_by_creatorid(
+                g.user._id, cursor=request.args.get('cursor'))
+        except InvalidCursor:
+            abort(400)
 
         return render_template("workout/workoutlist.html",
-                               workouts=workouts)
+                               workouts=workouts,
+                               next_cursor=next_cursor)
 
     """Invitation System"""
     @app.route('/invitations', methods=["GET"])
@@ -834,12 +914,22 @@ def create_app():
             app.logger.debug('Redirecting user because there is no g.user.')
             return redirect(url_for('login'))
 
-        sent_invitations, recieved_invitaitons = g.database.search_all_user_invitations(
-            g.user._id)
+        sent_cursor = request.args.get('sent_cursor')
+        recieved_cursor = request.args.get('recieved_cursor')
+        try:
+            (sent_invitations, recieved_invitaitons,
+             next_sent_cursor, next_recieved_cursor) = g.database.list_user_invitations_page(
+                g.user._id, sent_cursor=sent_cursor, recieved_cursor=recieved_cursor)
+        except InvalidCursor:
+            abort(400)
 
         return render_template('user/list_invitations.html',
                                all_sent=sent_invitations,
-                               all_recieved=recieved_invitaitons)
+                               all_recieved=recieved_invitaitons,
+                               sent_cursor=sent_cursor,
+                               recieved_cursor=recieved_cursor,
+                               next_sent_cursor=next_sent_cursor,
+                               next_recieved_cursor=next_recieved_cursor)
 
     @app.route('/accept_invitation', methods=['POST'])
     def accept_invitation():
@@ -865,6 +955,30 @@ def create_app():
             app.logger.debug("User could not find invitation!")
             abort(500)
 
+    @app.route('/accept_invitations', methods=['POST'])
+    def accept_invitations():
+        """Accepts the checked recieved invitations, or all of them, in one batch."""
+        if not g.user:
+            app.logger.debug('Redirecting user because there is no g.user.')
+            return redirect(url_for('login'))
+
+        confirmation = escape(request.form.get('confirmation', ''))
+        if confirmation != 'true':
+            abort(400)
+
+        try:
+            if request.form.get('all') == 'true':
+                accepted = g.database.accept_all_invitations(g.user._id)
+            else:
+                invitation_ids = [str(escape(invitation_id)) for invitation_id in
+                                  request.form.getlist('invitation_ids')]
+                accepted = g.database.accept_invitations(invitation_ids, g.user._id)
+        except InvalidId:
+            abort(400)
+
+        app.logger.debug('User {} accepted {} invitations.'.format(g.user._id, accepted))
+        return redirect(url_for('invitations'))
+
     """Schedule"""
     @app.route('/schedule', methods=["GET"])
     def schedule():
@@ -876,11 +990,27 @@ def create_app():
         app.logger.debug('User {} loaded Schedule.'.format(
             str(session['user_id'])))
 
-        created_events, recieved_events = g.database.list_events_from_user_id(
-            g.user._id)
+        # Only one month of events is loaded, ?month=YYYY-MM picks which one
+        try:
+            if 'month' in request.args:
+                month = datetime.strptime(request.args['month'], '%Y-%m')
+            else:
+                month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            previous_month = (month - timedelta(days=1)).replace(day=1)
+            next_month = (month + timedelta(days=31)).replace(day=1)
+        except (ValueError, OverflowError):
+            # Months without a previous or next month (0001-01, 9999-12) can not be paged
+            app.logger.debug('Schedule month was invalid.')
+            abort(400)
+        created_events, recieved_events = g.database.list_events_in_range(
+            g.user._id, month, next_month)
+
         return render_template("user/schedule.html",
                                created_events=created_events,
-                               recieved_events=recieved_events)
+                               recieved_events=recieved_events,
+                               month=month,
+                               previous_month=previous_month.strftime('%Y-%m'),
+                               next_month=next_month.strftime('%Y-%m'))
 
     @app.route('/event/<creator_id>/<event_title>', methods=["GET"])
     def event(creator_id, event_title):
@@ -894,10 +1024,8 @@ def create_app():
             event_title = escape(event_title)
             event = g.database.get_event_by_attributes(title=event_title,
                                                        creator_id=creator_id)
-            creator = g.database.get_trainer_by_id(creator_id) or \
-                g.database.get_trainee_by_id(creator_id)
-            participant = g.database.get_trainer_by_id(event.participant_id) or \
-                g.database.get_trainee_by_id(event.participant_id)
+            creator = g.database.get_user_by_id(creator_id)
+            participant = g.database.get_user_by_id(event.participant_id)
 
             return render_template("user/event.html",
                                    event=event,
@@ -916,14 +1044,10 @@ def create_app():
 
         list_of_added = []
         if type(g.user) == Trainer:
-            for trainee_id in g.user.trainees:
-                trainee = g.database.get_trainee_by_id(trainee_id)
-                list_of_added.append(trainee)
+            list_of_added = g.database.get_user_summaries_by_ids(g.user.trainees, 'trainee')
 
         elif type(g.user) == Trainee:
-            for trainer_id in g.user.trainers:
-                trainer = g.database.get_trainer_by_id(trainer_id)
-                list_of_added.append(trainer)
+            list_of_added = g.database.get_user_summaries_by_ids(g.user.trainers, 'trainer')
 
         if request.method == 'POST':
             try:
@@ -976,14 +1100,11 @@ def create_app():
             abort(400)
 
         try:
-            youtube = Youtube(g.GOOGLE_YOUTUBE_KEY)
-            youtube_videos = youtube.search_topic(category)['items']
+            youtube_videos = youtube_cache.search_topic(category)
+        except YoutubeRequestFailed:
+            youtube_videos = DEFAULT_DIET_VIDEOS
         except Exception:
             youtube_videos = []
-        except AttributeError:
-            youtube_videos = []
-        except YoutubeRequestFailed:
-            youtube_videos = DEFAULT_YOUTUBE_DIET_SEARCH
 
         return render_template('diet/videos.html', youtube_videos=youtube_videos)
 
@@ -0,0 +1,174 @@
+from bisect import bisect_left, insort
+from threading import Lock, Thread, Event as ThreadEvent
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUTOCOMPLETE_LIMIT = 10
+
+
+class PrefixIndex:
+    """
+    In memory prefix index over the usernames and display names of one role.
+    Keys are kept in a sorted array so a prefix lookup is a bisect plus a short scan.
+    """
+
+    def __init__(self):
+        """Constructor for PrefixIndex class."""
+        self._keys = []
+        self._users = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _user_keys(user_id: str, username: str, name: str):
+        """Returns the (key, user_id) pairs indexed for a user."""
+        terms = {str(username).lower()}
+        if name and str(name) != 'None':
+            name = str(name).lower()
+            terms.add(name)
+            terms.update(name.split())
+        return [(term, user_id) for term in terms if term]
+
+    def load(self, users):
+        """Replaces the whole index with an iterable of (user_id, username, name) tuples."""
+        keys = []
+        users_by_id = {}
+        for user_id, username, name in users:
+            user_id = str(user_id)
+            users_by_id[user_id] = (str(username), name)
+            keys.extend(self._user_keys(user_id, username, name))
+        keys.sort()
+
+        with self._lock:
+            self._keys = keys
+            self._users = users_by_id
+
+    def add(self, user_id: str, username: str, name: str):
+        """Adds or replaces a user in the index."""
+        user_id = str(user_id)
+        with self._lock:
+            self._remove(user_id)
+            self._users[user_id] = (str(username), name)
+            for key in self._user_keys(user_id, username, name):
+                insort(self._keys, key)
+
+    def update(self, user_id: str, username: str = None, name: str = None):
+        """Updates the username and/or the name of a user already in the index."""
+        user_id = str(user_id)
+        with self._lock:
+            if user_id not in self._users:
+                return
+            old_username, old_name = self._users[user_id]
+
+        self.add(user_id,
+                 username if username is not None else old_username,
+                 name if name is not None else old_name)
+
+    def remove(self, user_id: str):
+        """Removes a user from the index."""
+        with self._lock:
+            self._remove(str(user_id))
+
+    def _remove(self, user_id: str):
+        if user_id not in self._users:
+            return
+        username, name = self._users.pop(user_id)
+        for key in self._user_keys(user_id, username, name):
+            position = bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+
+    def search(self, prefix: str, limit: int = DEFAULT_AUTOCOMPLETE_LIMIT):
+        """Returns up to limit {'_id', 'username', 'name'} dicts whose username or name starts with prefix."""
+        prefix = str(prefix).lower()
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        with self._lock:
+            position = bisect_left(self._keys, (prefix, ''))
+            while position < len(self._keys) and len(results) < limit:
+                key, user_id = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                if user_id not in seen:
+                    seen.add(user_id)
+                    username, name = self._users[user_id]
+                    results.append({
+                        '_id': user_id,
+                        'username': username,
+                        'name': name
+                    })
+                position += 1
+        return results
+
+    def __len__(self):
+        return len(self._users)
+
+
+class Autocomplete:
+    """
+    Per role prefix indexes of usernames and display names.
+    Built from the database on startup, kept current by the Database write methods
+    and rebuilt periodically to pick up writes made by other worker processes.
+    """
+
+    ROLES = ('trainee', 'trainer')
+
+    def __init__(self):
+        """Constructor for Autocomplete class."""
+        self.indexes = {role: PrefixIndex() for role in self.ROLES}
+        self._refresher = None
+        self._stop = ThreadEvent()
+
+    def build(self, database):
+        """Loads every user of every role with one projected streaming scan per collection."""
+        for role in self.ROLES:
+            self.indexes[role].load(database.iter_user_names(role))
+
+    def start_refresher(self, database_factory, interval: float):
+        """
+        Rebuilds the indexes every interval seconds on a daemon thread.
+        database_factory is called on every rebuild so the thread always uses
+        the Database of the current process. Does nothing if already running.
+        """
+        if interval <= 0 or (self._refresher is not None and self._refresher.is_alive()):
+            return
+
+        def refresh():
+            while not self._stop.wait(interval):
+                try:
+                    self.build(database_factory())
+                except Exception:
+                    logger.exception('Could not rebuild the autocomplete indexes')
+
+        self._stop.clear()
+        self._refresher = Thread(target=refresh, name='autocomplete-refresher', daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        """Stops the refresher thread."""
+        self._stop.set()
+
+    def reset_locks(self):
+        """
+        Renews the locks and forgets the refresher thread, which does not survive a fork.
+        The indexes built by the parent process are kept.
+        """
+        for index in self.indexes.values():
+            index._lock = Lock()
+        self._refresher = None
+        self._stop = ThreadEvent()
+
+    def add(self, role: str, user_id: str, username: str, name: str):
+        self.indexes[role].add(user_id, username, name)
+
+    def update(self, role: str, user_id: str, username: str = None, name: str = None):
+        self.indexes[role].update(user_id, username=username, name=name)
+
+    def remove(self, role: str, user_id: str):
+        self.indexes[role].remove(user_id)
+
+    def search(self, role: str, prefix: str, limit: int = DEFAULT_AUTOCOMPLETE_LIMIT):
+        return self.indexes[role].search(prefix, limit)
@@ -3,12 +3,32 @@ from .trainee import Trainee
 from .trainer import Trainer
 from .workout import Workout
 from .event import Event
+from .map_pin import MapPin
+from .user_summary import UserSummary
+from .autocomplete import Autocomplete
+from .cache import LRUCache
+from .settings import (
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_MAX_IDLE_TIME_MS,
+    MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS)
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from copy import deepcopy
 from datetime import datetime
 from markupsafe import escape
-from pymongo import MongoClient
+from pymongo import DeleteMany, DeleteOne, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from threading import Lock
+import base64
 import hashlib
-import re
+import json
+import os
 
 from vitality import workout
 
@@ -17,18 +37,297 @@ def password_sha256(password: str):
     return hashlib.sha256(escape(password).encode()).hexdigest()
 
 
+SEARCH_GRAM_SIZE = 3
+# Shorter terms match most users through their 1 and 2 character grams
+MIN_SEARCH_TERM_LENGTH = SEARCH_GRAM_SIZE
+DEFAULT_SEARCH_LIMIT = 20
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_NEARBY_LIMIT = 25
+MAX_NEARBY_LIMIT = 100
+DEFAULT_NEARBY_RADIUS = 50000
+NEARBY_TRAINER_FIELDS = ('username', 'name')
+USER_SUMMARY_PROJECTION = {'username': 1, 'name': 1}
+USER_ROLES = ('trainee', 'trainer')
+PROFILE_FIELDS = ('username', 'password', 'name', 'phone', 'lng', 'lat')
+
+
+def search_grams(text: str):
+    """
+    Returns every lowercase substring of text between 1 and SEARCH_GRAM_SIZE characters long.
+    Stored on user documents so substring searches can be served by a multikey index.
+    """
+    text = str(text).lower()
+    return sorted({text[start:start + size]
+                   for size in range(1, SEARCH_GRAM_SIZE + 1)
+                   for start in range(len(text) - size + 1)})
+
+
+def encode_cursor(values: list):
+    """Returns an opaque, url safe pagination cursor for the sort key values of the last item of a page."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Returns the sort key values stored in a cursor made by encode_cursor."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor).encode()).decode())
+    except ValueError:
+        raise InvalidCursor("Cursor could not be decoded.")
+    # Any JSON decodes, only the list encode_cursor writes can be unpacked by the pagers
+    if not isinstance(values, list):
+        raise InvalidCursor("Cursor could not be decoded.")
+    return values
+
+
+def search_query_grams(term: str):
+    """Returns the grams a user document must contain to match the search term."""
+    term = str(term).lower()
+    if len(term) <= SEARCH_GRAM_SIZE:
+        return [term]
+    return [term[start:start + SEARCH_GRAM_SIZE]
+            for start in range(len(term) - SEARCH_GRAM_SIZE + 1)]
+
+
+_mongo_clients = {}
+_mongo_clients_lock = Lock()
+
+
+"""
+Process wide cache of hydrated Trainee and Trainer classes keyed by user id.
+Every write made through a Database invalidates it, writes made by other
+worker processes are only picked up once the entry's ttl has passed.
+"""
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+"""Process wide username and display name prefix indexes, see vitality.autocomplete."""
+autocomplete = Autocomplete()
+
+
+def _reset_after_fork():
+    """
+    Forget the clients and cached users inherited from a parent process.
+    MongoClient is not fork-safe, so each worker process builds its own pool.
+    """
+    global _mongo_clients_lock
+    _mongo_clients.clear()
+    _mongo_clients_lock = Lock()
+    user_cache.reset()
+    autocomplete.reset_locks()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_mongo_client(uri: str):
+    """
+    Return the process wide MongoClient for the given uri.
+    The client (and its connection pool) is created once and shared across threads.
+    """
+    client = _mongo_clients.get(uri)
+    if client is not None:
+        return client
+
+    with _mongo_clients_lock:
+        client = _mongo_clients.get(uri)
+        if client is None:
+            client = MongoClient(
+                uri,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS)
+            _mongo_clients[uri] = client
+        return client
+
+
+_MISSING = object()
+
+
+class IdentityMap:
+    """
+    Request scoped memo of id -> Trainee/Trainer lookups.
+    None is remembered as well, so a user known not to exist is not queried again.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, role: str, id: str):
+        """Returns the remembered model for the role and id, or _MISSING."""
+        user = self.users.get((role, str(id)), _MISSING)
+        if user is _MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def get_user(self, id: str):
+        """Returns the remembered model of either role, or _MISSING."""
+        trainee = self.users.get(('trainee', str(id)), _MISSING)
+        trainer = self.users.get(('trainer', str(id)), _MISSING)
+        if trainee is not None and trainee is not _MISSING:
+            user = trainee
+        elif trainer is not None and trainer is not _MISSING:
+            user = trainer
+        elif trainee is None and trainer is None:
+            user = None
+        else:
+            user = _MISSING
+
+        if user is _MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def remember(self, role: str, id: str, user):
+        """Stores the model (or None) found for the role and id."""
+        self.users[(role, str(id))] = user
+        return user
+
+    def forget(self, id: str):
+        """Drops every remembered model for the id."""
+        self.users.pop(('trainee', str(id)), None)
+        self.users.pop(('trainer', str(id)), None)
+
+    def clear(self):
+        """Drops every remembered model."""
+        self.users.clear()
+
+    def stats(self):
+        """Returns the hit and miss counts of the identity map."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.users)
+        }
+
+
 class Database:
-    def __init__(self, uri):
-        """Constructor for Database class."""
-        self.mongo = MongoClient(uri)['flaskDatabase']
-        self.mongo.trainee.create_index([('location', "2dsphere")], name='trainee_search_index', default_language='english')
-        self.mongo.trainer.create_index([('location', "2dsphere")], name='trainer_search_index', default_language='english')
+    def __init__(self, uri, identity_map: bool = False, shared_cache: bool = False):
+        """
+        Constructor for Database class.
+        Cheap to create, every Database shares the pooled client of its uri.
+        Indexes are managed by vitality.migrations, not by the constructor.
+
+        identity_map: bool - Memoize user lookups by id for the life of this object.
+            Meant for the per request Database stored on flask.g.
+        shared_cache: bool - Read users by id through the process wide user_cache.
+        """
+        self.mongo = get_mongo_client(uri)['flaskDatabase']
+        self.identity_map = IdentityMap() if identity_map else None
+        self.shared_cache = shared_cache
+
+    def forget_user(self, id: str = None):
+        """
+        Invalidates the identity map and the shared user cache for a user id,
+        or entirely if no id is given.
+        """
+        if id is None:
+            user_cache.clear()
+        else:
+            user_cache.delete(str(id))
+
+        if self.identity_map is None:
+            return
+        if id is None:
+            self.identity_map.clear()
+        else:
+            self.identity_map.forget(id)
+
+    def _write_transaction(self, callback):
+        """
+        Runs callback(session) inside a transaction when the deployment supports them
+        (replica sets and sharded clusters) and returns its result.
+        On a standalone server callback(None) runs without a transaction, so callbacks
+        should order their writes so that an interruption leaves the safest state.
+        """
+        client = self.mongo.client
+        if client.topology_description.topology_type_name in ('ReplicaSetWithPrimary', 'Sharded'):
+            with client.start_session() as session:
+                return session.with_transaction(callback)
+        return callback(None)
+
+    def _recall_user(self, id: str, role: str = None):
+        """
+        Returns the user remembered by the identity map or the shared user cache.
+        role: str - 'trainee', 'trainer' or None for either.
+        Returns _MISSING when the user has to be read from the database.
+        """
+        if self.identity_map is not None:
+            if role is None:
+                user = self.identity_map.get_user(id)
+            else:
+                user = self.identity_map.get(role, id)
+            if user is not _MISSING:
+                return user
+
+        if self.shared_cache:
+            user = user_cache.get(str(id), _MISSING)
+            if user is not _MISSING:
+                user = deepcopy(user)
+                self._remember_user(id, user, cache=False)
+                if role is not None and type(user).__name__.lower() != role:
+                    return None
+                return user
+
+        return _MISSING
+
+    def _remember_user(self, id: str, user, role: str = None, cache: bool = True):
+        """
+        Stores a user read from the database in the identity map and the shared user cache.
+        A None user is remembered as missing for the role, or for both roles if role is None.
+        """
+        if self.identity_map is not None:
+            for user_role in ('trainee', 'trainer'):
+                if user is not None:
+                    self.identity_map.remember(
+                        user_role, id, user if type(user).__name__.lower() == user_role else None)
+                elif role is None or role == user_role:
+                    self.identity_map.remember(user_role, id, None)
+
+        if cache and self.shared_cache and user is not None:
+            user_cache.set(str(id), deepcopy(user))
+        return user
+
+    def _find_page(self, collection, query: dict, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None):
+        """
+        Returns (documents, next_cursor) for one keyset page of the query ordered by _id.
+        next_cursor is None on the last page.
+        """
+        if cursor:
+            try:
+                last_id = ObjectId(decode_cursor(cursor)[0])
+            except (TypeError, ValueError, IndexError, KeyError, InvalidId):
+                raise InvalidCursor("Cursor does not belong to this listing.")
+            query = {'$and': [query, {'_id': {'$gt': last_id}}]}
+
+        documents = list(collection.find(query).sort('_id', 1).limit(int(limit) + 1))
+        next_cursor = None
+        if len(documents) > int(limit):
+            documents = documents[:int(limit)]
+            next_cursor = encode_cursor([str(documents[-1]['_id'])])
+        return documents, next_cursor
+
+    def _iter_find(self, collection, query: dict, batch_size: int = DEFAULT_BATCH_SIZE):
+        """Lazily yields the documents of the query, fetched from the server batch_size at a time."""
+        for document in collection.find(query).batch_size(batch_size):
+            yield document
 
     """ Trainee Functions """
 
     def trainee_dict_to_class(self, trainee_dict: dict):
         """Return a Trainee class from a dictionary"""
         trainee_dict['_id'] = str(trainee_dict['_id'])
+        trainee_dict.pop('username_grams', None)
+        trainee_dict.pop('name_grams', None)
         trainee_dict['trainers'] = [str(trainer_id)
                                     for trainer_id in trainee_dict['trainers']]
         if 'location' in trainee_dict:
@@ -53,12 +352,13 @@ class Database:
 
     def get_trainee_by_id(self, id: str):
         """Returns the Trainee class of the User found by the trainee's id."""
-        found_user = self.mongo.trainee.find_one({"_id": ObjectId(id)})
+        trainee = self._recall_user(id, 'trainee')
+        if trainee is not _MISSING:
+            return trainee
 
-        if found_user:
-            return self.trainee_dict_to_class(found_user)
-
-        return None
+        found_user = self.mongo.trainee.find_one({"_id": ObjectId(id)})
+        trainee = self.trainee_dict_to_class(found_user) if found_user else None
+        return self._remember_user(id, trainee, 'trainee')
 
     def get_trainee_by_username(self, username: str):
         """Returns the Trainee class of the User found by the trainee's username."""
@@ -71,13 +371,7 @@ class Database:
 
     def set_trainee_username(self, id: str, username: str):
         """Updates a trainee's username given a user id."""
-        self.mongo.trainee.update_one(
-            {"_id": ObjectId(id)},
-            {
-                "$set": {
-                    "username": username
-                }
-            })
+        self.update_user_profile(id, 'trainee', username=username)
 
     def set_trainee_password(self, id: str, password: str):
         """Updates a trainee's password given a user id."""
@@ -88,6 +382,7 @@ class Database:
                     "password": password_sha256(password)
                 }
             })
+        self.forget_user(id)
 
     def set_trainee_phone(self, id: str, phone: int):
         """Updates a trainee's phone number given a user id."""
@@ -98,6 +393,7 @@ class Database:
                     "phone": phone
                 }
             })
+        self.forget_user(id)
 
     def set_trainee_name(self, id: str, name: str):
         """Updates a trainee's name given a user id."""
@@ -105,14 +401,17 @@ class Database:
             {"_id": ObjectId(id)},
             {
                 "$set": {
-                    "name": name
+                    "name": name,
+                    "name_grams": search_grams(name)
                 }
             })
+        self.forget_user(id)
+        autocomplete.update('trainee', id, name=name)
 
     def set_coords(self, id: str, lng: float, lat: float):
         """Updates a user's coordinates """
-        if self.get_trainer_by_id(id) is None:
-            self.mongo.trainee.update_one(
+        for collection in (self.mongo.trainee, self.mongo.trainer):
+            updated = collection.update_one(
                 {"_id": ObjectId(id)},
                 {
                     "$set": {
@@ -123,26 +422,91 @@ class Database:
                     }
                 }
             )
+            if updated.matched_count:
+                break
+        self.forget_user(id)
 
-        if self.get_trainee_by_id(id) is None:
-            self.mongo.trainer.update_one(
-                {"_id": ObjectId(id)},
-                {
-                    "$set": {
-                        "location": {
-                            "type": "Point",
-                            "coordinates": [lng, lat]
-                        }
-                    }
-                }
-            )
+    def update_user_profile(self, user_id: str, role: str, **fields):
+        """
+        Updates any of the username, password, name, phone and lng/lat of a user with a single $set.
+            role: str - 'trainee' or 'trainer', the collection of the user.
+        The password is hashed, the search grams follow the username and name, and
+        lng/lat, which must be given together, are stored as the GeoJSON location.
+        Username uniqueness within the collection is enforced by its unique index.
+        Returns the updated Trainee or Trainer class, or None if the user was not found.
+        """
+        self._validate_profile_fields(role, fields)
+        update = self._profile_update(role, fields)
+        if not update:
+            return self.get_user_by_id(user_id)
+
+        try:
+            updated_user = self.mongo[role].find_one_and_update(
+                {'_id': ObjectId(user_id)},
+                {'$set': update},
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            raise UsernameTakenError("Username was taken.")
+        self.forget_user(user_id)
+        if updated_user is None:
+            return None
+
+        if 'username' in fields or 'name' in fields:
+            autocomplete.update(role, user_id,
+                                username=fields.get('username'),
+                                name=fields.get('name'))
+        if role == 'trainee':
+            return self.trainee_dict_to_class(updated_user)
+        return self.trainer_dict_to_class(updated_user)
+
+    def _validate_profile_fields(self, role: str, fields: dict):
+        """Raises InvalidProfileFieldError for an unknown role or field, or a lone lng or lat."""
+        if role not in USER_ROLES:
+            raise InvalidProfileFieldError("Unknown role {}.".format(role))
+        unknown_fields = set(fields) - set(PROFILE_FIELDS)
+        if unknown_fields:
+            raise InvalidProfileFieldError("Unknown profile fields {}.".format(sorted(unknown_fields)))
+        if ('lng' in fields) != ('lat' in fields):
+            raise InvalidProfileFieldError("lng and lat must be updated together.")
+
+    def _profile_update(self, role: str, fields: dict):
+        """
+        Returns the $set document of validated profile fields.
+        Raises UsernameTakenError if the new username belongs to a user of the other role.
+        """
+        update = {}
+        if 'username' in fields:
+            update.update(self._username_update(role, fields['username']))
+        if 'password' in fields:
+            update['password'] = password_sha256(fields['password'])
+        if 'name' in fields:
+            update['name'] = fields['name']
+            update['name_grams'] = search_grams(fields['name'])
+        if 'phone' in fields:
+            update['phone'] = fields['phone']
+        if 'lng' in fields:
+            update['location'] = {
+                'type': 'Point',
+                'coordinates': [fields['lng'], fields['lat']]
+            }
+        return update
+
+    def _username_update(self, role: str, username: str):
+        """Returns the username fields to $set, checking the other role's unique usernames."""
+        other_role = 'trainer' if role == 'trainee' else 'trainee'
+        if self.mongo[other_role].find_one({'username': username}, {'_id': 1}) is not None:
+            raise UsernameTakenError("Username was taken.")
+        return {
+            'username': username,
+            'username_grams': search_grams(username)
+        }
 
     def trainee_add_trainer(self, trainee_id: str, trainer_id: str):
         """Add trainer object id to trainee's trainer list"""
-        if self.get_trainee_by_id(trainee_id) is None or self.get_trainee_by_id(trainee_id) is None:
+        if self.get_trainee_by_id(trainee_id) is None:
             raise UserNotFoundError("Trainee ID does not exist.")
 
-        if self.get_trainer_by_id(trainer_id) is None or self.get_trainer_by_id(trainer_id) is None:
+        if self.get_trainer_by_id(trainer_id) is None:
             raise UserNotFoundError("Trainer ID does not exist.")
 
         self.mongo.trainee.update_one(
@@ -152,12 +516,11 @@ class Database:
                     "trainers": ObjectId(trainer_id)
                 }
             })
+        self.forget_user(trainee_id)
 
     def add_trainee(self, trainee: Trainee):
         """Adds a user to the database based on a provided Trainee class."""
-        if (self.get_trainee_by_username(trainee.username) is not None):
-            raise UsernameTakenError("Username was taken.")
-
+        # Usernames are unique within a collection by index, the other role is checked here
         if (self.get_trainer_by_username(trainee.username) is not None):
             raise UsernameTakenError("Username was taken.")
 
@@ -173,7 +536,13 @@ class Database:
         }
         trainee_dict.pop('lat')
         trainee_dict.pop('lng')
-        self.mongo.trainee.insert_one(trainee_dict)
+        trainee_dict['username_grams'] = search_grams(trainee_dict['username'])
+        trainee_dict['name_grams'] = search_grams(trainee_dict['name'])
+        try:
+            inserted = self.mongo.trainee.insert_one(trainee_dict)
+        except DuplicateKeyError:
+            raise UsernameTakenError("Username was taken.")
+        autocomplete.add('trainee', inserted.inserted_id, trainee_dict['username'], trainee_dict['name'])
 
     def add_trainee_experience(self, trainee_id: str, value: int):
 
@@ -187,30 +556,22 @@ class Database:
                 }
             }
         )
+        self.forget_user(trainee_id)
 
-    def remove_trainee(self, id: str):
-        """Deletes a trainee by trainee id."""
-        self.mongo.trainee.delete_one({"_id": ObjectId(id)})
-
-        # Remove trainee from trainer's list
-        self.mongo.trainer.update_many(
-            {},
-            {
-                "$pull": {
-                    "trainees": {
-                        "$in": [ObjectId(id)]
-                    }
-                }
-            }
-
-        )
+    def remove_trainee(self, id: str, cascade: bool = True):
+        """
+        Deletes a trainee by trainee id.
+        With cascade, their workouts, invitations, events and links are removed as well,
+        otherwise remove_user_references must be called later, for example from a job.
+        """
+        self._remove_user('trainee', id, cascade)
 
     def trainee_remove_trainer(self, trainee_id: str, trainer_id: str):
         """Remove trainer object id from trainees's trainer list"""
-        if self.get_trainee_by_id(trainee_id) is None or self.get_trainee_by_id(trainee_id) is None:
+        if self.get_trainee_by_id(trainee_id) is None:
             raise UserNotFoundError("Trainee ID does not exist.")
 
-        if self.get_trainer_by_id(trainer_id) is None or self.get_trainer_by_id(trainer_id) is None:
+        if self.get_trainer_by_id(trainer_id) is None:
             raise UserNotFoundError("Trainer ID does not exist.")
 
         self.mongo.trainee.update_one(
@@ -225,12 +586,15 @@ class Database:
                 }
             }
         )
+        self.forget_user(trainee_id)
 
     """ Trainer Functions """
 
     def trainer_dict_to_class(self, trainer_dict: str):
         """Return a Trainer class from a dictionary"""
         trainer_dict['_id'] = str(trainer_dict['_id'])
+        trainer_dict.pop('username_grams', None)
+        trainer_dict.pop('name_grams', None)
         trainer_dict['trainees'] = [str(trainee_id)
                                     for trainee_id in trainer_dict['trainees']]
         if 'location' in trainer_dict: 
@@ -259,67 +623,118 @@ class Database:
 
     def get_trainer_by_id(self, id: str):
         """Returns the trainer class of the trainer found by the trainer's id."""
-        found_trainer = self.mongo.trainer.find_one({"_id": ObjectId(id)})
-        if found_trainer:
-            return self.trainer_dict_to_class(found_trainer)
-
-        return None
-
-    def list_trainers_by_search(self, name: str):
-        """Return a list of trainers by using regex against the 'name' and 'username' fields"""
-        def escape_regex(word: str):
-            """Escaping the user input being passed into regex"""
-            word = escape(word)
-            word = re.escape(word)
-            return word
-
-        trainers = []
-
-        found_trainers = self.mongo.trainer.find(
-            {"$or": [
-                {
-                    "username": {"$regex": r".*{}.*".format(escape_regex(name))}
-                },
-                {
-                    "name": {"$regex": r".*{}.*".format(escape_regex(name))}
-                }
-            ]}
-        )
-
-        if found_trainers is not None:
-            for trainer in found_trainers:
-                trainers.append(self.trainer_dict_to_class(trainer))
-
-        return trainers
-
-    def list_trainees_by_search(self, name: str):
-        """Return a list of trainees by using regex against the 'name' and 'username' fields"""
-        def escape_regex(word: str):
-            """Escaping the user input being passed into regex"""
-            word = escape(word)
-            word = re.escape(word)
-            return word
-
-        trainees = []
-        found_trainees = self.mongo.trainee.find(
-            {"$or": [
-                {
-                    "username": {"$regex": r".*{}.*".format(escape_regex(name))}
-                },
-                {
-                    "name": {"$regex": r".*{}.*".format(escape_regex(name))}
-                }
-            ]}
-        )
+        trainer = self._recall_user(id, 'trainer')
+        if trainer is not _MISSING:
+            return trainer
 
-        if found_trainees is not None:
-            for trainee in found_trainees:
-                trainees.append(self.trainee_dict_to_class(trainee))
+        found_trainer = self.mongo.trainer.find_one({"_id": ObjectId(id)})
+        trainer = self.trainer_dict_to_class(found_trainer) if found_trainer else None
+        return self._remember_user(id, trainer, 'trainer')
 
-        return trainees
+    def search_users(self, collection, name: str, limit: int = DEFAULT_SEARCH_LIMIT, cursor: str = None):
+        """
+        Return the user documents of a collection whose 'username' or 'name' contains the search term.
+        Candidates come from the indexed 'username_grams' and 'name_grams' fields and are
+        ordered by relevance: exact username, username prefix, name prefix, then any substring.
+        Each document keeps its 'search_score' so callers can build a (score, username) cursor.
+        A limit of None returns every match. Terms shorter than MIN_SEARCH_TERM_LENGTH match nothing.
+        """
+        term = str(escape(name)).lower()
+        if len(term) < MIN_SEARCH_TERM_LENGTH:
+            return iter(())
+
+        grams = search_query_grams(term)
+        pipeline = [
+            {'$match': {'$or': [
+                {'username_grams': {'$all': grams}},
+                {'name_grams': {'$all': grams}}
+            ]}},
+            {'$addFields': {
+                'search_username': {'$indexOfCP': [{'$toLower': '$username'}, term]},
+                'search_name': {'$indexOfCP': [{'$toLower': {'$ifNull': ['$name', '']}}, term]}
+            }},
+            {'$match': {'$or': [
+                {'search_username': {'$gte': 0}},
+                {'search_name': {'$gte': 0}}
+            ]}},
+            {'$addFields': {'search_score': {'$add': [
+                {'$cond': [{'$eq': [{'$toLower': '$username'}, term]}, 8, 0]},
+                {'$cond': [{'$eq': ['$search_username', 0]}, 4, 0]},
+                {'$cond': [{'$eq': ['$search_name', 0]}, 2, 0]},
+                {'$cond': [{'$gte': ['$search_username', 0]}, 1, 0]}
+            ]}}},
+        ]
+        if cursor:
+            try:
+                last_score, last_username = decode_cursor(cursor)
+            except (TypeError, ValueError, KeyError):
+                raise InvalidCursor("Cursor does not belong to a user search.")
+            pipeline.append({'$match': {'$or': [
+                {'search_score': {'$lt': last_score}},
+                {'search_score': last_score, 'username': {'$gt': last_username}}
+            ]}})
+
+        pipeline += [
+            {'$sort': {'search_score': -1, 'username': 1}},
+            {'$project': {
+                'search_username': 0,
+                'search_name': 0
+            }}
+        ]
+        if limit is not None:
+            pipeline.insert(-1, {'$limit': int(limit)})
+        return collection.aggregate(pipeline, batchSize=DEFAULT_BATCH_SIZE)
+
+    def _search_users_page(self, collection, dict_to_class, name: str, limit: int, cursor: str):
+        """Returns (users, next_cursor) for one page of search_users."""
+        found_users = list(self.search_users(collection, name, int(limit) + 1, cursor))
+        next_cursor = None
+        if len(found_users) > int(limit):
+            found_users = found_users[:int(limit)]
+            next_cursor = encode_cursor([found_users[-1]['search_score'], found_users[-1]['username']])
+
+        users = []
+        for user in found_users:
+            user.pop('search_score')
+            users.append(dict_to_class(user))
+        return users, next_cursor
+
+    def _iter_search_users(self, collection, dict_to_class, name: str):
+        """Lazily yields every match of search_users as classes."""
+        for user in self.search_users(collection, name, limit=None):
+            user.pop('search_score')
+            yield dict_to_class(user)
+
+    def list_trainers_by_search(self, name: str, limit: int = DEFAULT_SEARCH_LIMIT):
+        """Return a list of the most relevant trainers whose 'name' or 'username' contains the search term"""
+        return self.list_trainers_page_by_search(name, limit)[0]
+
+    def list_trainers_page_by_search(self, name: str, limit: int = DEFAULT_SEARCH_LIMIT, cursor: str = None):
+        """Return (trainers, next_cursor) for one page of list_trainers_by_search"""
+        return self._search_users_page(self.mongo.trainer, self.trainer_dict_to_class, name, limit, cursor)
+
+    def iter_trainers_by_search(self, name: str):
+        """Lazily yield every trainer matching the search term, most relevant first"""
+        return self._iter_search_users(self.mongo.trainer, self.trainer_dict_to_class, name)
+
+    def list_trainees_by_search(self, name: str, limit: int = DEFAULT_SEARCH_LIMIT):
+        """Return a list of the most relevant trainees whose 'name' or 'username' contains the search term"""
+        return self.list_trainees_page_by_search(name, limit)[0]
+
+    def list_trainees_page_by_search(self, name: str, limit: int = DEFAULT_SEARCH_LIMIT, cursor: str = None):
+        """Return (trainees, next_cursor) for one page of list_trainees_by_search"""
+        return self._search_users_page(self.mongo.trainee, self.trainee_dict_to_class, name, limit, cursor)
+
+    def iter_trainees_by_search(self, name: str):
+        """Lazily yield every trainee matching the search term, most relevant first"""
+        return self._iter_search_users(self.mongo.trainee, self.trainee_dict_to_class, name)
 
     def find_trainers_near_user(self, lng, lat, min=0, max=10000000000):
         """Return a list of trainers based on the user's location"""
+        return list(self.iter_trainers_near_user(lng, lat, min, max))
+
+    def iter_trainers_near_user(self, lng, lat, min=0, max=10000000000):
+        """Lazily yield the trainers nearest to the user's location first"""
         returned_list = self.mongo.trainer.find({
             'location': {
                 "$near": {
@@ -331,24 +746,103 @@ class Database:
                     "$minDistance": min
                 }
             }
-        })
+        }).batch_size(DEFAULT_BATCH_SIZE)
 
-        trainer_list = []
         for trainer in returned_list:
-            trainer_object = self.trainer_dict_to_class(trainer)
-            trainer_list.append(trainer_object)
-        
-        return trainer_list
+            yield self.trainer_dict_to_class(trainer)
+
+    def find_nearest_trainers(self, lng, lat,
+                              limit: int = DEFAULT_NEARBY_LIMIT,
+                              max_distance: float = DEFAULT_NEARBY_RADIUS,
+                              fields=NEARBY_TRAINER_FIELDS):
+        """
+        Return the nearest trainers within max_distance meters of the point, nearest first.
+        Each trainer is a dict holding '_id', 'lng', 'lat', 'distance' in meters and the requested fields.
+        The limit is capped at MAX_NEARBY_LIMIT so the cost never grows with the number of trainers.
+        """
+        limit = max(0, min(int(limit), MAX_NEARBY_LIMIT))
+        if limit == 0:
+            return []
+
+        projection = {field: 1 for field in fields}
+        projection.update({'location': 1, 'distance': 1})
+        found_trainers = self.mongo.trainer.aggregate([
+            {'$geoNear': {
+                'near': {
+                    "type": "Point",
+                    "coordinates": [float(lng), float(lat)]
+                },
+                'distanceField': 'distance',
+                'spherical': True,
+                'maxDistance': float(max_distance),
+                'key': 'location'
+            }},
+            {'$limit': limit},
+            {'$project': projection}
+        ])
+
+        trainers = []
+        for trainer in found_trainers:
+            location = trainer.pop('location')
+            trainer['_id'] = str(trainer['_id'])
+            trainer['lng'] = location['coordinates'][0]
+            trainer['lat'] = location['coordinates'][1]
+            trainers.append(trainer)
+        return trainers
+
+    def find_nearby_trainer_pins(self, lng, lat,
+                                 limit: int = DEFAULT_NEARBY_LIMIT,
+                                 max_distance: float = DEFAULT_NEARBY_RADIUS):
+        """Return the MapPin classes of the nearest trainers within max_distance meters."""
+        return [MapPin(**trainer) for trainer in self.find_nearest_trainers(
+            lng, lat, limit, max_distance, fields=('username',))]
+
+    def find_trainers_page_near_user(self, lng, lat, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None, max=10000000000):
+        """
+        Return (trainers, next_cursor) for one page of trainers ordered by distance from the user.
+        The cursor keeps the last distance and the ids found at exactly that distance.
+        """
+        min_distance = 0
+        query = {}
+        if cursor:
+            try:
+                min_distance, last_ids = decode_cursor(cursor)
+                query['_id'] = {'$nin': [ObjectId(id) for id in last_ids]}
+            except (TypeError, ValueError, KeyError, InvalidId):
+                raise InvalidCursor("Cursor does not belong to a nearby search.")
+
+        found_trainers = list(self.mongo.trainer.aggregate([
+            {'$geoNear': {
+                'near': {
+                    "type": "Point",
+                    "coordinates": [float(lng), float(lat)]
+                },
+                'distanceField': 'distance',
+                'spherical': True,
+                'minDistance': min_distance,
+                'maxDistance': max,
+                'query': query
+            }},
+            {'$limit': int(limit) + 1}
+        ]))
+
+        next_cursor = None
+        if len(found_trainers) > int(limit):
+            found_trainers = found_trainers[:int(limit)]
+            last_distance = found_trainers[-1]['distance']
+            next_cursor = encode_cursor([last_distance, [
+                str(trainer['_id']) for trainer in found_trainers
+                if trainer['distance'] == last_distance]])
+
+        trainers = []
+        for trainer in found_trainers:
+            trainer.pop('distance')
+            trainers.append(self.trainer_dict_to_class(trainer))
+        return trainers, next_cursor
 
     def set_trainer_username(self, id: str, username: str):
         """Updates a trainer's username given a trainer id."""
-        self.mongo.trainer.update_one(
-            {"_id": ObjectId(id)},
-            {
-                "$set": {
-                    "username": username
-                }
-            })
+        self.update_user_profile(id, 'trainer', username=username)
 
     def set_trainer_password(self, id: str, password: str):
         """Updates a trainer's password given a trainer id."""
@@ -359,6 +853,7 @@ class Database:
                     "password": password_sha256(password)
                 }
             })
+        self.forget_user(id)
 
     def set_trainer_phone(self, id: str, phone: str):
         """Updates a trainer's phone number given a trainer id."""
@@ -369,6 +864,7 @@ class Database:
                     "phone": phone
                 }
             })
+        self.forget_user(id)
 
     def set_trainer_name(self, id: str, name: str):
         """Updates a trainer's name given a trainer id."""
@@ -376,16 +872,19 @@ class Database:
             {"_id": ObjectId(id)},
             {
                 "$set": {
-                    "name": name
+                    "name": name,
+                    "name_grams": search_grams(name)
                 }
             })
+        self.forget_user(id)
+        autocomplete.update('trainer', id, name=name)
 
     def trainer_add_trainee(self, trainer_id: str, trainee_id: str):
         """Add trainer object id to trainee's trainer list"""
-        if self.get_trainee_by_id(trainee_id) is None or self.get_trainee_by_id(trainee_id) is None:
+        if self.get_trainee_by_id(trainee_id) is None:
             raise UserNotFoundError("Trainee ID does not exist.")
 
-        if self.get_trainer_by_id(trainer_id) is None or self.get_trainer_by_id(trainer_id) is None:
+        if self.get_trainer_by_id(trainer_id) is None:
             raise UserNotFoundError("Trainer ID does not exist.")
 
         self.mongo.trainer.update_one(
@@ -395,13 +894,14 @@ class Database:
                     "trainees": ObjectId(trainee_id)
                 }
             })
+        self.forget_user(trainer_id)
 
     def trainer_remove_trainee(self, trainer_id: str, trainee_id: str):
         """Remove trainee object id from trainers's trainee list"""
-        if self.get_trainee_by_id(trainee_id) is None or self.get_trainee_by_id(trainee_id) is None:
+        if self.get_trainee_by_id(trainee_id) is None:
             raise UserNotFoundError("Trainee ID does not exist.")
 
-        if self.get_trainer_by_id(trainer_id) is None or self.get_trainer_by_id(trainer_id) is None:
+        if self.get_trainer_by_id(trainer_id) is None:
             raise UserNotFoundError("Trainer ID does not exist.")
 
         self.mongo.trainer.update_one(
@@ -416,12 +916,11 @@ class Database:
                 }
             }
         )
+        self.forget_user(trainer_id)
 
     def add_trainer(self, trainer: Trainer):
         """Adds a trainer to the database based on a provided trainer class."""
-        if (self.get_trainer_by_username(trainer.username) is not None):
-            raise UsernameTakenError("Username was taken.")
-
+        # Usernames are unique within a collection by index, the other role is checked here
         if (self.get_trainee_by_username(trainer.username) is not None):
             raise UsernameTakenError("Username was taken.")
 
@@ -437,7 +936,13 @@ class Database:
         }
         trainer_dict.pop('lng')
         trainer_dict.pop('lat')
-        self.mongo.trainer.insert_one(trainer_dict)
+        trainer_dict['username_grams'] = search_grams(trainer_dict['username'])
+        trainer_dict['name_grams'] = search_grams(trainer_dict['name'])
+        try:
+            inserted = self.mongo.trainer.insert_one(trainer_dict)
+        except DuplicateKeyError:
+            raise UsernameTakenError("Username was taken.")
+        autocomplete.add('trainer', inserted.inserted_id, trainer_dict['username'], trainer_dict['name'])
 
     def add_trainer_experience(self, trainer_id: str, value: int):
 
@@ -451,22 +956,159 @@ class Database:
                 }
             }
         )
+        self.forget_user(trainer_id)
 
-    def remove_trainer(self, id: str):
-        """Deletes a trainer by trainer id."""
-        self.mongo.trainer.delete_one({"_id": ObjectId(id)})
+    def remove_trainer(self, id: str, cascade: bool = True):
+        """
+        Deletes a trainer by trainer id.
+        With cascade, their workouts, invitations, events and links are removed as well,
+        otherwise remove_user_references must be called later, for example from a job.
+        """
+        self._remove_user('trainer', id, cascade)
+
+    """ User Functions """
+
+    def _remove_user(self, role: str, id: str, cascade: bool = True):
+        """Deletes a user and, with cascade, the documents that reference them."""
+        if not cascade:
+            self.mongo[role].delete_one({'_id': ObjectId(id)})
+            autocomplete.remove(role, id)
+            self.forget_user(id)
+            return
+
+        def remove(session):
+            self.mongo[role].delete_one({'_id': ObjectId(id)}, session=session)
+            self._remove_user_references(role, id, session)
+
+        self._write_transaction(remove)
+        autocomplete.remove(role, id)
+        self.forget_user()
+
+    def remove_user_references(self, role: str, id: str):
+        """
+        Removes the links, workouts, invitations and events of a removed user.
+        Safe to repeat, every write is a $pull or a delete.
+        """
+        self._write_transaction(lambda session: self._remove_user_references(role, id, session))
+        self.forget_user()
 
-        # Remove trainer from trainee's list
-        self.mongo.trainee.update_many(
-            {},
+    def _remove_user_references(self, role: str, id: str, session=None):
+        """
+        Only the counterparts listing the user are rewritten, found through the multikey
+        index on their relationship array, and the user's workouts, invitations and events
+        are removed with one bulk_write per collection on their indexed owner fields.
+        """
+        user_id = ObjectId(id)
+        other_role, relationship = ('trainer', 'trainees') if role == 'trainee' else ('trainee', 'trainers')
+
+        self.mongo[other_role].update_many(
+            {relationship: user_id},
             {
-                "$pull": {
-                    "trainers": {
-                        "$in": [ObjectId(id)]
-                    }
+                '$pull': {
+                    relationship: user_id
                 }
-            }
-        )
+            },
+            session=session)
+        self.mongo.workout.bulk_write([
+            DeleteMany({'creator_id': user_id})
+        ], session=session)
+        self.mongo.invitation.bulk_write([
+            DeleteMany({'sender': user_id}),
+            DeleteMany({'recipient': user_id})
+        ], ordered=False, session=session)
+        self.mongo.event.bulk_write([
+            DeleteMany({'creator_id': user_id}),
+            DeleteMany({'participant_id': user_id})
+        ], ordered=False, session=session)
+
+    def iter_user_names(self, role: str, batch_size: int = 1000):
+        """
+        Yields (id, username, name) for every user of a role.
+        Streams a projected cursor so only the three fields are ever held per batch.
+        """
+        collection = self.mongo.trainer if role == 'trainer' else self.mongo.trainee
+        found_users = collection.find(
+            {}, {'username': 1, 'name': 1}).batch_size(batch_size)
+        for user in found_users:
+            yield str(user['_id']), user.get('username', ''), user.get('name')
+
+    def user_dict_to_class(self, user_dict: dict):
+        """Return a Trainee or Trainer class from a dictionary tagged with its 'role'"""
+        role = user_dict.pop('role')
+        if role == 'trainer':
+            return self.trainer_dict_to_class(user_dict)
+        return self.trainee_dict_to_class(user_dict)
+
+    def find_user(self, query: dict):
+        """
+        Returns the first Trainee or Trainer matching the query.
+        Both collections are searched in a single round trip using $unionWith.
+        """
+        found_users = self.mongo.trainee.aggregate([
+            {'$match': query},
+            {'$addFields': {'role': {'$literal': 'trainee'}}},
+            {'$unionWith': {
+                'coll': 'trainer',
+                'pipeline': [
+                    {'$match': query},
+                    {'$addFields': {'role': {'$literal': 'trainer'}}}
+                ]
+            }},
+            {'$limit': 1}
+        ])
+
+        for found_user in found_users:
+            return self.user_dict_to_class(found_user)
+
+        return None
+
+    def get_user_by_id(self, id: str):
+        """Returns the Trainee or Trainer class of the user found by the user's id."""
+        user = self._recall_user(id)
+        if user is not _MISSING:
+            return user
+
+        user = self.find_user({"_id": ObjectId(id)})
+        return self._remember_user(id, user)
+
+    def get_user_by_username(self, username: str):
+        """Returns the Trainee or Trainer class of the user found by the user's username."""
+        return self.find_user({"username": username})
+
+    def get_user_summaries_by_ids(self, ids: list, role: str = None):
+        """
+        Returns the UserSummary classes of a list of user ids with one projected query.
+        Only the collection of the role is searched when it is given ('trainee' or 'trainer'),
+        otherwise both collections are searched in a single round trip using $unionWith.
+        The order of the ids is kept and ids that were not found are skipped.
+        """
+        if not ids:
+            return []
+
+        query = {"_id": {"$in": [ObjectId(id) for id in ids]}}
+        roles = [role] if role is not None else ['trainee', 'trainer']
+        pipeline = [
+            {'$match': query},
+            {'$project': dict(USER_SUMMARY_PROJECTION, role={'$literal': roles[0]})}
+        ]
+        if len(roles) > 1:
+            pipeline.append({'$unionWith': {
+                'coll': roles[1],
+                'pipeline': [
+                    {'$match': query},
+                    {'$project': dict(USER_SUMMARY_PROJECTION, role={'$literal': roles[1]})}
+                ]
+            }})
+
+        summaries = {}
+        for user in self.mongo[roles[0]].aggregate(pipeline):
+            summaries[str(user['_id'])] = UserSummary(**user)
+        return [summaries[str(id)] for id in ids if str(id) in summaries]
+
+    def get_user_summary_by_id(self, id: str, role: str = None):
+        """Returns the UserSummary class of a user id, or None if the user was not found."""
+        summaries = self.get_user_summaries_by_ids([id], role)
+        return summaries[0] if summaries else None
 
     """Workout Functions"""
 
@@ -508,27 +1150,121 @@ class Database:
         If a workout with the passed key value pairs are not found, then we raise a WorkoutNotFound
         error. 
         """
-        if 'creator_id' in kwargs: 
-            kwargs['creator_id'] = ObjectId(kwargs['creator_id'])
-        if '_id' in kwargs: 
-            kwargs['_id'] = ObjectId(kwargs['_id'])
-            
-        found_workout = self.mongo.workout.find({**kwargs})
-        workouts = []
-        for workout in found_workout:
-            workout = self.workout_dict_to_class(workout)
-            workouts.append(workout)
-        return workouts
+        return list(self.iter_workouts_by_attributes(**kwargs))
+
+    def workout_query(self, attributes: dict):
+        """Returns a workout find query with the id attributes converted to ObjectIds."""
+        query = dict(attributes)
+        if 'creator_id' in query:
+            query['creator_id'] = ObjectId(query['creator_id'])
+        if '_id' in query:
+            query['_id'] = ObjectId(query['_id'])
+        return query
+
+    def iter_workouts_by_attributes(self, **kwargs):
+        """Lazily yields the Workout classes matching the keyword arguments."""
+        for workout in self._iter_find(self.mongo.workout, self.workout_query(kwargs)):
+            yield self.workout_dict_to_class(workout)
+
+    def get_workout_page_by_attributes(self, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None, **kwargs):
+        """Returns (workouts, next_cursor) for one page of the workouts matching the keyword arguments."""
+        found_workouts, next_cursor = self._find_page(
+            self.mongo.workout, self.workout_query(kwargs), limit, cursor)
+        return [self.workout_dict_to_class(workout) for workout in found_workouts], next_cursor
 
     def get_all_workouts_by_creatorid(self, creator_id: str):
         """Returns the Workout class found by the workout's id."""
-        found_workouts = self.mongo.workout.find(
-            {"creator_id": ObjectId(creator_id)})
-        workouts = []
-        if found_workouts:
-            for workout in found_workouts:
-                workouts.append(self.workout_dict_to_class(workout))
-        return workouts
+        return list(self.iter_workouts_by_creatorid(creator_id))
+
+    def iter_workouts_by_creatorid(self, creator_id: str):
+        """Lazily yields the Workout classes created by a user."""
+        return self.iter_workouts_by_attributes(creator_id=creator_id)
+
+    def get_workout_page_by_creatorid(self, creator_id: str, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None):
+        """Returns (workouts, next_cursor) for one page of the workouts created by a user."""
+        return self.get_workout_page_by_attributes(limit, cursor, creator_id=creator_id)
+
+    def search_workouts(self,
+                        text: str = '',
+                        difficulty: str = None,
+                        category: str = None,
+                        limit: int = DEFAULT_SEARCH_LIMIT,
+                        cursor: str = None):
+        """
+        Full text search over the workouts' name, about and category fields.
+            text: str - The search terms, every workout matches when empty.
+            difficulty: str - Only return workouts of this difficulty.
+            category: str - Only return workouts of this category.
+            limit: int - The page size.
+            cursor: str - The 'next_cursor' of the previous page.
+
+        Returns a dictionary with the page of Workout classes ordered by relevance under 'workouts',
+        the difficulty and category counts of every text match under 'facets' and the cursor of
+        the next page (or None) under 'next_cursor'. Facets are only counted for the first page
+        of a text search, other pages return None. Without text the page is a plain _id ordered
+        keyset query, so browsing never scans the whole catalog.
+        """
+        text = str(text).strip() if text else ''
+        filters = {}
+        if difficulty:
+            filters['difficulty'] = difficulty
+        if category:
+            filters['category'] = category
+
+        match = {'$text': {'$search': text}} if text else {}
+        if text:
+            page, next_cursor = self._search_workouts_page(match, filters, limit, cursor)
+        else:
+            page, next_cursor = self._find_page(self.mongo.workout, filters, limit, cursor)
+
+        return {
+            'workouts': [self.workout_dict_to_class(workout) for workout in page],
+            'facets': self._workout_search_facets(match) if text and cursor is None else None,
+            'next_cursor': next_cursor
+        }
+
+    def _search_workouts_page(self, match: dict, filters: dict, limit: int, cursor: str):
+        """Returns (workouts, next_cursor) for one page of text matches ordered by relevance."""
+        pipeline = [{'$match': dict(match, **filters)},
+                    {'$addFields': {'search_score': {'$meta': 'textScore'}}}]
+        if cursor:
+            try:
+                last_score, last_id = decode_cursor(cursor)
+                last_id = ObjectId(last_id)
+            except (TypeError, ValueError, KeyError, InvalidId):
+                raise InvalidCursor("Cursor does not belong to a workout search.")
+            pipeline.append({'$match': {'$or': [
+                {'search_score': {'$lt': last_score}},
+                {'search_score': last_score, '_id': {'$gt': last_id}}
+            ]}})
+        pipeline += [
+            {'$sort': {'search_score': -1, '_id': 1}},
+            {'$limit': int(limit) + 1}
+        ]
+
+        found = list(self.mongo.workout.aggregate(pipeline))
+        page = found[:int(limit)]
+        next_cursor = None
+        if len(found) > int(limit):
+            next_cursor = encode_cursor([page[-1]['search_score'], str(page[-1]['_id'])])
+        for workout in page:
+            workout.pop('search_score')
+        return page, next_cursor
+
+    def _workout_search_facets(self, match: dict):
+        """Returns the difficulty and category counts of the workouts matching the query."""
+        found = next(self.mongo.workout.aggregate([
+            {'$match': match},
+            {'$facet': {
+                'difficulty': [{'$sortByCount': '$difficulty'}],
+                'category': [{'$sortByCount': '$category'}]
+            }}
+        ]))
+        return {
+            facet: {count['_id']: count['count']
+                    for count in found[facet] if count['_id'] is not None}
+            for facet in ('difficulty', 'category')
+        }
 
     def set_workout_creator_id(self, id: str, creator_id: str):
         """Updates a workout's creator id given a workout id."""
@@ -630,13 +1366,56 @@ class Database:
                 }
             })
 
+    def complete_workout(self, user_id: str, name: str, role: str, exp: int,
+                         total_time: str, reps: str, miles: str, category: str):
+        """
+        Adds exp to a user and marks the user's workout of that name as completed with its results.
+            role: str - 'trainee' or 'trainer', the collection of the user.
+        The experience is added even if the user has no workout of that name, and both
+        writes share a transaction when the deployment supports them.
+        Returns the updated Workout class, or None if the user has no workout of that name.
+        """
+        def complete(session):
+            completed_workout = self.mongo.workout.find_one_and_update(
+                {
+                    'creator_id': ObjectId(user_id),
+                    'name': name
+                },
+                {
+                    '$set': {
+                        'total_time': total_time,
+                        'reps': reps,
+                        'miles': miles,
+                        'category': category,
+                        'is_complete': True
+                    }
+                },
+                return_document=ReturnDocument.AFTER,
+                session=session)
+
+            self.mongo[role].update_one(
+                {'_id': ObjectId(user_id)},
+                {
+                    '$inc': {
+                        'exp': int(exp)
+                    }
+                },
+                session=session)
+            return completed_workout
+
+        completed_workout = self._write_transaction(complete)
+        self.forget_user(user_id)
+        if completed_workout is None:
+            return None
+        return self.workout_dict_to_class(completed_workout)
+
     def remove_workout(self, id: str):
         """Deletes a workout by workout id."""
         self.mongo.workout.delete_one({"_id": ObjectId(id)})
 
     def add_workout(self, workout: Workout):
         """Adds a workout to the database based on a provided Workout class."""
-        if self.get_trainee_by_id(workout.creator_id) is None and self.get_trainer_by_id(workout.creator_id) is None:
+        if self.get_user_by_id(workout.creator_id) is None:
             raise WorkoutCreatorIdNotFoundError("Creator Id Not Found")
         self.mongo.workout.insert_one({
             "creator_id": ObjectId(workout.creator_id),
@@ -659,9 +1438,9 @@ class Database:
 
             returns the object id of the invitation.
         """
-        if self.get_trainee_by_id(sender) is None and self.get_trainer_by_id(sender) is None:
+        if self.get_user_by_id(sender) is None:
             raise UserNotFoundError('Sender could not be found')
-        if self.get_trainee_by_id(recipient) is None and self.get_trainer_by_id(recipient) is None:
+        if self.get_user_by_id(recipient) is None:
             raise UserNotFoundError('Recipient could not be found')
         invitation = self.mongo.invitation.insert_one({
             'sender': ObjectId(sender),
@@ -700,31 +1479,128 @@ class Database:
         Search for all invitations a user has sent and recieved.
             user_id: str - The id of the user given by mongodb.
         """
-        database_sent = self.mongo.invitation.find({
-            'sender': ObjectId(user_id)
-        })
-        database_recieved = self.mongo.invitation.find({
-            'recipient': ObjectId(user_id)
-        })
+        all_sent = list(self.iter_user_invitations(user_id, 'sent'))
+        all_recieved = list(self.iter_user_invitations(user_id, 'recieved'))
+        return (all_sent, all_recieved)
 
-        all_sent = []
-        all_recieved = []
+    def invitation_query(self, user_id: str, direction: str):
+        """
+        Returns the find query of a user's invitations.
+            direction: str - 'sent' or 'recieved'.
+        """
+        field = 'sender' if direction == 'sent' else 'recipient'
+        return {field: ObjectId(user_id)}
+
+    def invitation_dict(self, item: dict):
+        """Returns an invitation document with its ids as strings."""
+        return {
+            '_id': str(item['_id']),
+            'sender': str(item['sender']),
+            'recipient': str(item['recipient']),
+        }
 
-        for item in database_sent:
-            all_sent.append({
-                '_id': str(item['_id']),
-                'sender': str(item['sender']),
-                'recipient': str(item['recipient']),
-            })
+    def iter_user_invitations(self, user_id: str, direction: str):
+        """
+        Lazily yields the invitations a user has sent or recieved.
+            direction: str - 'sent' or 'recieved'.
+        """
+        for item in self._iter_find(self.mongo.invitation, self.invitation_query(user_id, direction)):
+            yield self.invitation_dict(item)
 
-        for item in database_recieved:
-            all_recieved.append({
-                '_id': str(item['_id']),
-                'sender': str(item['sender']),
-                'recipient': str(item['recipient']),
-            })
+    def _invitation_listing_pipeline(self, user_id: str, limit: int = None,
+                                     sent_cursor: str = None, recieved_cursor: str = None):
+        """
+        Aggregation listing the invitations a user has sent and recieved in one round trip.
+        The counterpart of each invitation is joined with $lookup on both user collections,
+        projected to its display fields, and the results are split by $facet.
+        """
+        user_id = ObjectId(user_id)
+
+        def counterpart_lookup(collection):
+            return {'$lookup': {
+                'from': collection,
+                'let': {'user_id': '$counterpart'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$_id', '$$user_id']}}},
+                    {'$project': dict(USER_SUMMARY_PROJECTION, role={'$literal': collection})}
+                ],
+                'as': 'counterpart_' + collection
+            }}
+
+        def direction_facet(field, cursor):
+            stages = [{'$match': {field: user_id}}]
+            if cursor:
+                try:
+                    last_id = ObjectId(decode_cursor(cursor)[0])
+                except (TypeError, ValueError, IndexError, KeyError, InvalidId):
+                    raise InvalidCursor("Cursor does not belong to this listing.")
+                stages.append({'$match': {'_id': {'$gt': last_id}}})
+            stages.append({'$sort': {'_id': 1}})
+            if limit is not None:
+                stages.append({'$limit': int(limit) + 1})
+            # Only the invitations on this page are joined with their counterpart
+            return stages + [
+                {'$addFields': {'counterpart': '$' + ('recipient' if field == 'sender' else 'sender')}},
+                counterpart_lookup('trainee'),
+                counterpart_lookup('trainer')
+            ]
 
-        return (all_sent, all_recieved)
+        return [
+            {'$match': {'$or': [{'sender': user_id}, {'recipient': user_id}]}},
+            {'$facet': {
+                'sent': direction_facet('sender', sent_cursor),
+                'recieved': direction_facet('recipient', recieved_cursor)
+            }}
+        ]
+
+    def hydrated_invitation_dict(self, item: dict):
+        """
+        Returns an invitation document with its ids as strings and the UserSummary class
+        of the other user under 'user', or None if that user no longer exists.
+        """
+        invitation = self.invitation_dict(item)
+        counterparts = item['counterpart_trainee'] + item['counterpart_trainer']
+        invitation['user'] = UserSummary(**counterparts[0]) if counterparts else None
+        return invitation
+
+    def list_user_invitations(self, user_id: str):
+        """
+        Returns the (sent, recieved) invitations of a user with the other user of each one
+        as a UserSummary under 'user', using a single aggregation.
+        """
+        listing = next(self.mongo.invitation.aggregate(self._invitation_listing_pipeline(user_id)))
+        return ([self.hydrated_invitation_dict(item) for item in listing['sent']],
+                [self.hydrated_invitation_dict(item) for item in listing['recieved']])
+
+    def list_user_invitations_page(self, user_id: str, limit: int = DEFAULT_PAGE_SIZE,
+                                   sent_cursor: str = None, recieved_cursor: str = None):
+        """
+        Returns (sent, recieved, next_sent_cursor, next_recieved_cursor) for one page of each
+        direction of list_user_invitations, still in a single aggregation.
+        """
+        listing = next(self.mongo.invitation.aggregate(self._invitation_listing_pipeline(
+            user_id, limit, sent_cursor, recieved_cursor)))
+
+        pages = []
+        for direction in ('sent', 'recieved'):
+            items = listing[direction]
+            next_cursor = None
+            if len(items) > int(limit):
+                items = items[:int(limit)]
+                next_cursor = encode_cursor([str(items[-1]['_id'])])
+            pages.append(([self.hydrated_invitation_dict(item) for item in items], next_cursor))
+
+        (sent, next_sent_cursor), (recieved, next_recieved_cursor) = pages
+        return sent, recieved, next_sent_cursor, next_recieved_cursor
+
+    def search_user_invitations_page(self, user_id: str, direction: str, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None):
+        """
+        Returns (invitations, next_cursor) for one page of the invitations a user has sent or recieved.
+            direction: str - 'sent' or 'recieved'.
+        """
+        found_invitations, next_cursor = self._find_page(
+            self.mongo.invitation, self.invitation_query(user_id, direction), limit, cursor)
+        return [self.invitation_dict(item) for item in found_invitations], next_cursor
 
     def accept_invitation(self, invitation_id: str, accepter_id: str):
         """
@@ -732,29 +1608,93 @@ class Database:
             invitation_id: str - The id of the invitation generated by mongodb.
             accepter_id: str - The id of the user that is accepting the id.
         """
-        invitation = self.mongo.invitation.find_one({
+        accepted = self._accept_invitations({
             '_id': ObjectId(invitation_id),
             'recipient': ObjectId(accepter_id)
         })
 
-        if invitation is None:
+        if accepted == 0:
             raise InvitationNotFound(
                 "Could not find a recipient with the given accepter id.")
 
-        sender = self.get_trainee_by_id(invitation['sender']) or\
-            self.get_trainer_by_id(invitation['sender'])
-        recipient = self.get_trainee_by_id(invitation['recipient']) or\
-            self.get_trainer_by_id(invitation['recipient'])
-
-        if type(sender) is Trainer:
-            self.trainer_add_trainee(sender._id, recipient._id)
-            self.trainee_add_trainer(recipient._id, sender._id)
+    def accept_invitations(self, invitation_ids: list, accepter_id: str):
+        """
+        Accepts every listed invitation recieved by the accepter at once.
+        Invitations that do not exist or were sent to someone else are skipped.
+        Returns the number of accepted invitations.
+        """
+        if not invitation_ids:
+            return 0
+        return self._accept_invitations({
+            '_id': {'$in': [ObjectId(id) for id in invitation_ids]},
+            'recipient': ObjectId(accepter_id)
+        })
 
-        elif type(sender) is Trainee:
-            self.trainee_add_trainer(sender._id, recipient._id)
-            self.trainer_add_trainee(recipient._id, sender._id)
+    def accept_all_invitations(self, accepter_id: str):
+        """Accepts every invitation recieved by the accepter. Returns the number accepted."""
+        return self._accept_invitations({'recipient': ObjectId(accepter_id)})
 
-        self.delete_invitation(invitation_id)
+    def _accept_invitations(self, query: dict):
+        """
+        Accepts the invitations matching the query.
+        One aggregation reads the invitations with the role of the sender and the recipient,
+        then one bulk write per collection links both sides and deletes the invitations,
+        inside a transaction when the deployment supports them.
+        Relationship updates are $addToSet so they are applied before the deletes
+        and are safe to repeat if a standalone server is interrupted in between.
+        """
+        def role_lookup(field, collection):
+            return {'$lookup': {
+                'from': collection,
+                'let': {'user_id': '$' + field},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$_id', '$$user_id']}}},
+                    {'$project': {'_id': 1}}
+                ],
+                'as': '{}_{}'.format(field, collection)
+            }}
+
+        invitations = list(self.mongo.invitation.aggregate([
+            {'$match': query},
+            role_lookup('sender', 'trainer'),
+            role_lookup('recipient', 'trainee'),
+            role_lookup('sender', 'trainee'),
+            role_lookup('recipient', 'trainer')
+        ]))
+        if not invitations:
+            return 0
+
+        trainee_updates = []
+        trainer_updates = []
+        linked_users = set()
+        for invitation in invitations:
+            if invitation['sender_trainer'] and invitation['recipient_trainee']:
+                trainer_id, trainee_id = invitation['sender'], invitation['recipient']
+            elif invitation['sender_trainee'] and invitation['recipient_trainer']:
+                trainee_id, trainer_id = invitation['sender'], invitation['recipient']
+            else:
+                # One of the users was removed, the invitation is only deleted
+                continue
+
+            trainer_updates.append(UpdateOne({'_id': trainer_id},
+                                             {'$addToSet': {'trainees': trainee_id}}))
+            trainee_updates.append(UpdateOne({'_id': trainee_id},
+                                             {'$addToSet': {'trainers': trainer_id}}))
+            linked_users.update([str(trainer_id), str(trainee_id)])
+
+        invitation_deletes = [DeleteOne({'_id': invitation['_id']}) for invitation in invitations]
+
+        def accept(session):
+            if trainer_updates:
+                self.mongo.trainer.bulk_write(trainer_updates, ordered=False, session=session)
+            if trainee_updates:
+                self.mongo.trainee.bulk_write(trainee_updates, ordered=False, session=session)
+            self.mongo.invitation.bulk_write(invitation_deletes, ordered=False, session=session)
+
+        self._write_transaction(accept)
+        for user_id in linked_users:
+            self.forget_user(user_id)
+        return len(invitations)
 
     def create_event(self, event: Event):
         """Creates an event document within the database using a passed Event class."""
@@ -765,6 +1705,8 @@ class Database:
         event_dict.pop('_id')
         event_dict['creator_id'] = ObjectId(event_dict['creator_id'])
         event_dict['participant_id'] = ObjectId(event_dict['participant_id'])
+        # Stored as a BSON datetime so schedules can be range filtered and sorted by date
+        event_dict['date'] = event.date
         self.mongo.event.insert_one(event_dict)
 
     def delete_event(self, event_id: str, creator_id: str):
@@ -784,49 +1726,127 @@ class Database:
         if 'participant_id' in kwargs:
             kwargs['participant_id'] = ObjectId(kwargs['participant_id'])
 
-        if 'date' in kwargs:
-            kwargs['date'] = str(kwargs['date'])
+        if 'date' in kwargs and type(kwargs['date']) is not datetime:
+            kwargs['date'] = datetime.fromisoformat(str(kwargs['date']))
 
         returned_value = self.mongo.event.find_one(kwargs)
 
         if returned_value is None:
             raise EventNotFound
 
-        returned_value['date'] = datetime.fromisoformat(returned_value['date'])
-        returned_value['_id'] = str(returned_value['_id'])
-        returned_value['creator_id'] = str(returned_value['creator_id'])
-        returned_value['participant_id'] = str(returned_value['participant_id'])
-        return Event(**returned_value)
+        return self.event_dict_to_class(returned_value)
+
+    def event_dict_to_class(self, event_dict: dict):
+        """Return an Event class from a dictionary"""
+        event_dict['_id'] = str(event_dict['_id'])
+        event_dict['creator_id'] = str(event_dict['creator_id'])
+        event_dict['participant_id'] = str(event_dict['participant_id'])
+        if type(event_dict['date']) is not datetime:
+            event_dict['date'] = datetime.fromisoformat(event_dict['date'])
+        return Event(**event_dict)
+
+    def get_dashboard_stats(self, user_id: str):
+        """
+        Returns the overview counts of a user:
+            created_events, recieved_events, workouts, completed_workouts,
+            sent_invitations and recieved_invitations.
+        Every count is a count_documents on the leading field of an owner index,
+        so the server answers it from the index without reading the documents.
+        """
+        user_id = ObjectId(user_id)
+        return {
+            'created_events': self.mongo.event.count_documents({'creator_id': user_id}),
+            'recieved_events': self.mongo.event.count_documents({'participant_id': user_id}),
+            'workouts': self.mongo.workout.count_documents({'creator_id': user_id}),
+            'completed_workouts': self.mongo.workout.count_documents({'creator_id': user_id,
+                                                                      'is_complete': True}),
+            'sent_invitations': self.mongo.invitation.count_documents({'sender': user_id}),
+            'recieved_invitations': self.mongo.invitation.count_documents({'recipient': user_id})
+        }
+
+    def list_events_in_range(self, user_id: str, start: datetime, end: datetime):
+        """
+        Returns the (created, recieved) events of a user dated from start up to, but excluding, end.
+        Both lists come from one query backed by the (creator_id, date) and
+        (participant_id, date) indexes and are ordered by date.
+        """
+        user_id = ObjectId(user_id)
+        date_range = {'$gte': start, '$lt': end}
+        found_events = self.mongo.event.find({
+            '$or': [
+                {'creator_id': user_id, 'date': date_range},
+                {'participant_id': user_id, 'date': date_range}
+            ]
+        }).sort([('date', 1), ('_id', 1)])
+
+        created_events = []
+        recieved_events = []
+        for event in found_events:
+            # A user who invites themself sees the event in both lists
+            if event['creator_id'] == user_id:
+                created_events.append(self.event_dict_to_class(dict(event)))
+            if event['participant_id'] == user_id:
+                recieved_events.append(self.event_dict_to_class(dict(event)))
+        return created_events, recieved_events
 
     def list_events_from_user_id(self, user_id: str):
         """Returns the created and invited events"""
-        # Get created events as Event objects
-        created_events = self.mongo.event.find({
-            'creator_id': ObjectId(user_id)
-        })
+        created_event_classes = list(self.iter_events_from_user_id(user_id, 'created'))
+        recieved_event_classes = list(self.iter_events_from_user_id(user_id, 'recieved'))
+        return created_event_classes, recieved_event_classes
 
-        created_event_classes = []
-        for event in created_events:
-            event['_id'] = str(event['_id'])
-            event['creator_id'] = str(event['creator_id'])
-            event['participant_id'] = str(event['participant_id'])
-            event['date'] = datetime.fromisoformat(event['date'])
-            created_event_classes.append(Event(**event))
-
-        # Get recieved events as Event objects
-        recieved_events = self.mongo.event.find({
-            'participant_id': ObjectId(user_id)
-        })
+    def event_query(self, user_id: str, direction: str):
+        """
+        Returns the find query of a user's events.
+            direction: str - 'created' or 'recieved'.
+        """
+        field = 'creator_id' if direction == 'created' else 'participant_id'
+        return {field: ObjectId(user_id)}
 
-        recieved_event_classes = []
-        for event in recieved_events:
-            event['_id'] = str(event['_id'])
-            event['creator_id'] = str(event['creator_id'])
-            event['participant_id'] = str(event['participant_id'])
-            event['date'] = datetime.fromisoformat(event['date'])
-            recieved_event_classes.append(Event(**event))
+    def iter_events_from_user_id(self, user_id: str, direction: str):
+        """
+        Lazily yields the Event classes a user has created or was invited to.
+            direction: str - 'created' or 'recieved'.
+        """
+        for event in self._iter_find(self.mongo.event, self.event_query(user_id, direction)):
+            yield self.event_dict_to_class(event)
 
-        return created_event_classes, recieved_event_classes
+    def list_events_page_from_user_id(self, user_id: str, direction: str, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None):
+        """
+        Returns (events, next_cursor) for one page of the events a user has created or was invited to.
+            direction: str - 'created' or 'recieved'.
+        """
+        found_events, next_cursor = self._find_page(
+            self.mongo.event, self.event_query(user_id, direction), limit, cursor)
+        return [self.event_dict_to_class(event) for event in found_events], next_cursor
+
+    """Youtube Cache Functions"""
+
+    def get_youtube_videos(self, topic: str):
+        """Returns (videos, fetched_at) cached for a Youtube search topic, or None if not cached."""
+        found = self.mongo.youtube_cache.find_one({'_id': topic})
+        if found is None:
+            return None
+        return found['videos'], found['fetched_at']
+
+    def set_youtube_videos(self, topic: str, videos: list, fetched_at: datetime, expire_at: datetime):
+        """
+        Stores the trimmed videos of a Youtube search topic, see vitality.youtube.trim_search_result.
+        The TTL index removes the document once expire_at has passed.
+        """
+        self.mongo.youtube_cache.replace_one(
+            {'_id': topic},
+            {
+                'videos': videos,
+                'fetched_at': fetched_at,
+                'expire_at': expire_at
+            },
+            upsert=True)
+
+
+class InvalidCursor(ValueError):
+    """Error for a pagination cursor that could not be decoded"""
+    pass
 
 
 class EventNotFound(ValueError):
@@ -839,6 +1859,11 @@ class UsernameTakenError(ValueError):
     pass
 
 
+class InvalidProfileFieldError(ValueError):
+    """If a profile update names an unknown field or role"""
+    pass
+
+
 class UserNotFoundError(ValueError):
     """If a username was taken within the database class"""
     pass
@@ -0,0 +1,336 @@
+from .settings import (
+    JOB_WORKERS,
+    JOB_POLL_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_LEASE_SECONDS,
+    YOUTUBE_PREFETCH_JITTER_SECONDS)
+from .youtube import youtube_cache, prefetch_interval, YOUTUBE_TOPICS
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from threading import BoundedSemaphore, Lock, Thread, Event as ThreadEvent
+from time import time
+import atexit
+import logging
+import os
+import random
+import socket
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+DEFAULT_JOB_WORKERS = 4
+DEFAULT_JOB_POLL_SECONDS = 1.0
+DEFAULT_JOB_MAX_ATTEMPTS = 5
+DEFAULT_JOB_LEASE_SECONDS = 300
+MAX_JOB_BACKOFF_SECONDS = 3600
+
+# Finished jobs are kept this long so their idempotency keys keep rejecting duplicates
+FINISHED_JOB_RETENTION = timedelta(days=7)
+
+# The reference cleanup of a deleted account is enqueued before the account is removed
+# and runs this long after, so a crash in between can not orphan the references
+REMOVE_USER_REFERENCES_DELAY_SECONDS = 30
+
+
+def job_backoff(attempts: int):
+    """Seconds to wait before retrying a job that failed attempts times."""
+    return min(2 ** attempts, MAX_JOB_BACKOFF_SECONDS)
+
+
+class JobRunner:
+    """
+    Runs deferred work on a bounded thread pool, fed by the Mongo 'job' collection.
+    Jobs are persisted before they run, so they survive worker restarts. A job whose
+    lease expires while 'running' is picked up again by any worker process.
+    Failed jobs are retried with exponential backoff up to max_attempts, and jobs
+    enqueued with the same idempotency key are only stored once.
+    """
+
+    def __init__(self,
+                 workers: int = DEFAULT_JOB_WORKERS,
+                 poll_interval: float = DEFAULT_JOB_POLL_SECONDS,
+                 max_attempts: int = DEFAULT_JOB_MAX_ATTEMPTS,
+                 lease_seconds: float = DEFAULT_JOB_LEASE_SECONDS):
+        """Constructor for JobRunner class."""
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.tasks = {}
+        self._lock = Lock()
+        self._pid = None
+        self._dispatcher = None
+        self._executor = None
+        self._slots = None
+        self._stop = ThreadEvent()
+        self._wake = ThreadEvent()
+
+    def task(self, name: str):
+        """Decorator registering function(database, **kwargs) as the task called name."""
+        def register(function):
+            self.tasks[name] = function
+            return function
+        return register
+
+    def enqueue(self, database, name: str, key: str = None, delay: float = 0, **kwargs):
+        """
+        Stores a job calling the task name with kwargs and returns its id as a string.
+        With a key, a job already stored under the same key is kept and its id returned.
+        kwargs must be BSON serializable.
+        """
+        if name not in self.tasks:
+            raise UnknownJobError("No task is registered as {}.".format(name))
+
+        now = datetime.utcnow()
+        job = {
+            'name': name,
+            'kwargs': kwargs,
+            'status': JOB_PENDING,
+            'attempts': 0,
+            'run_at': now + timedelta(seconds=delay),
+            'created_at': now
+        }
+        if key is not None:
+            job['key'] = key
+
+        try:
+            inserted = database.mongo.job.insert_one(job)
+        except DuplicateKeyError:
+            return str(database.mongo.job.find_one({'key': key}, {'_id': 1})['_id'])
+
+        self._wake.set()
+        return str(inserted.inserted_id)
+
+    def claim(self, database):
+        """
+        Atomically leases the next due job to this process and returns it, or None.
+        Pending jobs are due at their run_at, running jobs once their lease has expired.
+        Only jobs of tasks registered on this runner are claimed.
+        """
+        now = datetime.utcnow()
+        return database.mongo.job.find_one_and_update(
+            {'name': {'$in': list(self.tasks)}, '$or': [
+                {'status': JOB_PENDING, 'run_at': {'$lte': now}},
+                {'status': JOB_RUNNING, 'locked_until': {'$lte': now}}
+            ]},
+            {
+                '$set': {
+                    'status': JOB_RUNNING,
+                    'locked_by': '{}:{}'.format(socket.gethostname(), os.getpid()),
+                    'locked_until': now + timedelta(seconds=self.lease_seconds)
+                },
+                '$inc': {
+                    'attempts': 1
+                }
+            },
+            sort=[('run_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def run(self, database, job: dict):
+        """Runs a claimed job and records its success, its next retry or its failure."""
+        try:
+            self.tasks[job['name']](database, **job['kwargs'])
+        except Exception as error:
+            logger.exception('Job {} {} failed'.format(job['name'], job['_id']))
+            now = datetime.utcnow()
+            if job['attempts'] < self.max_attempts and job['name'] in self.tasks:
+                update = {
+                    'status': JOB_PENDING,
+                    'run_at': now + timedelta(seconds=job_backoff(job['attempts'])),
+                    'last_error': repr(error)
+                }
+            else:
+                update = {
+                    'status': JOB_FAILED,
+                    'finished_at': now,
+                    'expire_at': now + FINISHED_JOB_RETENTION,
+                    'last_error': repr(error)
+                }
+        else:
+            now = datetime.utcnow()
+            update = {
+                'status': JOB_DONE,
+                'finished_at': now,
+                'expire_at': now + FINISHED_JOB_RETENTION
+            }
+
+        database.mongo.job.update_one(
+            {'_id': job['_id']},
+            {
+                '$set': update,
+                '$unset': {
+                    'locked_by': '',
+                    'locked_until': ''
+                }
+            })
+
+    def release(self, database, job: dict):
+        """Hands a claimed job that was never started back to the queue, due immediately."""
+        try:
+            database.mongo.job.update_one(
+                {'_id': job['_id'], 'status': JOB_RUNNING},
+                {
+                    '$set': {
+                        'status': JOB_PENDING,
+                        'run_at': datetime.utcnow()
+                    },
+                    '$unset': {
+                        'locked_by': '',
+                        'locked_until': ''
+                    },
+                    '$inc': {
+                        'attempts': -1
+                    }
+                })
+        except Exception:
+            logger.exception('Could not release job {}, it is retried once its lease expires'.format(job['_id']))
+
+    def run_pending(self, database):
+        """Runs every due job on the calling thread. Returns the number of jobs run."""
+        count = 0
+        job = self.claim(database)
+        while job is not None:
+            self.run(database, job)
+            count += 1
+            job = self.claim(database)
+        return count
+
+    def start(self, database_factory):
+        """
+        Starts the dispatcher thread and the worker pool of this process.
+        database_factory is called once per job so every job uses a Database of the current process.
+        Does nothing if already running in this process or if workers is 0.
+        """
+        with self._lock:
+            if self.workers <= 0 or self._pid == os.getpid():
+                return
+
+            # Threads do not survive a fork, a child process starts its own
+            self._pid = os.getpid()
+            self._stop = ThreadEvent()
+            self._wake = ThreadEvent()
+            self._slots = BoundedSemaphore(self.workers)
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='job-worker')
+            self._dispatcher = Thread(target=self._dispatch,
+                                      args=(database_factory,),
+                                      name='job-dispatcher',
+                                      daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self, database_factory):
+        """Claims due jobs while a worker slot is free, sleeping poll_interval when idle."""
+        while not self._stop.is_set():
+            if not self._slots.acquire(timeout=self.poll_interval):
+                continue
+
+            try:
+                database = database_factory()
+                job = self.claim(database)
+            except Exception:
+                logger.exception('Could not claim a job')
+                job = None
+
+            if job is None:
+                self._slots.release()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+
+            try:
+                self._executor.submit(self._work, database, job)
+            except RuntimeError:
+                # The pool was shut down under us, hand the job back instead of leaving it leased
+                logger.warning('Job pool is shut down, releasing job {}'.format(job['_id']))
+                self._slots.release()
+                self.release(database, job)
+                return
+
+    def _work(self, database, job: dict):
+        try:
+            self.run(database, job)
+        except Exception:
+            logger.exception('Could not record the result of job {}'.format(job['_id']))
+        finally:
+            self._slots.release()
+
+    def stop(self, timeout: float = None):
+        """
+        Drains the runner: stops claiming jobs, waits up to timeout seconds for the
+        dispatcher and then for every running job to finish. Pending jobs stay queued
+        for the next process, and a job killed mid run is retried once its lease expires.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._stop.set()
+            self._wake.set()
+            self._dispatcher.join(timeout)
+            self._executor.shutdown(wait=True)
+            self._pid = None
+
+    def stats(self, database):
+        """Returns the number of jobs per status."""
+        counts = {JOB_PENDING: 0, JOB_RUNNING: 0, JOB_DONE: 0, JOB_FAILED: 0}
+        for status in database.mongo.job.aggregate([
+                {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[status['_id']] = status['count']
+        return counts
+
+
+class UnknownJobError(ValueError):
+    """If a job names a task that is not registered"""
+    pass
+
+
+class UserNotRemovedError(RuntimeError):
+    """If the references of a user are to be removed while the user still exists"""
+    pass
+
+
+jobs = JobRunner(JOB_WORKERS, JOB_POLL_SECONDS, JOB_MAX_ATTEMPTS, JOB_LEASE_SECONDS)
+atexit.register(jobs.stop)
+
+
+@jobs.task('remove_user_references')
+def remove_user_references(database, role: str, user_id: str):
+    """
+    Deferred cascade of a removed user's account deletion.
+    The job is stored before the account is removed, it is retried while the account still exists.
+    """
+    if database.find_user({'_id': ObjectId(user_id)}) is not None:
+        raise UserNotRemovedError('User {} still exists.'.format(user_id))
+    database.remove_user_references(role, user_id)
+
+
+def schedule_youtube_prefetch(database, next_interval: bool = False):
+    """
+    Enqueues the prefetch of every Youtube topic for the current interval, or at a
+    jittered time in the next one. The job key names the interval, so however many
+    processes schedule it the topics are fetched once per interval.
+    """
+    interval = prefetch_interval(len(YOUTUBE_TOPICS))
+    slot = int(time() // interval)
+    delay = 0
+    if next_interval:
+        slot += 1
+        delay = slot * interval - time() + random.uniform(0, YOUTUBE_PREFETCH_JITTER_SECONDS)
+
+    return jobs.enqueue(database, 'prefetch_youtube_topics',
+                        key='prefetch_youtube_topics:{}'.format(slot),
+                        delay=delay)
+
+
+@jobs.task('prefetch_youtube_topics')
+def prefetch_youtube_topics(database):
+    """Refreshes every Youtube topic in the shared cache, then schedules the next run."""
+    schedule_youtube_prefetch(database, next_interval=True)
+    fetched = youtube_cache.prefetch(YOUTUBE_TOPICS)
+    logger.info('Prefetched {} of {} Youtube topics'.format(fetched, len(YOUTUBE_TOPICS)))
@@ -0,0 +1,22 @@
+class MapPin:
+    """Read only view of a trainer drawn as a marker on the nearby trainers map."""
+
+    def __init__(self,
+                 _id: str,
+                 username: str,
+                 lng: float,
+                 lat: float,
+                 distance: float = None):
+        """Constructor for MapPin class."""
+        self._id = str(_id)
+        self.username = str(username)
+        self.lng = lng
+        self.lat = lat
+        self.distance = distance
+
+    def as_dict(self):
+        """Returns all attributes of the MapPin class as a dictionary."""
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return f'MapPin({self._id}, {self.username}, {self.lng}, {self.lat}, {self.distance})'
@@ -0,0 +1,235 @@
+from .database import search_grams
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, TEXT, IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
+
+MIGRATION_DOCUMENT_ID = 'schema'
+
+
+def _initial_indexes(mongo):
+    """Indexes behind every hot lookup made by the Database class."""
+    mongo.trainee.create_indexes([
+        IndexModel([('location', GEOSPHERE)], name='trainee_search_index', default_language='english'),
+        IndexModel([('username', ASCENDING)], name='trainee_username_index')
+    ])
+    mongo.trainer.create_indexes([
+        IndexModel([('location', GEOSPHERE)], name='trainer_search_index', default_language='english'),
+        IndexModel([('username', ASCENDING)], name='trainer_username_index')
+    ])
+    mongo.workout.create_indexes([
+        IndexModel([('creator_id', ASCENDING), ('name', ASCENDING)], name='workout_creator_name_index')
+    ])
+    mongo.invitation.create_indexes([
+        IndexModel([('sender', ASCENDING)], name='invitation_sender_index'),
+        IndexModel([('recipient', ASCENDING)], name='invitation_recipient_index')
+    ])
+    mongo.event.create_indexes([
+        IndexModel([('creator_id', ASCENDING)], name='event_creator_index'),
+        IndexModel([('participant_id', ASCENDING)], name='event_participant_index')
+    ])
+
+
+def _user_search_grams(mongo):
+    """Indexes the username and name grams used by the user search and fills them in."""
+    for collection in (mongo.trainee, mongo.trainer):
+        collection.create_indexes([
+            IndexModel([('username_grams', ASCENDING)], name='username_grams_index'),
+            IndexModel([('name_grams', ASCENDING)], name='name_grams_index')
+        ])
+
+        updates = []
+        for user in collection.find({}, {'username': 1, 'name': 1}):
+            updates.append(UpdateOne({'_id': user['_id']}, {
+                '$set': {
+                    'username_grams': search_grams(user.get('username', '')),
+                    'name_grams': search_grams(user.get('name', ''))
+                }
+            }))
+            if len(updates) == 1000:
+                collection.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+
+
+def _workout_text_index(mongo):
+    """Full text index used by Database.search_workouts."""
+    mongo.workout.create_indexes([
+        IndexModel([('name', TEXT), ('about', TEXT), ('category', TEXT)],
+                   name='workout_text_index',
+                   weights={'name': 10, 'category': 5, 'about': 1},
+                   default_language='english')
+    ])
+
+
+def _keyset_indexes(mongo):
+    """
+    (owner, _id) indexes behind the keyset pages of workouts, invitations and events.
+    They replace the single field owner indexes, which they cover as a prefix.
+    """
+    mongo.workout.create_indexes([
+        IndexModel([('creator_id', ASCENDING), ('_id', ASCENDING)], name='workout_creator_page_index')
+    ])
+    mongo.invitation.create_indexes([
+        IndexModel([('sender', ASCENDING), ('_id', ASCENDING)], name='invitation_sender_page_index'),
+        IndexModel([('recipient', ASCENDING), ('_id', ASCENDING)], name='invitation_recipient_page_index')
+    ])
+    mongo.event.create_indexes([
+        IndexModel([('creator_id', ASCENDING), ('_id', ASCENDING)], name='event_creator_page_index'),
+        IndexModel([('participant_id', ASCENDING), ('_id', ASCENDING)], name='event_participant_page_index')
+    ])
+
+    for collection, name in ((mongo.invitation, 'invitation_sender_index'),
+                             (mongo.invitation, 'invitation_recipient_index'),
+                             (mongo.event, 'event_creator_index'),
+                             (mongo.event, 'event_participant_index')):
+        try:
+            collection.drop_index(name)
+        except OperationFailure:
+            # Already dropped by an earlier, interrupted run.
+            pass
+
+
+def find_duplicate_usernames(collection):
+    """Returns {username: number of users} for every username held by more than one user."""
+    return {duplicate['_id']: duplicate['count'] for duplicate in collection.aggregate([
+        {'$group': {'_id': '$username', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)}
+
+
+def _unique_usernames(mongo):
+    """
+    Makes usernames unique so concurrent signups and renames cannot collide.
+    The unique index is built on a descending key so it can coexist with the
+    non unique index of migration 1, which is only dropped once it is replaced.
+    """
+    for collection, role in ((mongo.trainee, 'trainee'), (mongo.trainer, 'trainer')):
+        duplicates = find_duplicate_usernames(collection)
+        if duplicates:
+            raise MigrationError('Duplicate {} usernames must be renamed before usernames can be unique: {}'.format(
+                role, ', '.join('{} ({} users)'.format(username, count)
+                                for username, count in sorted(duplicates.items(), key=str))))
+
+        collection.create_indexes([
+            IndexModel([('username', DESCENDING)], name='{}_username_unique_index'.format(role), unique=True)
+        ])
+        try:
+            collection.drop_index('{}_username_index'.format(role))
+        except OperationFailure:
+            # Already dropped by an earlier, interrupted run.
+            pass
+
+
+def _event_datetimes(mongo):
+    """Converts string event dates to BSON datetimes and indexes them per user."""
+    updates = []
+    for event in mongo.event.find({'date': {'$type': 'string'}}, {'date': 1}):
+        updates.append(UpdateOne({'_id': event['_id']}, {
+            '$set': {
+                'date': datetime.fromisoformat(event['date'])
+            }
+        }))
+        if len(updates) == 1000:
+            mongo.event.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        mongo.event.bulk_write(updates, ordered=False)
+
+    mongo.event.create_indexes([
+        IndexModel([('creator_id', ASCENDING), ('date', ASCENDING)], name='event_creator_date_index'),
+        IndexModel([('participant_id', ASCENDING), ('date', ASCENDING)], name='event_participant_date_index')
+    ])
+
+
+def _relationship_indexes(mongo):
+    """Multikey indexes used to find the counterparts of a removed user."""
+    mongo.trainee.create_indexes([
+        IndexModel([('trainers', ASCENDING)], name='trainee_trainers_index')
+    ])
+    mongo.trainer.create_indexes([
+        IndexModel([('trainees', ASCENDING)], name='trainer_trainees_index')
+    ])
+
+
+def _job_queue(mongo):
+    """Indexes of the background job queue, see vitality.jobs."""
+    mongo.job.create_indexes([
+        IndexModel([('key', ASCENDING)], name='job_key_index', unique=True,
+                   partialFilterExpression={'key': {'$exists': True}}),
+        IndexModel([('status', ASCENDING), ('run_at', ASCENDING)], name='job_due_index'),
+        IndexModel([('status', ASCENDING), ('locked_until', ASCENDING)], name='job_lease_index'),
+        IndexModel([('expire_at', ASCENDING)], name='job_expire_index', expireAfterSeconds=0)
+    ])
+
+
+def _youtube_cache(mongo):
+    """Expire cached Youtube search results, see vitality.youtube.CachedYoutube."""
+    mongo.youtube_cache.create_index([('expire_at', ASCENDING)],
+                                     name='youtube_cache_expire_index',
+                                     expireAfterSeconds=0)
+
+
+def _workout_completion_index(mongo):
+    """(creator_id, is_complete) index that answers the completed workout count of the overview."""
+    mongo.workout.create_indexes([
+        IndexModel([('creator_id', ASCENDING), ('is_complete', ASCENDING)], name='workout_creator_complete_index')
+    ])
+
+
+"""
+Ordered list of (version, description, function) tuples.
+Every function must be idempotent, a migration can be re-run safely
+if a worker dies before the schema version is recorded.
+"""
+MIGRATIONS = [
+    (1, 'Create user, workout, invitation and event indexes', _initial_indexes),
+    (2, 'Index and backfill user search grams', _user_search_grams),
+    (3, 'Create the workout full text index', _workout_text_index),
+    (4, 'Replace owner indexes with (owner, _id) keyset indexes', _keyset_indexes),
+    (5, 'Make the username indexes unique', _unique_usernames),
+    (6, 'Store event dates as datetimes and index them per user', _event_datetimes),
+    (7, 'Index the trainee and trainer relationship arrays', _relationship_indexes),
+    (8, 'Create the background job queue indexes', _job_queue),
+    (9, 'Expire the shared Youtube search cache', _youtube_cache),
+    (10, 'Index completed workouts per creator', _workout_completion_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(database):
+    """Returns the last migration version applied to the database."""
+    document = database.mongo.migration.find_one({'_id': MIGRATION_DOCUMENT_ID})
+    return document['version'] if document is not None else 0
+
+
+def list_pending_migrations(database):
+    """Returns the (version, description, function) tuples not yet applied."""
+    version = get_schema_version(database)
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def migrate(database):
+    """
+    Applies every pending migration in order.
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    for version, description, function in list_pending_migrations(database):
+        function(database.mongo)
+        database.mongo.migration.update_one(
+            {'_id': MIGRATION_DOCUMENT_ID},
+            {
+                '$max': {
+                    'version': version
+                }
+            },
+            upsert=True)
+        applied.append(version)
+    return applied
+
+
+class MigrationError(Exception):
+    """If a migration can not be applied until the data is fixed by hand"""
+    pass
@@ -7,3 +7,61 @@ SECRET_KEY = environ.get('SECRET_KEY')
 MONGO_URI = environ.get('MONGO_URI')
 GOOGLE_MAPS_KEY = environ.get('GOOGLE_MAPS_KEY')
 GOOGLE_YOUTUBE_KEY = environ.get('GOOGLE_YOUTUBE_KEY')
+
+# Apply pending index migrations when the app starts instead of only warning.
+# Off by default so "flask migrate --check" sees the real pending state, deploys run "flask migrate"
+MONGO_MIGRATE_ON_STARTUP = (environ.get('MONGO_MIGRATE_ON_STARTUP') or 'false').lower() == 'true'
+
+# MongoClient connection pool, shared by every Database within a worker process
+MONGO_MAX_POOL_SIZE = int(environ.get('MONGO_MAX_POOL_SIZE') or 100)
+MONGO_MIN_POOL_SIZE = int(environ.get('MONGO_MIN_POOL_SIZE') or 0)
+MONGO_MAX_IDLE_TIME_MS = int(environ.get('MONGO_MAX_IDLE_TIME_MS') or 60000)
+MONGO_CONNECT_TIMEOUT_MS = int(environ.get('MONGO_CONNECT_TIMEOUT_MS') or 20000)
+MONGO_SOCKET_TIMEOUT_MS = int(environ.get('MONGO_SOCKET_TIMEOUT_MS') or 30000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS') or 30000)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS') or 10000)
+
+# Process wide cache of users by id, a size of 0 disables it
+USER_CACHE_SIZE = int(environ.get('USER_CACHE_SIZE') or 1024)
+USER_CACHE_TTL = float(environ.get('USER_CACHE_TTL') or 30)
+
+# Seconds between rebuilds of the in memory autocomplete indexes, 0 disables rebuilding
+AUTOCOMPLETE_REFRESH_SECONDS = float(environ.get('AUTOCOMPLETE_REFRESH_SECONDS') or 300)
+
+# Nearest trainers shown on the /nearby_trainers map and the radius searched in meters
+NEARBY_TRAINERS_LIMIT = int(environ.get('NEARBY_TRAINERS_LIMIT') or 25)
+NEARBY_TRAINERS_RADIUS = float(environ.get('NEARBY_TRAINERS_RADIUS') or 50000)
+
+# Background jobs, a JOB_WORKERS of 0 leaves queued jobs to other processes
+JOB_WORKERS = int(environ.get('JOB_WORKERS') or 4)
+JOB_POLL_SECONDS = float(environ.get('JOB_POLL_SECONDS') or 1)
+JOB_MAX_ATTEMPTS = int(environ.get('JOB_MAX_ATTEMPTS') or 5)
+JOB_LEASE_SECONDS = float(environ.get('JOB_LEASE_SECONDS') or 300)
+
+# Youtube search results cached per topic: fresh for TTL seconds, then served stale
+# for STALE_SECONDS while refreshed in the background. Failures are cached for ERROR_TTL
+YOUTUBE_CACHE_SIZE = int(environ.get('YOUTUBE_CACHE_SIZE') or 64)
+YOUTUBE_CACHE_TTL = float(environ.get('YOUTUBE_CACHE_TTL') or 3600)
+YOUTUBE_CACHE_STALE_SECONDS = float(environ.get('YOUTUBE_CACHE_STALE_SECONDS') or 86400)
+YOUTUBE_CACHE_ERROR_TTL = float(environ.get('YOUTUBE_CACHE_ERROR_TTL') or 60)
+
+# Youtube API client: pooled connections, timeouts in seconds and retries of failed
+# connections or server errors. The circuit opens after BREAKER_FAILURES failures in
+# a row and falls back to the default videos for BREAKER_RESET_SECONDS
+YOUTUBE_POOL_SIZE = int(environ.get('YOUTUBE_POOL_SIZE') or 10)
+YOUTUBE_CONNECT_TIMEOUT = float(environ.get('YOUTUBE_CONNECT_TIMEOUT') or 3.05)
+YOUTUBE_READ_TIMEOUT = float(environ.get('YOUTUBE_READ_TIMEOUT') or 5)
+YOUTUBE_RETRIES = int(environ.get('YOUTUBE_RETRIES') or 2)
+YOUTUBE_BREAKER_FAILURES = int(environ.get('YOUTUBE_BREAKER_FAILURES') or 5)
+YOUTUBE_BREAKER_RESET_SECONDS = float(environ.get('YOUTUBE_BREAKER_RESET_SECONDS') or 60)
+
+# Seconds a search may take, retries included, when many topics are searched at once
+YOUTUBE_SEARCH_DEADLINE = float(environ.get('YOUTUBE_SEARCH_DEADLINE') or 10)
+
+# Youtube topics are refreshed by a background job every PREFETCH_SECONDS, plus up to
+# PREFETCH_JITTER_SECONDS, on PREFETCH_WORKERS threads. The interval is stretched to
+# stay within DAILY_QUOTA units. A PREFETCH_SECONDS of 0 fetches topics on demand
+YOUTUBE_PREFETCH_SECONDS = float(environ.get('YOUTUBE_PREFETCH_SECONDS') or 3600)
+YOUTUBE_PREFETCH_JITTER_SECONDS = float(environ.get('YOUTUBE_PREFETCH_JITTER_SECONDS') or 300)
+YOUTUBE_PREFETCH_WORKERS = int(environ.get('YOUTUBE_PREFETCH_WORKERS') or 3)
+YOUTUBE_DAILY_QUOTA = int(environ.get('YOUTUBE_DAILY_QUOTA') or 10000)
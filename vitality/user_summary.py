@@ -0,0 +1,24 @@
+class UserSummary:
+    """
+    Read only view of a Trainee or Trainer holding only what lists and links display.
+    Built from a projected query, so it never carries the password, the body
+    metrics or the relationship arrays.
+    """
+
+    def __init__(self,
+                 _id: str,
+                 username: str,
+                 name: str = None,
+                 role: str = None):
+        """Constructor for UserSummary class."""
+        self._id = str(_id)
+        self.username = str(username)
+        self.name = None if name is None else str(name)
+        self.role = role
+
+    def as_dict(self):
+        """Returns all attributes of the UserSummary class as a dictionary."""
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return f'UserSummary({self._id}, {self.username}, {self.name}, {self.role})'
@@ -1,31 +1,225 @@
+from .cache import LRUCache
+from .settings import (
+    GOOGLE_YOUTUBE_KEY,
+    YOUTUBE_CACHE_SIZE,
+    YOUTUBE_CACHE_TTL,
+    YOUTUBE_CACHE_STALE_SECONDS,
+    YOUTUBE_CACHE_ERROR_TTL,
+    YOUTUBE_CONNECT_TIMEOUT,
+    YOUTUBE_READ_TIMEOUT,
+    YOUTUBE_RETRIES,
+    YOUTUBE_POOL_SIZE,
+    YOUTUBE_BREAKER_FAILURES,
+    YOUTUBE_BREAKER_RESET_SECONDS,
+    YOUTUBE_PREFETCH_SECONDS,
+    YOUTUBE_PREFETCH_WORKERS,
+    YOUTUBE_DAILY_QUOTA,
+    YOUTUBE_SEARCH_DEADLINE)
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from threading import Lock, Thread
+from time import monotonic
+from urllib3.util.retry import Retry
+import asyncio
+import logging
+import os
 import requests
 
+logger = logging.getLogger(__name__)
+
 YOUTUBE_SEARCH_URL = 'https://www.googleapis.com/youtube/v3/search'
 
+# Server errors worth retrying, quota errors (403) are not
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+QUOTA_ERROR_REASONS = ('quotaExceeded', 'dailyLimitExceeded', 'rateLimitExceeded', 'userRateLimitExceeded')
+
+# Quota units charged for every search.list call
+SEARCH_QUOTA_COST = 100
+
+WORKOUT_TOPICS = [
+    'Abs Workout Routine',
+    'Legs Workout Routine',
+    'Full Body Workout'
+]
+
+DIET_TOPICS = [
+    'Low Carb Recipe',
+    'Paleo Carb Recipe',
+    'High Protein Recipe',
+    'Weight Watchers Recipe',
+    'Sugar Free Recipe',
+    'Vegan Recipe']
+
+"""Every topic searched by the app, kept warm by the prefetch job."""
+YOUTUBE_TOPICS = WORKOUT_TOPICS + DIET_TOPICS
+
+
+def prefetch_interval(topic_count: int, seconds: float = YOUTUBE_PREFETCH_SECONDS,
+                      daily_quota: int = YOUTUBE_DAILY_QUOTA):
+    """
+    Returns the seconds between two prefetches of topic_count topics.
+    The interval is stretched past seconds when refreshing every topic that often
+    would spend more than the daily quota.
+    """
+    return max(seconds, 86400 * topic_count * SEARCH_QUOTA_COST / daily_quota)
+
+
+def new_youtube_session(pool_size: int = YOUTUBE_POOL_SIZE, retries: int = YOUTUBE_RETRIES):
+    """
+    Returns a requests Session keeping up to pool_size connections alive.
+    Failed connections and server errors are retried up to retries times with
+    a short backoff. Reads are not retried so a slow API costs one read timeout.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries,
+                                            connect=retries,
+                                            read=0,
+                                            status=retries,
+                                            backoff_factor=0.1,
+                                            status_forcelist=RETRY_STATUS_CODES,
+                                            allowed_methods=frozenset(['GET']),
+                                            raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_session = None
+_session_lock = Lock()
+
+
+def get_youtube_session():
+    """Returns the Session shared by every Youtube client of this process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = new_youtube_session()
+        return _session
+
+
+def is_quota_error(response):
+    """Returns True if a Youtube error response reports an exhausted quota or rate limit."""
+    try:
+        errors = response.json()['error']['errors']
+    except (ValueError, KeyError, TypeError):
+        return response.status_code == 429
+    return any(error.get('reason') in QUOTA_ERROR_REASONS for error in errors)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service. After failure_threshold consecutive failures
+    the circuit opens and calls are refused for reset_seconds. Then a single
+    trial call is let through, closing the circuit on success or reopening it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 60):
+        """Constructor for CircuitBreaker class."""
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.reset()
+
+    def reset(self):
+        """Closes the circuit and drops its lock. Used after a fork."""
+        self._lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half-open'."""
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if monotonic() - self.opened_at < self.reset_seconds:
+                return 'open'
+            return 'half-open'
+
+    def allow(self):
+        """Returns True if a call may be made now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if monotonic() - self.opened_at < self.reset_seconds or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+            self._trial = False
+
 
 class Youtube:
+    """
+    Client of the Youtube search API.
+    Requests go through a pooled Session with (connect, read) timeouts, and a
+    CircuitBreaker refuses them with YoutubeCircuitOpen while the API keeps failing.
+    """
 
-    def __init__(self, developerKey):
+    def __init__(self,
+                 developerKey,
+                 session: requests.Session = None,
+                 timeout: tuple = (YOUTUBE_CONNECT_TIMEOUT, YOUTUBE_READ_TIMEOUT),
+                 breaker: CircuitBreaker = None,
+                 search_url: str = YOUTUBE_SEARCH_URL):
         self.developerKey = developerKey
+        self.session = session
+        self.timeout = timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker(
+            YOUTUBE_BREAKER_FAILURES, YOUTUBE_BREAKER_RESET_SECONDS)
+        self.search_url = search_url
 
     def search_topic(self, topic: str):
+        if not self.breaker.allow():
+            raise YoutubeCircuitOpen('Circuit open')
 
-        returned_value = requests.get(YOUTUBE_SEARCH_URL,
-                                      headers={
-                                          'Accept': 'application/json'
-                                      },
-                                      params={
-                                          'part': "snippet",
-                                          'maxResults': 6,
-                                          'q': topic,
-                                          'key': self.developerKey
-                                      })
-
-        if returned_value.status_code == 200:
-            return returned_value.json()
-        else:
-            raise YoutubeRequestFailed(
+        session = self.session if self.session is not None else get_youtube_session()
+        try:
+            returned_value = session.get(self.search_url,
+                                         headers={
+                                             'Accept': 'application/json'
+                                         },
+                                         params={
+                                             'part': "snippet",
+                                             'maxResults': 6,
+                                             'q': topic,
+                                             'key': self.developerKey
+                                         },
+                                         timeout=self.timeout)
+            if returned_value.status_code == 200:
+                result = returned_value.json()
+                self.breaker.record_success()
+                return result
+        except (requests.RequestException, ValueError) as error:
+            self.breaker.record_failure()
+            raise YoutubeRequestFailed('Request failed: {!r}'.format(error))
+
+        self.breaker.record_failure()
+        if returned_value.status_code in (403, 429) and is_quota_error(returned_value):
+            raise YoutubeQuotaExceeded(
                 'Status == {}'.format(returned_value.status_code))
+        raise YoutubeRequestFailed(
+            'Status == {}'.format(returned_value.status_code))
+
+    def search_topics(self, topics: list, concurrency: int = YOUTUBE_POOL_SIZE,
+                      deadline: float = YOUTUBE_SEARCH_DEADLINE):
+        """Searches many topics concurrently, see search_topics."""
+        return search_topics(self, topics, concurrency, deadline)
 
 
 DEFAULT_YOUTUBE_WORKOUT_SEARCH = {'etag': 'oww2YjQMhgQkbCus-YCrHhCOLa0',
@@ -319,5 +513,432 @@ DEFAULT_YOUTUBE_DIET_SEARCH = {'etag': 'GjebS7ncm1hcm7yey5lCN3V52w4',
                                'regionCode': 'US'}
 
 
+class AsyncYoutube:
+    """
+    Searches many topics concurrently with a Youtube client.
+    requests has no asyncio support, so each search runs on a worker thread
+    sharing the client's pooled Session, at most concurrency at a time.
+    Every search must finish within deadline seconds, and once one reports an
+    exhausted quota the searches not yet started fail without calling the API.
+    """
+
+    def __init__(self, youtube, concurrency: int = YOUTUBE_POOL_SIZE,
+                 deadline: float = YOUTUBE_SEARCH_DEADLINE):
+        """Constructor for AsyncYoutube class."""
+        self.youtube = youtube
+        self.concurrency = max(concurrency, 1)
+        self.deadline = deadline
+
+    async def search_topic(self, topic: str, executor: ThreadPoolExecutor = None):
+        """Returns the search result of the topic, raising YoutubeRequestFailed past the deadline."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(executor, self.youtube.search_topic, topic),
+                self.deadline)
+        except asyncio.TimeoutError:
+            raise YoutubeRequestFailed('Deadline of {}s exceeded'.format(self.deadline))
+
+    async def search_topics(self, topics: list):
+        """Returns {topic: search result, or the exception raised} for every topic."""
+        topics = list(dict.fromkeys(topics))
+        semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        quota_exceeded = asyncio.Event()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                      thread_name_prefix='youtube-search')
+
+        async def search(topic):
+            async with semaphore:
+                if quota_exceeded.is_set():
+                    raise YoutubeQuotaExceeded('Quota exceeded before {} was searched'.format(topic))
+                try:
+                    return await self.search_topic(topic, executor)
+                except YoutubeQuotaExceeded:
+                    quota_exceeded.set()
+                    raise
+
+        try:
+            results = await asyncio.gather(*(search(topic) for topic in topics),
+                                           return_exceptions=True)
+        finally:
+            # Searches past their deadline end on their own with the Session timeouts
+            executor.shutdown(wait=False)
+        return dict(zip(topics, results))
+
+
+def search_topics(youtube, topics: list, concurrency: int = YOUTUBE_POOL_SIZE,
+                  deadline: float = YOUTUBE_SEARCH_DEADLINE):
+    """
+    Synchronous wrapper of AsyncYoutube.search_topics for Flask routes and jobs, so
+    searching many topics takes as long as the slowest one. youtube is any client
+    with a search_topic method. Can not be called from a running event loop.
+    """
+    return asyncio.run(AsyncYoutube(youtube, concurrency, deadline).search_topics(topics))
+
+
+def trim_search_result(result: dict):
+    """
+    Returns the videos of a Youtube search result as a list of dictionaries
+    holding only what the templates render: videoId, title, thumbnail and channel.
+    """
+    videos = []
+    for item in result.get('items', []):
+        video_id = item.get('id', {}).get('videoId')
+        if video_id is None:
+            # Channels and playlists can not be embedded as videos
+            continue
+        snippet = item.get('snippet', {})
+        thumbnails = snippet.get('thumbnails', {})
+        thumbnail = thumbnails.get('high') or thumbnails.get('medium') or thumbnails.get('default') or {}
+        videos.append({
+            'videoId': video_id,
+            'title': snippet.get('title', ''),
+            'thumbnail': thumbnail.get('url', ''),
+            'channel': snippet.get('channelTitle', '')
+        })
+    return videos
+
+
+class CachedYoutube:
+    """
+    Caches the trimmed videos of Youtube searches by topic, see trim_search_result.
+    A result is fresh for ttl seconds. For stale_seconds after that it is still
+    served while a single background thread refreshes it, past that the caller
+    fetches it again. Failed searches are remembered for error_ttl seconds and
+    raise YoutubeRequestFailed without calling the API, so an exhausted quota is
+    not hammered, and a failed refresh is not retried before error_ttl either.
+    At most maxsize topics are kept, least recently used first out.
+
+    With a database_factory, results are also read through and written to the
+    shared youtube_cache collection, so a restarted worker or another process
+    starts warm instead of calling the API. Failures are only cached in process.
+
+    When read_only is set, only prefetch calls the API: misses raise
+    YoutubeRequestFailed and stale topics are reloaded from the shared cache.
+    """
+
+    def __init__(self,
+                 youtube,
+                 maxsize: int = 64,
+                 ttl: float = 3600,
+                 stale_seconds: float = 86400,
+                 error_ttl: float = 60,
+                 database_factory=None,
+                 read_only: bool = False):
+        """Constructor for CachedYoutube class."""
+        self.youtube = youtube
+        self.ttl = ttl
+        self.stale_seconds = stale_seconds
+        self.error_ttl = error_ttl
+        self.database_factory = database_factory
+        self.read_only = read_only
+        self.entries = LRUCache(maxsize=maxsize,
+                                ttl=ttl + max(stale_seconds, error_ttl))
+        self.reset()
+
+    def reset(self):
+        """Drops every entry, counter, lock and pending refresh. Used after a fork."""
+        self.entries.reset()
+        self._lock = Lock()
+        self._topic_locks = {}
+        self._refreshing = set()
+        self._retry_at = {}
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.prefetches = 0
+
+    def search_topic(self, topic: str):
+        """
+        Returns the cached videos of the topic, fetching them on a miss.
+        Raises YoutubeRequestFailed if the search failed within the last error_ttl
+        seconds, or on a miss when read_only.
+        """
+        entry = self._lookup(topic)
+        if entry is not None:
+            return self._result(entry)
+
+        # Concurrent misses on the same topic wait for a single fetch
+        with self._topic_lock(topic):
+            entry = self._lookup(topic, count=False)
+            if entry is not None:
+                return self._result(entry)
+
+            entry = self._load(topic)
+            if entry is not None:
+                self._count('shared_hits')
+                self.entries.set(topic, entry)
+                return self._result(entry)
+
+            self._count('misses')
+            if self.read_only:
+                raise YoutubeRequestFailed('{} is not cached'.format(topic))
+            return self._result(self._fetch(topic))
+
+    def search_topics(self, topics: list, concurrency: int = YOUTUBE_POOL_SIZE):
+        """
+        Returns {topic: videos, or the YoutubeRequestFailed raised} for every topic.
+        Topics missing from both caches are fetched concurrently, see search_topics.
+        """
+        results = {}
+        missing = []
+        for topic in dict.fromkeys(topics):
+            entry = self._lookup(topic)
+            if entry is None:
+                entry = self._load(topic)
+                if entry is not None:
+                    self._count('shared_hits')
+                    self.entries.set(topic, entry)
+            if entry is None:
+                self._count('misses')
+                missing.append(topic)
+            else:
+                results[topic] = entry
+
+        if self.read_only:
+            for topic in missing:
+                results[topic] = YoutubeRequestFailed('{} is not cached'.format(topic))
+        else:
+            results.update(self._fetch_many(missing, concurrency))
+
+        for topic, entry in results.items():
+            try:
+                results[topic] = self._result(entry) if isinstance(entry, tuple) else entry
+            except YoutubeRequestFailed as error:
+                results[topic] = error
+        return results
+
+    def prefetch(self, topics: list, workers: int = YOUTUBE_PREFETCH_WORKERS):
+        """
+        Concurrently searches every topic whose shared copy is older than ttl, on up
+        to workers threads. Stops calling the API once it reports an exhausted quota.
+        Returns the number of topics fetched.
+        """
+        due = []
+        for topic in dict.fromkeys(topics):
+            entry = self._load(topic)
+            if entry is None or monotonic() - entry[0] >= self.ttl:
+                due.append(topic)
+
+        fetched = sum(1 for entry in self._fetch_many(due, workers, keep_stale=True).values()
+                      if isinstance(entry, tuple))
+        with self._lock:
+            self.prefetches += fetched
+        return fetched
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _lookup(self, topic: str, count: bool = True):
+        """
+        Returns the usable entry of the topic, scheduling a refresh if it is stale.
+        Returns None when the topic has to be fetched by the caller.
+        """
+        entry = self.entries.get(topic)
+        if entry is None:
+            return None
+
+        fetched_at, videos, error = entry
+        age = monotonic() - fetched_at
+        if error is not None:
+            if age >= self.error_ttl:
+                return None
+            counter = 'negative_hits'
+        elif age < self.ttl:
+            counter = 'fresh_hits'
+        elif age < self.ttl + self.stale_seconds:
+            counter = 'stale_hits'
+            self._refresh_in_background(topic)
+        else:
+            return None
+
+        if count:
+            self._count(counter)
+        return entry
+
+    def _result(self, entry):
+        fetched_at, videos, error = entry
+        if error is not None:
+            raise YoutubeRequestFailed(error)
+        return videos
+
+    def _load(self, topic: str):
+        """Returns the entry of the topic stored in the shared cache, or None if missing or too old."""
+        if self.database_factory is None:
+            return None
+
+        try:
+            found = self.database_factory().get_youtube_videos(topic)
+        except Exception as error:
+            logger.warning('Could not read the shared Youtube cache: {!r}'.format(error))
+            return None
+        if found is None:
+            return None
+
+        videos, fetched_at = found
+        age = (datetime.utcnow() - fetched_at).total_seconds()
+        if age >= self.ttl + self.stale_seconds:
+            # The TTL monitor only runs once a minute
+            return None
+        return (monotonic() - max(age, 0), videos, None)
+
+    def _store(self, topic: str, videos: list):
+        """Writes the videos of the topic to the shared cache."""
+        if self.database_factory is None:
+            return
+
+        fetched_at = datetime.utcnow()
+        try:
+            self.database_factory().set_youtube_videos(
+                topic, videos, fetched_at,
+                fetched_at + timedelta(seconds=self.ttl + self.stale_seconds))
+        except Exception as error:
+            logger.warning('Could not write the shared Youtube cache: {!r}'.format(error))
+
+    def _fetch(self, topic: str, keep_stale: bool = False):
+        """
+        Searches the topic and stores the videos or the failure.
+        With keep_stale, a failure leaves the stale videos in place instead.
+        """
+        try:
+            videos = trim_search_result(self.youtube.search_topic(topic))
+        except Exception as error:
+            logger.warning('Youtube search for {} failed: {!r}'.format(topic, error))
+            if keep_stale:
+                raise
+            entry = (monotonic(), None, str(error))
+        else:
+            entry = (monotonic(), videos, None)
+            self._store(topic, videos)
+
+        self.entries.set(topic, entry)
+        return entry
+
+    def _fetch_many(self, topics: list, concurrency: int, keep_stale: bool = False):
+        """
+        Searches the topics concurrently and stores their videos or failures.
+        Returns {topic: entry, or the exception raised when keep_stale}.
+        """
+        if not topics:
+            return {}
+
+        entries = {}
+        for topic, result in search_topics(self.youtube, topics, concurrency).items():
+            if isinstance(result, Exception):
+                logger.warning('Youtube search for {} failed: {!r}'.format(topic, result))
+                if keep_stale:
+                    entries[topic] = result
+                    continue
+                entry = (monotonic(), None, str(result))
+            else:
+                videos = trim_search_result(result)
+                entry = (monotonic(), videos, None)
+                self._store(topic, videos)
+
+            self.entries.set(topic, entry)
+            entries[topic] = entry
+        return entries
+
+    def _topic_lock(self, topic: str):
+        with self._lock:
+            return self._topic_locks.setdefault(topic, Lock())
+
+    def _refresh_in_background(self, topic: str):
+        """Starts a refresh thread for the topic unless one is running or recently failed."""
+        with self._lock:
+            if topic in self._refreshing or monotonic() < self._retry_at.get(topic, 0):
+                return
+            self._refreshing.add(topic)
+
+        Thread(target=self._refresh, args=(topic,),
+               name='youtube-refresh', daemon=True).start()
+
+    def _refresh(self, topic: str):
+        try:
+            with self._topic_lock(topic):
+                # Another process may have refreshed the shared cache already
+                entry = self._load(topic)
+                current = self.entries.get(topic)
+                if entry is not None and monotonic() - entry[0] < self.ttl:
+                    self.entries.set(topic, entry)
+                elif self.read_only:
+                    if entry is not None and (current is None or entry[0] > current[0]):
+                        self.entries.set(topic, entry)
+                    raise YoutubeRequestFailed('{} was not prefetched'.format(topic))
+                else:
+                    self._fetch(topic, keep_stale=True)
+            self._count('refreshes')
+        except Exception:
+            with self._lock:
+                self.refresh_failures += 1
+                self._retry_at[topic] = monotonic() + self.error_ttl
+        finally:
+            with self._lock:
+                self._refreshing.discard(topic)
+
+    def stats(self):
+        """Returns the hit, miss and refresh counters of the cache."""
+        entries = self.entries.stats()
+        with self._lock:
+            hits = self.fresh_hits + self.stale_hits + self.negative_hits + self.shared_hits
+            lookups = hits + self.misses
+            return {
+                'fresh_hits': self.fresh_hits,
+                'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_ratio': hits / lookups if lookups else 0.0,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'prefetches': self.prefetches,
+                'evictions': entries['evictions'],
+                'size': entries['size'],
+                'maxsize': entries['maxsize']
+            }
+
+
 class YoutubeRequestFailed(Exception):
     pass
+
+
+class YoutubeCircuitOpen(YoutubeRequestFailed):
+    """If Youtube is not called because its circuit breaker is open"""
+    pass
+
+
+class YoutubeQuotaExceeded(YoutubeRequestFailed):
+    """If Youtube refused a search because the quota or rate limit was exhausted"""
+    pass
+
+
+"""
+Process wide cache of Youtube search results by topic.
+create_app points its database_factory at the shared youtube_cache collection.
+"""
+youtube_cache = CachedYoutube(Youtube(GOOGLE_YOUTUBE_KEY),
+                              maxsize=YOUTUBE_CACHE_SIZE,
+                              ttl=YOUTUBE_CACHE_TTL,
+                              stale_seconds=YOUTUBE_CACHE_STALE_SECONDS,
+                              error_ttl=YOUTUBE_CACHE_ERROR_TTL)
+
+
+def _reset_after_fork():
+    """Forget the session, breaker and cached results inherited from a parent process."""
+    global _session, _session_lock
+    _session = None
+    _session_lock = Lock()
+    youtube_cache.reset()
+    youtube_cache.youtube.breaker.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+DEFAULT_WORKOUT_VIDEOS = trim_search_result(DEFAULT_YOUTUBE_WORKOUT_SEARCH)
+DEFAULT_DIET_VIDEOS = trim_search_result(DEFAULT_YOUTUBE_DIET_SEARCH)